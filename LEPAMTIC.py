@@ -1,5 +1,12 @@
+import re
 import json
+import logging
+import itertools
 
+from metrics import tagged
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
 
 pattern_fields = ['land_management_practice', 'land_management_practice_category', 'land_management_practice_unified', 'effect', 'property', 'actor', 'method_or_measurement', 'temporal_scope', 'locational_scope', 'contrasting_land_management_practice', 'contrasting_land_management_practice_category', 'contrasting_land_management_practice_unified', 'location_country', 'study_type', 'sentences', 'comment']
 
@@ -7,6 +14,11 @@ pattern_fields_quoted = ['"land_management_practice"', '"land_management_practic
 
 unified_properties = ['diversity', 'abundance', 'activity', 'ecological index', 'biomass']
 
+prescreen_fields = ['relevance', 'comment']
+
+# JSON types of the fields which are not strings (for structured outputs)
+field_types = {'relevance': 'integer', 'score': 'number'}
+
 
 
 def parse_JSONL(s, required_fields=None):
@@ -28,8 +40,209 @@ def parse_JSONL(s, required_fields=None):
     return jsons
 
 
-def prescreen(llm, abstract, **kwargs):
-    prompt = f'''1. Objective
+def salvage_JSONL(s, required_fields=None):
+    '''Tolerant version of parse_JSONL() which keeps the valid lines.
+
+    Returns a tuple (rows, lines) where lines are the JSON lines of the answer and rows the parsed objects,
+    with None in place of the lines which are not valid JSON or miss some of the required fields.
+    '''
+    rows = []
+    lines = []
+    for x in s.split('\n'):
+        x = x.strip()
+        if not x.startswith('{'):
+            continue
+        try:
+            j = json.loads(x)
+        except json.JSONDecodeError:
+            j = None
+        if not isinstance(j, dict) or (required_fields and set(required_fields) - set(j.keys())):
+            j = None
+        rows.append(j)
+        lines.append(x)
+    return rows, lines
+
+
+def json_schema_format(required_fields):
+    '''The response_format of strict structured outputs: an object with the JSONL objects as a list under "items".'''
+    item_schema = {'type': 'object',
+                   'properties': {field: {'type': field_types.get(field, 'string')} for field in required_fields},
+                   'required': list(required_fields),
+                   'additionalProperties': False}
+    return {'type': 'json_schema',
+            'json_schema': {'name': 'items',
+                            'strict': True,
+                            'schema': {'type': 'object',
+                                       'properties': {'items': {'type': 'array', 'items': item_schema}},
+                                       'required': ['items'],
+                                       'additionalProperties': False}}}
+
+
+def parse_answer(s, required_fields=None):
+    '''Parse a JSONL answer or a structured output (see json_schema_format()) in the same way as parse_JSONL().'''
+    try:
+        obj = json.loads(s)
+    except json.JSONDecodeError:
+        obj = None
+    if isinstance(obj, dict) and list(obj.keys()) == ['items'] and isinstance(obj['items'], list):
+        return parse_JSONL('\n'.join(json.dumps(item) for item in obj['items']), required_fields)
+    return parse_JSONL(s, required_fields)
+
+
+def repair_prompt(invalid_lines, required_fields=None):
+    fields = f' with all of the fields {", ".join(required_fields)}' if required_fields else ''
+    invalid = '\n'.join(invalid_lines)
+    return f'''The following lines of your answer are not valid JSON objects{fields}:
+
+{invalid}
+
+Output corrected versions of only these lines in JSONL format (one valid JSON object per line{fields}). Use double quotes for all strings and do not include any extra text.'''
+
+
+def JSONL_line_checker(required_fields=None, on_row=None):
+    '''Return a function which parses one line of a JSONL answer as parse_JSONL() does (see ChatDialog.ask()).
+
+    Invalid lines raise JSONDecodeError (which aborts a streamed answer), valid objects are passed to on_row.
+    '''
+    def check_line(line):
+        for row in parse_JSONL(line, required_fields):
+            if on_row is not None:
+                on_row(row)
+    return check_line
+
+
+def ask_JSONL(llm, prompt, required_fields=None, on_row=None, **kwargs):
+    '''Ask the LLM and parse the JSONL answer as parse_JSONL() does.
+
+    With llm.structured_outputs the answer is constrained by a strict JSON schema built from required_fields.
+    Otherwise, invalid lines are asked for again (up to llm.salvage_attempts times) instead of discarding the
+    whole answer. The repaired answer replaces the original one in the dialog so later turns see all rows.
+    With llm.stream every line is checked as soon as it arrives and the generation is aborted at the first
+    invalid line (there is nothing to salvage then).
+    If the answer is still invalid, the turn is asked again from the same messages (up to llm.turn_retries times).
+    Invalid answers are removed from the LLM's cache.
+
+    on_row is called with every valid object; with llm.stream as soon as its line arrives (so rows of an
+    aborted answer can be followed by the rows of the repeated turn).
+    '''
+    snapshot = llm.snapshot()
+    for attempt in range(llm.turn_retries + 1):
+        keys = []
+        try:
+            with tagged(attempt=attempt):
+                return ask_JSONL_once(llm, prompt, required_fields, keys, on_row, **kwargs)
+        except json.JSONDecodeError as e:
+            llm.forget_responses(keys)
+            if attempt == llm.turn_retries:
+                raise
+            logger.info(f'{e}: turn retry {attempt+1} of {llm.turn_retries}')
+            llm.restore(snapshot)
+
+
+async def ask_JSONL_async(llm, prompt, required_fields=None, on_row=None, **kwargs):
+    snapshot = llm.snapshot()
+    for attempt in range(llm.turn_retries + 1):
+        keys = []
+        try:
+            with tagged(attempt=attempt):
+                return await ask_JSONL_once_async(llm, prompt, required_fields, keys, on_row, **kwargs)
+        except json.JSONDecodeError as e:
+            llm.forget_responses(keys)
+            if attempt == llm.turn_retries:
+                raise
+            logger.info(f'{e}: turn retry {attempt+1} of {llm.turn_retries}')
+            llm.restore(snapshot)
+
+
+def ask_JSONL_once(llm, prompt, required_fields, keys, on_row=None, **kwargs):
+    '''One attempt of ask_JSONL(). The cache keys of all calls are added to keys.'''
+    if llm.structured_outputs and required_fields:
+        answer = llm.ask(prompt, response_format=json_schema_format(required_fields), **kwargs)
+        keys.append(llm.last_cache_key)
+        return emit_rows(parse_answer(answer, required_fields), on_row)
+    if llm.stream:
+        try:
+            answer = llm.ask(prompt, on_line=JSONL_line_checker(required_fields, on_row), **kwargs)
+        finally:
+            keys.append(llm.last_cache_key)
+        return parse_JSONL(answer, required_fields)
+    answer = llm.ask(prompt, **kwargs)
+    keys.append(llm.last_cache_key)
+    if not llm.salvage_attempts:
+        return emit_rows(parse_JSONL(answer, required_fields), on_row)
+
+    rows, lines = salvage_JSONL(answer, required_fields)
+    n_repairs = 0
+    while None in rows and n_repairs < llm.salvage_attempts:
+        invalid = [line for row, line in zip(rows, lines) if row is None]
+        snapshot = llm.snapshot()
+        with tagged(repair=n_repairs + 1):
+            repaired = llm.ask(repair_prompt(invalid, required_fields), **kwargs)
+        keys.append(llm.last_cache_key)
+        llm.restore(snapshot)
+        rows, lines = merge_repaired(rows, lines, *salvage_JSONL(repaired, required_fields))
+        n_repairs += 1
+    return emit_rows(finish_salvage(llm, answer, rows, lines, n_repairs), on_row)
+
+
+async def ask_JSONL_once_async(llm, prompt, required_fields, keys, on_row=None, **kwargs):
+    if llm.structured_outputs and required_fields:
+        answer = await llm.ask(prompt, response_format=json_schema_format(required_fields), **kwargs)
+        keys.append(llm.last_cache_key)
+        return emit_rows(parse_answer(answer, required_fields), on_row)
+    if llm.stream:
+        try:
+            answer = await llm.ask(prompt, on_line=JSONL_line_checker(required_fields, on_row), **kwargs)
+        finally:
+            keys.append(llm.last_cache_key)
+        return parse_JSONL(answer, required_fields)
+    answer = await llm.ask(prompt, **kwargs)
+    keys.append(llm.last_cache_key)
+    if not llm.salvage_attempts:
+        return emit_rows(parse_JSONL(answer, required_fields), on_row)
+
+    rows, lines = salvage_JSONL(answer, required_fields)
+    n_repairs = 0
+    while None in rows and n_repairs < llm.salvage_attempts:
+        invalid = [line for row, line in zip(rows, lines) if row is None]
+        snapshot = llm.snapshot()
+        with tagged(repair=n_repairs + 1):
+            repaired = await llm.ask(repair_prompt(invalid, required_fields), **kwargs)
+        keys.append(llm.last_cache_key)
+        llm.restore(snapshot)
+        rows, lines = merge_repaired(rows, lines, *salvage_JSONL(repaired, required_fields))
+        n_repairs += 1
+    return emit_rows(finish_salvage(llm, answer, rows, lines, n_repairs), on_row)
+
+
+def emit_rows(rows, on_row):
+    '''Pass the rows to on_row (if given) and return them.'''
+    if on_row is not None:
+        for row in rows:
+            on_row(row)
+    return rows
+
+
+def merge_repaired(rows, lines, repaired_rows, repaired_lines):
+    '''Put the valid repaired rows in place of the invalid ones (in order), extra rows are appended.'''
+    repaired = iter([(row, line) for row, line in zip(repaired_rows, repaired_lines) if row is not None])
+    merged = [(row, line) if row is not None else next(repaired, (None, line)) for row, line in zip(rows, lines)]
+    merged += list(repaired)
+    return [row for row, line in merged], [line for row, line in merged]
+
+
+def finish_salvage(llm, answer, rows, lines, n_repairs):
+    invalid = [line for row, line in zip(rows, lines) if row is None]
+    if invalid:
+        raise json.JSONDecodeError(f'Error: invalid JSON: "{invalid[0]}"', answer, 0)
+    if n_repairs:
+        logger.debug(f'Repaired answer with {n_repairs} extra call(s)')
+        llm.messages[-1]['content'] = '\n'.join(json.dumps(row) for row in rows)
+    return rows
+
+
+def prescreen_prompt(abstract):
+    return f'''1. Objective
 You are screening scientific abstracts that describe how land management practices affect soil biota. We aim to identify abstracts suitable for structured data extraction.
 
 2. Target Extraction Template
@@ -66,15 +279,32 @@ The object must contain the following fields:
 
 {abstract}
 '''
-    result = parse_JSONL(llm.ask(prompt, **kwargs))
+
+
+def prescreen(llm, abstract, **kwargs):
+    with tagged(turn=1):
+        result = ask_JSONL(llm, prescreen_prompt(abstract), prescreen_fields, **kwargs)
+    return result
+
+
+async def prescreen_async(llm, abstract, **kwargs):
+    with tagged(turn=1):
+        result = await ask_JSONL_async(llm, prescreen_prompt(abstract), prescreen_fields, **kwargs)
     return result
 
 
-def extract_patterns(llm, text, **kwargs):
+def prescreen_turns(abstract):
+    '''The conversation of prescreen() as a list of (prompt, required_fields) turns.
 
-    prompt_intro = '''I am interested in how land management practices affect soil biota actors and how this is measured. I want you to analyze the abstract of a scientific publication. I will provide you with a template which you will fill in using the information extracted from the abstract.'''
+    required_fields is None if the answer is not parsed, otherwise the answer is parsed with parse_answer().
+    The result of the conversation is the parsed answer of the last turn.
+    '''
+    return [(prescreen_prompt(abstract), prescreen_fields)]
 
-    prompt_task_description = '''I am looking for specific, compact knowledge patterns which fit the following template:
+
+prompt_intro = '''I am interested in how land management practices affect soil biota actors and how this is measured. I want you to analyze the abstract of a scientific publication. I will provide you with a template which you will fill in using the information extracted from the abstract.'''
+
+prompt_task_description = '''I am looking for specific, compact knowledge patterns which fit the following template:
     
     1. land management practice L
     2. has effect E
@@ -95,13 +325,13 @@ For example:
     7. 0-10 cm soil layers (I)
     9. conventional tillage (C)'''
 
-    prompt_additional_requirements = '''Here are some additional requirements:
+prompt_additional_requirements = '''Here are some additional requirements:
     
     - Ignore sentences that express doubt, uncertainty, lack of knowledge, or that only describe the study aim without reporting results.
     - For the effect field, use only one of these options: "increase", "decrease", "no effect", "NA".
     - Make sure to include actors that are enzymes, communities, functional groups (e.g., microbes), or specific taxa.'''
 
-    prompt_export = f'''You will now export the extracted soil biology patterns from the abstract into a structured format for analysis.
+prompt_export = f'''You will now export the extracted soil biology patterns from the abstract into a structured format for analysis.
 
 1. Task
     - For each extracted pattern, produce a flat JSON object with standardized fields.
@@ -154,7 +384,7 @@ Additional normalization
     - Represent "Agroforestry" as "Crop diversification".
 '''
 
-    prompt_split_conjuncts = f'''Review the current list of extracted patterns. Some patterns may contain conjunctions in the property or actor fields.
+prompt_split_conjuncts = f'''Review the current list of extracted patterns. Some patterns may contain conjunctions in the property or actor fields.
 
 1. Task
     - If the property or actor field contains conjunctions (e.g., "and", "or", "as well as", "along with"), split them into separate items.
@@ -175,21 +405,227 @@ Additional normalization
 
 {chr(10).join(pattern_fields_quoted)}'''
 
-    
-    _ = llm.ask(prompt_intro, **kwargs)
-    _ = llm.ask(prompt_task_description, **kwargs)
-    _ = llm.ask(prompt_additional_requirements, **kwargs)
-    _ = llm.ask(text, **kwargs)
-    patterns = parse_JSONL(llm.ask(prompt_export, **kwargs), pattern_fields)
-    result = parse_JSONL(llm.ask(prompt_split_conjuncts, **kwargs), pattern_fields)
+
+# stands for the export request (with the abstract, in the compact chain) when the context is trimmed
+prompt_export_condensed = 'Export the extracted patterns in JSONL format, one pattern per line.'
+
+
+def trim_for_split(llm):
+    '''With llm.trim_context the conjunction splitting turn only gets the exported patterns.
+
+    The earlier turns (the instructions, their acknowledgements and the abstract) are dropped from the dialog
+    and the export request is condensed to one sentence.
+    '''
+    if not getattr(llm, 'trim_context', False):
+        return
+    llm.drop_turns(1)
+    llm.messages[-2]['content'] = prompt_export_condensed
+
+
+# conjunctions which separate the items of a property or actor (commas are separators too if one of them is present)
+conjunction_re = re.compile(r',?\s+(?:and/or|and|or|as well as|along with|&)\s+', re.IGNORECASE)
+# values in which a conjunction may not separate items
+relation_re = re.compile(r'[()\[\]]|\b(?:ratios?|between|interactions?|relationships?|balance|versus|vs|both|either|neither)\b', re.IGNORECASE)
+# prepositional phrases ("abundance of nematodes"), which may belong to all items of a value
+prepositions_re = re.compile(r'\s(?:of|in|on|for|from|under|at|with|to)\s', re.IGNORECASE)
+
+split_modes = ['llm', 'local', 'auto']
+
+
+def split_conjunct_value(value):
+    '''Split a property or actor at conjunctions ("and", "or", "as well as", "along with", and commas in a list).
+
+    Returns the list of items ([value] if there is no conjunction) or None if the value is ambiguous: the
+    conjunction is in parentheses or in a relation ("ratio", "between", ...), or the items may share words.
+    Items are taken to share words if they have different numbers of words (a shared head noun as in
+    "bacterial and fungal biomass", or a modifier of the first item as in "bacterial abundance and diversity")
+    or if only some of them have a prepositional phrase ("abundance and diversity of nematodes"). Items of
+    several words are only split if they repeat their first or last word ("soil carbon and soil nitrogen") or
+    each have a prepositional phrase, since "total carbon and nitrogen content" may share both.
+    '''
+    if not isinstance(value, str) or not conjunction_re.search(value):
+        return [value]
+    if relation_re.search(value):
+        return None
+    items = [item.strip() for part in conjunction_re.split(value) for item in part.split(',')]
+    if '' in items:
+        return None
+    if len({len(item.split()) for item in items}) > 1:
+        return None
+    with_phrase = [bool(prepositions_re.search(item)) for item in items]
+    if any(with_phrase) and not all(with_phrase):
+        return None
+    # a modifier or head of the first item may belong to all of them unless every item repeats it
+    words = [item.lower().split() for item in items]
+    if len(words[0]) > 1 and not all(with_phrase) and len({w[0] for w in words}) > 1 and len({w[-1] for w in words}) > 1:
+        return None
+    return items
+
+
+def split_conjunctions(patterns):
+    '''Local, deterministic counterpart of the conjunction splitting turn (prompt_split_conjuncts).
+
+    Every pattern is replaced by the Cartesian product of the items of its property and actor (see
+    split_conjunct_value()); the other fields are kept. Returns a tuple (patterns, ambiguous) where
+    ambiguous is the list of values which could not be split safely (their patterns are kept unchanged).
+    '''
+    result = []
+    ambiguous = []
+    for pattern in patterns:
+        items = {}
+        for field in ('property', 'actor'):
+            items[field] = split_conjunct_value(pattern.get(field))
+            if items[field] is None:
+                ambiguous.append(pattern[field])
+                items[field] = [pattern[field]]
+        result.extend(dict(pattern, property=property, actor=actor) for property, actor in itertools.product(items['property'], items['actor']))
+    return result, ambiguous
+
+
+def split_locally(patterns, split_by):
+    '''The exported patterns with conjunctions split by split_conjunctions() or None if the LLM turn is needed.
+
+    split_by is one of split_modes: 'llm' always uses the LLM turn, 'auto' only if some value is ambiguous and
+    'local' never (ambiguous values are kept as they are).
+    '''
+    if split_by == 'llm':
+        return None
+    result, ambiguous = split_conjunctions(patterns)
+    if ambiguous:
+        logger.debug(f'Ambiguous conjunctions in {ambiguous}' + (', splitting them with the LLM' if split_by == 'auto' else ', kept'))
+        if split_by == 'auto':
+            return None
     return result
 
 
-def extract_score(llm, text, **kwargs):
-    if llm.reset_for_each_call:
-        raise TypeError('LLM must retain context here')
-        
-    prompt1 = '''I am researching the literature on how land management practices impact soil biota and the methodologies used to measure these effects. My goal is to identify patterns that describe how specific land management practices influence particular soil biota actors compared to contrasting practices. First, I aim to develop a method to evaluate scientific abstracts based on how effectively they describe these patterns, including information on the practices, effects, actors, and contrasts. I will give you scoring instructions which you will apply to the given abstract.
+def extract_patterns(llm, text, on_pattern=None, split_by='llm', **kwargs):
+    '''Extract the patterns of the abstract with the full prompt chain.
+
+    on_pattern is called with every final pattern as soon as it is available (see ask_JSONL()).
+    split_by (see split_locally()) selects whether the last turn (conjunction splitting) is asked or done locally.
+    '''
+    for turn, prompt in enumerate([prompt_intro, prompt_task_description, prompt_additional_requirements, text], start=1):
+        with tagged(turn=turn):
+            _ = llm.ask(prompt, **kwargs)
+    with tagged(turn=5):
+        patterns = ask_JSONL(llm, prompt_export, pattern_fields, **kwargs)
+    result = split_locally(patterns, split_by)
+    if result is not None:
+        return emit_rows(result, on_pattern)
+    trim_for_split(llm)
+    with tagged(turn=6):
+        result = ask_JSONL(llm, prompt_split_conjuncts, pattern_fields, on_row=on_pattern, **kwargs)
+    return result
+
+
+async def extract_patterns_async(llm, text, on_pattern=None, split_by='llm', **kwargs):
+    for turn, prompt in enumerate([prompt_intro, prompt_task_description, prompt_additional_requirements, text], start=1):
+        with tagged(turn=turn):
+            _ = await llm.ask(prompt, **kwargs)
+    with tagged(turn=5):
+        patterns = await ask_JSONL_async(llm, prompt_export, pattern_fields, **kwargs)
+    result = split_locally(patterns, split_by)
+    if result is not None:
+        return emit_rows(result, on_pattern)
+    trim_for_split(llm)
+    with tagged(turn=6):
+        result = await ask_JSONL_async(llm, prompt_split_conjuncts, pattern_fields, on_row=on_pattern, **kwargs)
+    return result
+
+
+def extract_patterns_turns(text, split_by='llm'):
+    '''The conversation of extract_patterns() as a list of turns (see prescreen_turns()).
+
+    Unless split_by is 'llm' the conjunction splitting turn is left out (use split_conjunctions() on the answer).
+    '''
+    turns = [(prompt_intro, None),
+             (prompt_task_description, None),
+             (prompt_additional_requirements, None),
+             (text, None),
+             (prompt_export, pattern_fields)]
+    return turns + [(prompt_split_conjuncts, pattern_fields)] if split_by == 'llm' else turns
+
+
+prompt_conjunction_rules = '''4. Conjunctions
+    - If the property or actor field contains conjunctions (e.g., "and", "or", "as well as", "along with"), split them into separate patterns.
+    - If both fields contain conjunctions, generate all possible combinations (Cartesian product).
+    - Keep all other fields exactly the same in the resulting patterns.'''
+
+
+def compact_extraction_prompt(text, split_conjuncts=False):
+    '''The instructions of the first five turns of extract_patterns() and the abstract in a single prompt.'''
+    prompt = f'''{prompt_intro}
+
+{prompt_task_description}
+
+{prompt_additional_requirements}
+
+Here is the abstract:
+
+{text}
+
+{prompt_export}'''
+    if split_conjuncts:
+        prompt += '\n' + prompt_conjunction_rules
+    return prompt
+
+
+def extract_patterns_compact(llm, text, on_pattern=None, split_by='llm', **kwargs):
+    '''Same as extract_patterns() but in two calls: extraction with export and conjunction splitting.'''
+    with tagged(turn=1):
+        patterns = ask_JSONL(llm, compact_extraction_prompt(text), pattern_fields, **kwargs)
+    result = split_locally(patterns, split_by)
+    if result is not None:
+        return emit_rows(result, on_pattern)
+    trim_for_split(llm)
+    with tagged(turn=2):
+        result = ask_JSONL(llm, prompt_split_conjuncts, pattern_fields, on_row=on_pattern, **kwargs)
+    return result
+
+
+async def extract_patterns_compact_async(llm, text, on_pattern=None, split_by='llm', **kwargs):
+    with tagged(turn=1):
+        patterns = await ask_JSONL_async(llm, compact_extraction_prompt(text), pattern_fields, **kwargs)
+    result = split_locally(patterns, split_by)
+    if result is not None:
+        return emit_rows(result, on_pattern)
+    trim_for_split(llm)
+    with tagged(turn=2):
+        result = await ask_JSONL_async(llm, prompt_split_conjuncts, pattern_fields, on_row=on_pattern, **kwargs)
+    return result
+
+
+def extract_patterns_compact_turns(text, split_by='llm'):
+    '''The conversation of extract_patterns_compact() as a list of turns (see extract_patterns_turns()).'''
+    turns = [(compact_extraction_prompt(text), pattern_fields)]
+    return turns + [(prompt_split_conjuncts, pattern_fields)] if split_by == 'llm' else turns
+
+
+def extract_patterns_single(llm, text, on_pattern=None, split_by='llm', **kwargs):
+    '''Same as extract_patterns() but in one call which also splits conjunctions (split_by is not used).'''
+    with tagged(turn=1):
+        return ask_JSONL(llm, compact_extraction_prompt(text, split_conjuncts=True), pattern_fields, on_row=on_pattern, **kwargs)
+
+
+async def extract_patterns_single_async(llm, text, on_pattern=None, split_by='llm', **kwargs):
+    with tagged(turn=1):
+        return await ask_JSONL_async(llm, compact_extraction_prompt(text, split_conjuncts=True), pattern_fields, on_row=on_pattern, **kwargs)
+
+
+def extract_patterns_single_turns(text, split_by='llm'):
+    '''The conversation of extract_patterns_single() as a list of turns (see prescreen_turns()).'''
+    return [(compact_extraction_prompt(text, split_conjuncts=True), pattern_fields)]
+
+
+# prompt chains for pattern extraction: name -> (function, async function, turns)
+pattern_chains = {
+    'full': (extract_patterns, extract_patterns_async, extract_patterns_turns),
+    'compact': (extract_patterns_compact, extract_patterns_compact_async, extract_patterns_compact_turns),
+    'single': (extract_patterns_single, extract_patterns_single_async, extract_patterns_single_turns),
+}
+
+
+score_protocol_prompt = '''I am researching the literature on how land management practices impact soil biota and the methodologies used to measure these effects. My goal is to identify patterns that describe how specific land management practices influence particular soil biota actors compared to contrasting practices. First, I aim to develop a method to evaluate scientific abstracts based on how effectively they describe these patterns, including information on the practices, effects, actors, and contrasts. I will give you scoring instructions which you will apply to the given abstract.
 
 LLM Abstract Scoring Protocol for Soil Biology Data Mining
 
@@ -256,9 +692,10 @@ Final Scoring Instructions & Interpretation:
 4.	Goal - Predict Extraction Consistency: The final score is not a judgment of the abstract's overall scientific quality. Instead, it measures the clarity, specificity, and completeness of the information presented for the purpose of data extraction. A lower score indicates higher ambiguity or missing information pertinent to the extraction task, predicting greater potential variance between automated LLM extraction and human interpretation/extraction. Abstracts scoring higher are expected to yield more consistent and reliable data extraction results.
 
 In essence for the LLM: Evaluate the abstract based on all the rules. Concentrate your evaluation on the key result sentences you identified, but use the full abstract text to find necessary context before applying deductions. Apply deductions cumulatively. The score reflects how easy/unambiguous it is to extract the specific practice-effect-actor information from this abstract.'''
-    _ = llm.ask(prompt1, **kwargs) #, seed=SEED, temperature=TEMPERATURE)
 
-    prompt2 = f'''Evaluate the following abstract using the LLM Abstract Scoring Protocol for Soil Biology Data Mining provided earlier.
+
+def score_prompt(text):
+    return f'''Evaluate the following abstract using the LLM Abstract Scoring Protocol for Soil Biology Data Mining provided earlier.
 
 1. Task
     - Start with a score of 5 points.
@@ -282,12 +719,61 @@ The object must contain:
 
 {text}
 '''
-    answer = llm.ask(prompt2, **kwargs)
-    return parse_JSONL(answer, required_fields=['score', 'score_explanation'])
 
 
-def unify_actors(llm, actor_sentence_dicts, unified_actors_list, **kwargs):
-    prompt = f'''Map soil biota actors to standardized names using the following guidelines:
+def score_protocol_prefix(llm, **kwargs):
+    '''Send the scoring protocol to a fresh dialog and return the messages of the exchange.
+
+    The exchange does not depend on the abstract so it can be computed once and passed as
+    `prefix` to extract_score() for every abstract.
+    '''
+    llm.reset()
+    with tagged(turn=1):
+        _ = llm.ask(score_protocol_prompt, **kwargs)
+    return llm.snapshot()
+
+
+async def score_protocol_prefix_async(llm, **kwargs):
+    llm.reset()
+    with tagged(turn=1):
+        _ = await llm.ask(score_protocol_prompt, **kwargs)
+    return llm.snapshot()
+
+
+def extract_score(llm, text, prefix=None, **kwargs):
+    if llm.reset_for_each_call:
+        raise TypeError('LLM must retain context here')
+        
+    if prefix is None:
+        with tagged(turn=1):
+            _ = llm.ask(score_protocol_prompt, **kwargs) #, seed=SEED, temperature=TEMPERATURE)
+    else:
+        llm.restore(prefix)
+    with tagged(turn=2):
+        return ask_JSONL(llm, score_prompt(text), ['score', 'score_explanation'], **kwargs)
+
+
+async def extract_score_async(llm, text, prefix=None, **kwargs):
+    if llm.reset_for_each_call:
+        raise TypeError('LLM must retain context here')
+
+    if prefix is None:
+        with tagged(turn=1):
+            _ = await llm.ask(score_protocol_prompt, **kwargs)
+    else:
+        llm.restore(prefix)
+    with tagged(turn=2):
+        return await ask_JSONL_async(llm, score_prompt(text), ['score', 'score_explanation'], **kwargs)
+
+
+def extract_score_turns(text):
+    '''The conversation of extract_score() as a list of turns (see prescreen_turns()).'''
+    return [(score_protocol_prompt, None),
+            (score_prompt(text), ['score', 'score_explanation'])]
+
+
+def unify_actors_prompt(actor_sentence_dicts, unified_actors_list):
+    return f'''Map soil biota actors to standardized names using the following guidelines:
 
 1. Input Format
     - "Extracted items": A Python-style list of dictionaries, where each dictionary has the keys:
@@ -316,13 +802,25 @@ Extracted items: {actor_sentence_dicts}
 
 Unified categories: {unified_actors_list}
 '''
-    
-    answer = llm.ask(prompt, **kwargs)
-    return parse_JSONL(answer, required_fields=['actor', 'actor_unified'])
 
 
-def unify_property(llm, property_sentence_dicts, unified_property_list, **kwargs):
-    prompt = f'''Unify the names of soil biota properties that were reported to be affected by land management practices in scientific publications.
+def unify_actors(llm, actor_sentence_dicts, unified_actors_list, **kwargs):
+    with tagged(turn=1):
+        return ask_JSONL(llm, unify_actors_prompt(actor_sentence_dicts, unified_actors_list), ['actor', 'actor_unified'], **kwargs)
+
+
+async def unify_actors_async(llm, actor_sentence_dicts, unified_actors_list, **kwargs):
+    with tagged(turn=1):
+        return await ask_JSONL_async(llm, unify_actors_prompt(actor_sentence_dicts, unified_actors_list), ['actor', 'actor_unified'], **kwargs)
+
+
+def unify_actors_turns(actor_sentence_dicts, unified_actors_list):
+    '''The conversation of unify_actors() as a list of turns (see prescreen_turns()).'''
+    return [(unify_actors_prompt(actor_sentence_dicts, unified_actors_list), ['actor', 'actor_unified'])]
+
+
+def unify_property_prompt(property_sentence_dicts, unified_property_list):
+    return f'''Unify the names of soil biota properties that were reported to be affected by land management practices in scientific publications.
 
 1. Input Format
     - "Extracted items": A Python-style list of dictionaries, where each dictionary has the keys:
@@ -350,8 +848,21 @@ Extracted items: {property_sentence_dicts}
 
 Unified categories: {unified_property_list}
 '''
-    answer = llm.ask(prompt, **kwargs)
-    return parse_JSONL(answer, required_fields=['property', 'property_unified'])
+
+
+def unify_property(llm, property_sentence_dicts, unified_property_list, **kwargs):
+    with tagged(turn=1):
+        return ask_JSONL(llm, unify_property_prompt(property_sentence_dicts, unified_property_list), ['property', 'property_unified'], **kwargs)
+
+
+async def unify_property_async(llm, property_sentence_dicts, unified_property_list, **kwargs):
+    with tagged(turn=1):
+        return await ask_JSONL_async(llm, unify_property_prompt(property_sentence_dicts, unified_property_list), ['property', 'property_unified'], **kwargs)
+
+
+def unify_property_turns(property_sentence_dicts, unified_property_list):
+    '''The conversation of unify_property() as a list of turns (see prescreen_turns()).'''
+    return [(unify_property_prompt(property_sentence_dicts, unified_property_list), ['property', 'property_unified'])]
 
 
 
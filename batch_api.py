@@ -0,0 +1,218 @@
+import os
+import io
+import json
+import time
+import hashlib
+import logging
+
+from openai.types.chat import ChatCompletion
+
+from LEPAMTIC import parse_answer, json_schema_format
+from cassette import CassetteMiss, call_id
+from metrics import tagged
+from json import JSONDecodeError
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+
+def body_hash(body):
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class BatchRunner:
+    '''Runs chat completion requests through the provider's Batch API (files + batches endpoints).
+
+    The client, model and call parameters are taken from a ChatDialog. Every submitted batch is
+    recorded in `work_dir` so an interrupted run picks up the already submitted batches instead of
+    paying for them again.
+    '''
+    def __init__(self, llm, work_dir, poll_interval=60, completion_window='24h'):
+        self.llm = llm
+        self.client = llm.client
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        os.makedirs(self.work_dir, exist_ok=True)
+
+    def run(self, name, conversations, **kwargs):
+        '''Send one request for every conversation (a dict key -> list of messages) and wait for the answers.
+
+        Identical conversations are sent only once and answers found in the dialog's cache are not sent at all.
+        When the dialog's cassette is replayed nothing is sent and conversations without a recorded answer fail.
+        Every answer is recorded in the dialog's metrics and usage (see record_answer()).
+        Returns a dict key -> answer text. Keys of failed requests are not present in the result.
+        '''
+        kwargs = self.llm.call_kwargs(kwargs)
+        cache = self.llm.cache
+        cassette = self.llm.cassette
+        bodies = {}
+        key_to_id = {}
+        answers = {}
+        cache_keys = {}
+        # the first conversation of every request (identical conversations are sent once), for the cassette
+        first_keys = {}
+        for key, messages in conversations.items():
+            body = {'model': self.llm.model, 'messages': messages, **kwargs}
+            custom_id = body_hash(body)
+            key_to_id[key] = custom_id
+            if custom_id in bodies or custom_id in answers:
+                continue
+            if cassette is not None and cassette.replaying:
+                try:
+                    response = cassette.get(self.llm.model, messages, kwargs, call=call_id({'pk': key, 'stage': name}))
+                    answers[custom_id] = response['choices'][0]['message']['content']
+                    self.record_answer(key, response, from_cache=True)
+                except CassetteMiss as e:
+                    logger.warning(str(e))
+                continue
+            if cache is not None:
+                cache_keys[custom_id] = cache.key(self.llm.base_url, self.llm.model, messages, kwargs)
+                response = cache.get(cache_keys[custom_id])
+                if response is not None:
+                    answers[custom_id] = response['choices'][0]['message']['content']
+                    self.record_answer(key, response, from_cache=True)
+                    if cassette is not None:
+                        cassette.record(self.llm.model, messages, kwargs, response, call=call_id({'pk': key, 'stage': name}))
+                    continue
+            bodies[custom_id] = body
+            first_keys[custom_id] = key
+
+        if bodies:
+            started = time.perf_counter()
+            responses = self.run_requests(name, bodies)
+            seconds = time.perf_counter() - started
+            for custom_id, response in responses.items():
+                answers[custom_id] = response['choices'][0]['message']['content']
+                self.record_answer(first_keys[custom_id], response, seconds=seconds)
+                if cache is not None:
+                    cache.put(cache_keys[custom_id], response)
+                if cassette is not None:
+                    cassette.record(self.llm.model, bodies[custom_id]['messages'], kwargs, response,
+                                    call=call_id({'pk': first_keys[custom_id], 'stage': name}))
+        return {key: answers[custom_id] for key, custom_id in key_to_id.items() if custom_id in answers}
+
+    def record_answer(self, key, response, seconds=0, from_cache=False):
+        '''Record a response body in the dialog's metrics (tagged with the conversation key as pk) and token usage.'''
+        completion = ChatCompletion.model_validate(response)
+        if not from_cache:
+            self.llm.record_usage(completion)
+        if self.llm.metrics is not None:
+            with tagged(pk=key):
+                self.llm.metrics.record(self.llm.model, seconds, usage=completion.usage, from_cache=from_cache, batch=True)
+
+    def forget(self, messages, **kwargs):
+        '''Remove the answer to messages from the dialog's cache (e.g., an invalid one) so that the next run sends it again.'''
+        if self.llm.cache is not None:
+            self.llm.cache.delete(self.llm.cache.key(self.llm.base_url, self.llm.model, messages, self.llm.call_kwargs(kwargs)))
+
+    def run_requests(self, name, bodies):
+        '''Submit the request bodies (a dict custom_id -> body) as one batch. Returns a dict custom_id -> response body.'''
+        lines = [json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body})
+                 for custom_id, body in bodies.items()]
+        content = ('\n'.join(lines) + '\n').encode('utf-8')
+        content_hash = hashlib.sha1(content).hexdigest()
+
+        state_fn = os.path.join(self.work_dir, f'{name}.json')
+        state = None
+        if os.path.exists(state_fn):
+            with open(state_fn) as fp:
+                state = json.load(fp)
+            if state.get('requests_sha1') != content_hash:
+                logger.info(f'Batch {name}: requests changed, submitting a new batch')
+                state = None
+
+        if state is None:
+            with open(os.path.join(self.work_dir, f'{name}.jsonl'), 'wb') as fp:
+                fp.write(content)
+            input_file = self.client.files.create(file=(f'{name}.jsonl', io.BytesIO(content)), purpose='batch')
+            batch = self.client.batches.create(input_file_id=input_file.id,
+                                               endpoint='/v1/chat/completions',
+                                               completion_window=self.completion_window)
+            state = {'batch_id': batch.id, 'requests_sha1': content_hash, 'n_requests': len(bodies)}
+            with open(state_fn, 'w') as fp:
+                json.dump(state, fp)
+            logger.info(f'Batch {name}: submitted {len(bodies)} request(s) as {batch.id}')
+        else:
+            logger.info(f'Batch {name}: resuming {state["batch_id"]}')
+
+        batch = self.wait(state['batch_id'], name)
+        responses = {}
+        if batch.output_file_id:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if result.get('error') or response.get('status_code') != 200:
+                    logger.warning(f'Batch {name}: request {result["custom_id"]} failed: {result.get("error") or response.get("body")}')
+                    continue
+                responses[result['custom_id']] = response['body']
+        if len(responses) < len(bodies):
+            print(f'Warning: batch {name}: {len(bodies) - len(responses)} of {len(bodies)} request(s) failed')
+        return responses
+
+    def wait(self, batch_id, name):
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            logger.debug(f'Batch {name}: status {batch.status}, counts {batch.request_counts}')
+            if batch.status in ('completed', 'expired', 'cancelled'):
+                # expired and cancelled batches may still contain some of the answers
+                return batch
+            if batch.status == 'failed':
+                raise RuntimeError(f'Batch {batch_id} failed: {batch.errors}')
+            time.sleep(self.poll_interval)
+
+
+def run_batch_conversations(runner, name, conversations, n_repeats, **kwargs):
+    '''Run many multi-turn conversations with the Batch API, one batch per turn.
+
+    conversations is a dict key -> list of (prompt, required_fields) turns (see LEPAMTIC.prescreen_turns()).
+    All k-th turns go out as one batch and their answers extend the histories which are used for
+    the (k+1)-th turns. Requests whose answer could not be obtained or parsed are sent again
+    (up to n_repeats times) before the conversation is given up. All k-th turns are expected to
+    have the same required_fields (which give the schema of structured outputs).
+
+    Returns a tuple (results, failed) where results is a dict key -> parsed answer of the last turn
+    and failed is a list of keys of the failed conversations.
+    '''
+    histories = {key: runner.llm.initial_messages() for key in conversations}
+    results = {}
+    failed = []
+    active = list(conversations)
+    n_turns = max((len(turns) for turns in conversations.values()), default=0)
+    for k in range(n_turns):
+        pending = [key for key in active if k < len(conversations[key])]
+        turn_kwargs = kwargs
+        required_fields = conversations[pending[0]][k][1] if pending else None
+        if runner.llm.structured_outputs and required_fields:
+            turn_kwargs = dict(kwargs, response_format=json_schema_format(required_fields))
+        for cnt in range(n_repeats):
+            if not pending:
+                break
+            requests = {key: histories[key] + [{'role': 'user', 'content': conversations[key][k][0]}] for key in pending}
+            with tagged(stage=name, turn=k+1, attempt=cnt):
+                answers = runner.run(f'{name}__turn{k+1}__attempt{cnt+1}', requests, **turn_kwargs)
+            still_pending = []
+            for key in pending:
+                prompt, required_fields = conversations[key][k]
+                if key not in answers:
+                    still_pending.append(key)
+                    continue
+                if required_fields is not None:
+                    try:
+                        results[key] = parse_answer(answers[key], required_fields)
+                    except JSONDecodeError as e:
+                        print(e)
+                        print(f'Error in {name} for {key}, turn {k+1}, attempt {cnt+1} of {n_repeats}')
+                        runner.forget(requests[key], **turn_kwargs)
+                        still_pending.append(key)
+                        continue
+                histories[key] = requests[key] + [{'role': 'assistant', 'content': answers[key]}]
+            pending = still_pending
+        failed.extend(pending)
+        pending = set(pending)
+        active = [key for key in active if key not in pending]
+
+    results = {key: results.get(key) for key in active}
+    return results, failed
@@ -0,0 +1,71 @@
+'''Write a synthetic corpus of abstracts (CSV or Excel) for benchmarks.
+
+The abstracts are assembled from sentence templates about land management practices and soil biota, so
+they have the length and the vocabulary of real ones. The same size and seed always give the same corpus.
+
+    python benchmarks/make_corpus.py --n_abstracts 10000 --output_file corpus_10000.csv
+'''
+import random
+import argparse
+
+import pandas as pd
+
+
+PRACTICES = ['no tillage', 'reduced tillage', 'cover cropping', 'organic fertilization', 'mineral fertilization',
+             'crop rotation', 'straw incorporation', 'biochar amendment', 'irrigation', 'agroforestry']
+CONTRASTS = ['conventional tillage', 'bare fallow', 'unfertilized control', 'monoculture', 'straw removal']
+ACTORS = ['bacteria', 'fungi', 'arbuscular mycorrhizal fungi', 'nematodes', 'earthworms', 'collembola',
+          'mites', 'protists', 'the microbial community', 'ammonia-oxidizing archaea']
+PROPERTIES = ['abundance', 'diversity', 'biomass', 'activity', 'community composition', 'richness']
+METHODS = ['qPCR', 'phospholipid fatty acid analysis', '16S rRNA gene amplicon sequencing', 'hand sorting',
+           'the Shannon diversity index', 'substrate-induced respiration']
+COUNTRIES = ['Spain', 'Germany', 'China', 'Brazil', 'the United States', 'Slovenia', 'Kenya', 'France']
+
+TEMPLATES = ['Land management shapes the soil biota of agricultural fields, but the effects of {practice} remain unclear.',
+             'We conducted a {years}-year field experiment in {country} comparing {practice} with {contrast}.',
+             'Soil samples were taken at {depth} cm depth in {season} and analysed with {method}.',
+             'Compared to {contrast}, {practice} {verb} the {property} of {actor} by {percent}%.',
+             'The {property} of {actor} was not affected by {practice}.',
+             'Effects were strongest in the topsoil and declined with depth.',
+             '{actor_cap} responded to changes in soil organic carbon and pH rather than to the practice itself.',
+             'These results suggest that {practice} can support {property} of soil biota in {country}.',
+             'Our findings have implications for the design of sustainable cropping systems.']
+
+
+def make_abstract(rng):
+    values = {'practice': rng.choice(PRACTICES), 'contrast': rng.choice(CONTRASTS), 'actor': rng.choice(ACTORS),
+              'property': rng.choice(PROPERTIES), 'method': rng.choice(METHODS), 'country': rng.choice(COUNTRIES),
+              'years': rng.randint(2, 30), 'depth': rng.choice(['0-10', '0-20', '10-30']),
+              'season': rng.choice(['spring', 'summer', 'autumn']), 'verb': rng.choice(['increased', 'decreased']),
+              'percent': rng.randint(5, 80)}
+    values['actor_cap'] = values['actor'][0].upper() + values['actor'][1:]
+    sentences = TEMPLATES[:4] + rng.sample(TEMPLATES[4:], rng.randint(2, len(TEMPLATES) - 4))
+    return ' '.join(sentence.format(**values) for sentence in sentences)
+
+
+def make_corpus(n_abstracts, seed=0):
+    '''Return a dataframe with the columns id, title and abstract.'''
+    rng = random.Random(seed)
+    abstracts = [make_abstract(rng) for _ in range(n_abstracts)]
+    return pd.DataFrame({'id': [f'doc{i:07d}' for i in range(n_abstracts)],
+                         'title': [abstract.split('.')[0] for abstract in abstracts],
+                         'abstract': abstracts})
+
+
+def write_corpus(path, n_abstracts, seed=0):
+    df = make_corpus(n_abstracts, seed)
+    if path.endswith('.xlsx'):
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic corpus of abstracts (columns id, title and abstract)')
+    parser.add_argument('--n_abstracts', type=int, required=True, help='Number of abstracts')
+    parser.add_argument('--output_file', type=str, required=True, help='CSV or .xlsx file')
+    parser.add_argument('--seed', type=int, required=False, default=0, help='Seed of the random abstracts')
+    args = parser.parse_args()
+
+    write_corpus(args.output_file, args.n_abstracts, args.seed)
+    print(f'{args.n_abstracts} abstracts written to {args.output_file}')
@@ -0,0 +1,438 @@
+'''A local OpenAI-compatible server which answers the LEPAMTIC prompts with canned, schema-valid JSONL.
+
+The server recognizes every prompt of LEPAMTIC.py (prescreening, scoring, the pattern extraction chains,
+unification and the repair of invalid lines) and answers deterministically from a hash of the conversation
+(conjunction splitting splits the patterns of the previous answer), so runs can be compared. Latency, malformed answers and 429/5xx errors are drawn at random as configured.
+It supports plain and streamed chat completions, strict JSON schema structured outputs and the files and
+batches endpoints of the Batch API. GET /stats returns the counters of all requests answered so far.
+
+    python benchmarks/mock_server.py --port 8765 --latency lognormal:0.8,0.5 --rate_limit_rate 0.01
+'''
+import os
+import sys
+import re
+import ast
+import json
+import time
+import zlib
+import random
+import socket
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import LEPAMTIC as lepamtic
+
+
+PRACTICES = [('no tillage', 'Soil management', 'No tillage', 'conventional tillage', 'Conventional tillage'),
+             ('cover cropping', 'Crop management', 'Cover crops', 'bare fallow', 'Fallow'),
+             ('organic fertilization', 'Nutrient management', 'Organic fertilizer', 'mineral fertilization', 'Mineral fertilizer'),
+             ('crop rotation', 'Crop management', 'Crop rotation', 'monoculture', 'Monoculture'),
+             ('straw incorporation', 'Residue management', 'Residue retention', 'straw removal', 'Residue removal')]
+ACTORS = ['bacteria', 'fungi', 'arbuscular mycorrhizal fungi', 'nematodes', 'earthworms', 'microbial community']
+PROPERTIES = ['abundance', 'diversity', 'biomass', 'activity', 'community composition']
+EFFECTS = ['increase', 'decrease', 'no effect']
+METHODS = ['qPCR', 'PLFA analysis', 'amplicon sequencing', 'hand sorting', 'Shannon diversity index']
+COUNTRIES = ['Spain', 'Germany', 'China', 'Brazil', 'United States', 'Slovenia']
+
+PROMPT_KINDS = [('repair', lambda text: text.startswith('The following lines of your answer are not valid JSON objects')),
+                ('screen', lambda text: text.startswith(lepamtic.prescreen_prompt('')[:60])),
+                ('score_protocol', lambda text: text == lepamtic.score_protocol_prompt),
+                ('score', lambda text: text.startswith(lepamtic.score_prompt('')[:60])),
+                ('unify_actor', lambda text: text.startswith(lepamtic.unify_actors_prompt([], [])[:50])),
+                ('unify_property', lambda text: text.startswith(lepamtic.unify_property_prompt([], [])[:50])),
+                ('patterns', lambda text: text == lepamtic.prompt_export or text.startswith(lepamtic.prompt_intro + '\n')),
+                ('split_conjuncts', lambda text: text == lepamtic.prompt_split_conjuncts)]
+
+
+def parse_latency(value):
+    '''argparse type of --latency: fixed:S, uniform:A,B, normal:MEAN,SD or lognormal:MEDIAN,SIGMA (seconds).'''
+    name, _, params = value.partition(':')
+    try:
+        params = [float(p) for p in params.split(',')] if params else []
+    except ValueError:
+        params = None
+    n_params = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2}.get(name)
+    if n_params is None or params is None or len(params) != n_params:
+        raise argparse.ArgumentTypeError(f'"{value}" is not one of fixed:S, uniform:A,B, normal:MEAN,SD or lognormal:MEDIAN,SIGMA')
+    return name, params
+
+
+def draw_latency(latency, rng):
+    name, params = latency
+    if name == 'fixed':
+        return params[0]
+    if name == 'uniform':
+        return rng.uniform(*params)
+    if name == 'normal':
+        return max(0.0, rng.gauss(*params))
+    return params[0] * rng.lognormvariate(0, params[1])
+
+
+def message_text(message):
+    content = message.get('content') or ''
+    if isinstance(content, list):
+        content = ''.join(part.get('text', '') for part in content)
+    return content
+
+
+def prompt_kind(text):
+    for kind, matches in PROMPT_KINDS:
+        if matches(text):
+            return kind
+    return 'chat'
+
+
+def pick(options, seed, salt=0):
+    return options[(seed + salt * 7919) % len(options)]
+
+
+def make_pattern(seed, i, property=None, actor=None):
+    practice, category, unified, contrast, contrast_unified = pick(PRACTICES, seed, i)
+    property = property or pick(PROPERTIES, seed, i + 1)
+    actor = actor or pick(ACTORS, seed, i + 2)
+    effect = pick(EFFECTS, seed, i + 3)
+    return {'land_management_practice': practice,
+            'land_management_practice_category': category,
+            'land_management_practice_unified': unified,
+            'effect': effect,
+            'property': property,
+            'actor': actor,
+            'method_or_measurement': pick(METHODS, seed, i + 4),
+            'temporal_scope': 'NA',
+            'locational_scope': '0-20 cm soil depth',
+            'contrasting_land_management_practice': contrast,
+            'contrasting_land_management_practice_category': category,
+            'contrasting_land_management_practice_unified': contrast_unified,
+            'location_country': pick(COUNTRIES, seed, i + 5),
+            'study_type': 'field study',
+            'sentences': f'Compared to {contrast}, {practice} had an effect ({effect}) on the {property} of {actor}.',
+            'comment': 'NA'}
+
+
+def make_patterns(seed, split):
+    '''One to three patterns; before conjunction splitting the property of the first one may be a conjunction.'''
+    patterns = [make_pattern(seed, i) for i in range(1 + seed % 3)]
+    if seed % 2:
+        first, second = pick(PROPERTIES, seed, 1), pick(PROPERTIES, seed, 2)
+        if split:
+            patterns[:1] = [make_pattern(seed, 0, property=first), make_pattern(seed, 0, property=second)]
+        else:
+            patterns[0] = make_pattern(seed, 0, property=f'{first} and {second}')
+    return patterns
+
+
+def split_answer(answer):
+    '''The patterns of an exported answer with the conjunctions in property and actor split or None if it cannot be read.'''
+    try:
+        rows = [json.loads(line) for line in answer.splitlines() if line.strip().startswith('{')]
+    except json.JSONDecodeError:
+        return None
+    if len(rows) == 1 and isinstance(rows[0].get('items'), list):
+        rows = rows[0]['items']
+    conjunction = re.compile(r' and | or ')
+    return [dict(row, property=property, actor=actor) for row in rows
+            for property in conjunction.split(str(row.get('property')))
+            for actor in conjunction.split(str(row.get('actor')))] or None
+
+
+def input_data(text, label):
+    '''The Python literal after `label` in a unification prompt or None if it cannot be read.'''
+    for line in text.splitlines():
+        if line.startswith(label):
+            try:
+                return ast.literal_eval(line[len(label):].strip())
+            except (ValueError, SyntaxError):
+                return None
+    return None
+
+
+def canned_row(fields, seed, i=0):
+    '''A valid object with the fields of a repair prompt.'''
+    if fields[0] == 'relevance':
+        return {'relevance': 1, 'comment': 'Repaired.'}
+    if fields[0] == 'score':
+        return {'score': 3, 'score_explanation': 'Repaired.'}
+    if fields[0] in ('actor', 'property'):
+        return {fields[0]: 'NA', f'{fields[0]}_unified': 'NA'}
+    return make_pattern(seed, i)
+
+
+def answer_rows(kind, text, seed, relevant_fraction, previous=''):
+    '''The rows of the answer to a parsed prompt (previous is the last answer of the conversation) or None if the answer is free text.'''
+    if kind == 'screen':
+        relevant = (zlib.crc32(text.encode('utf-8')) % 1000) < relevant_fraction * 1000
+        return [{'relevance': int(relevant), 'comment': 'The abstract reports a practice, an effect, a property and an actor.' if relevant else 'No soil biota effect is reported.'}]
+    if kind == 'score':
+        return [{'score': (seed % 11) / 2, 'score_explanation': 'Deductions for a missing contrast and an unclear measurement method.'}]
+    if kind == 'split_conjuncts':
+        return split_answer(previous) or make_patterns(seed, split=True)
+    if kind == 'patterns':
+        return make_patterns(seed, split=False)
+    if kind in ('unify_actor', 'unify_property'):
+        field = kind.split('_')[1]
+        items = input_data(text, 'Extracted items:')
+        if items is None:  # e.g., a nan in the sentences, one answer per item is enough
+            items = [{field: 'NA'}] * text.count(f"'{field}':")
+        unified = input_data(text, 'Unified categories:') or ['NA']
+        return [{field: item[field], f'{field}_unified': pick(unified, zlib.crc32(str(item[field]).encode('utf-8')))} for item in items]
+    if kind == 'repair':
+        fields_line = text.splitlines()[0]
+        if ' with all of the fields ' not in fields_line:
+            return [{}]
+        fields = fields_line.split(' with all of the fields ')[1].rstrip(':').split(', ')
+        n_invalid = len(text.split('\n\n')[1].splitlines())
+        return [canned_row(fields, seed, i) for i in range(n_invalid)]
+    return None
+
+
+def corrupt(content, rng):
+    '''Cut a random line of the answer in the middle (an unterminated JSON object).'''
+    lines = content.splitlines()
+    i = rng.randrange(len(lines))
+    lines[i] = lines[i][:max(1, len(lines[i]) // 2)]
+    return '\n'.join(lines)
+
+
+class MockLLM:
+    '''The answers, the random failures and the statistics of the server.'''
+    def __init__(self, latency=('fixed', [0.0]), malformed_rate=0.0, rate_limit_rate=0.0, server_error_rate=0.0,
+                 relevant_fraction=0.7, chunk_delay=0.0, retry_after_ms=100, seed=0):
+        self.latency = latency
+        self.malformed_rate = malformed_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.relevant_fraction = relevant_fraction
+        self.chunk_delay = chunk_delay
+        self.retry_after_ms = retry_after_ms
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.stats = {'requests': 0, 'completions': 0, 'batch_requests': 0, 'rate_limited': 0, 'server_errors': 0,
+                      'malformed': 0, 'streamed': 0, 'latency_seconds': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                      'kinds': {}}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def draw(self, function, *args):
+        with self.lock:
+            return function(*args)
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def failure(self):
+        '''HTTP status of an injected error or None.'''
+        draw = self.draw(self.rng.random)
+        if draw < self.rate_limit_rate:
+            self.count('rate_limited')
+            return 429
+        if draw < self.rate_limit_rate + self.server_error_rate:
+            self.count('server_errors')
+            return self.draw(self.rng.choice, [500, 503])
+        return None
+
+    def completion(self, body):
+        '''Return (content, usage) of the answer to a chat completion request.'''
+        messages = body.get('messages', [])
+        texts = [message_text(message) for message in messages]
+        last = texts[-1] if texts else ''
+        kind = prompt_kind(last)
+        seed = zlib.crc32('\n'.join(text for message, text in zip(messages, texts) if message.get('role') == 'user').encode('utf-8'))
+        with self.lock:
+            self.stats['kinds'][kind] = self.stats['kinds'].get(kind, 0) + 1
+
+        previous = next((text for message, text in zip(messages[::-1], texts[::-1]) if message.get('role') == 'assistant'), '')
+        rows = answer_rows(kind, last, seed, self.relevant_fraction, previous)
+        if rows is None:
+            content = 'OK.'
+        elif (body.get('response_format') or {}).get('type') == 'json_schema':
+            content = json.dumps({'items': rows})
+        else:
+            content = '\n'.join(json.dumps(row) for row in rows)
+        if rows and kind != 'repair' and self.draw(self.rng.random) < self.malformed_rate:
+            self.count('malformed')
+            content = corrupt(content, self.rng)
+
+        # prompt caching: everything before the last message is a cached prefix
+        prompt_tokens = sum(len(text) for text in texts) // 4 + 4 * len(texts)
+        prefix_tokens = prompt_tokens - len(last) // 4 - 4
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4 + 1,
+                 'total_tokens': prompt_tokens + len(content) // 4 + 1,
+                 'prompt_tokens_details': {'cached_tokens': prefix_tokens // 128 * 128 if prefix_tokens >= 1024 else 0}}
+        self.count('prompt_tokens', usage['prompt_tokens'])
+        self.count('completion_tokens', usage['completion_tokens'])
+        return content, usage
+
+    def upload(self, raw):
+        '''Store the JSONL lines of a multipart file upload and return the file id.'''
+        lines = [line for line in raw.decode('utf-8').splitlines() if line.startswith('{')]
+        with self.lock:
+            file_id = f'file-{len(self.files)}'
+            self.files[file_id] = '\n'.join(lines)
+        return file_id
+
+    def create_batch(self, input_file_id):
+        '''Answer all requests of the batch at once; the batch is reported completed at the second poll.'''
+        output = []
+        for line in self.files[input_file_id].splitlines():
+            request = json.loads(line)
+            content, usage = self.completion(request['body'])
+            for key in ('requests', 'completions', 'batch_requests'):
+                self.count(key)
+            output.append(json.dumps({'id': f'response-{request["custom_id"]}', 'custom_id': request['custom_id'], 'error': None,
+                                      'response': {'status_code': 200, 'body': completion_response(request['body'], content, usage)}}))
+        with self.lock:
+            output_id = f'file-{len(self.files)}'
+            self.files[output_id] = '\n'.join(output)
+            batch_id = f'batch-{len(self.batches)}'
+            self.batches[batch_id] = {'input': input_file_id, 'output': output_id, 'polls': 0, 'total': len(output)}
+        return batch_id
+
+    def batch_object(self, batch_id, poll=True):
+        batch = self.batches[batch_id]
+        with self.lock:
+            batch['polls'] += poll
+            done = batch['polls'] > 1
+        return {'id': batch_id, 'object': 'batch', 'endpoint': '/v1/chat/completions', 'input_file_id': batch['input'],
+                'completion_window': '24h', 'status': 'completed' if done else 'in_progress', 'created_at': int(time.time()),
+                'output_file_id': batch['output'] if done else None,
+                'request_counts': {'total': batch['total'], 'completed': batch['total'] if done else 0, 'failed': 0}}
+
+
+def completion_response(body, content, usage):
+    return {'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model', 'mock'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    llm = None
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, without this small answers wait for delayed ACKs
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj, status=200, headers=None):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[-1] == 'stats':
+            self.send_json(self.llm.snapshot())
+        elif len(parts) >= 3 and parts[1] == 'batches' and parts[2] in self.llm.batches:
+            self.send_json(self.llm.batch_object(parts[2]))
+        elif len(parts) >= 3 and parts[1] == 'files' and parts[2] in self.llm.files:
+            data = self.llm.files[parts[2]].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json({'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}}, status=404)
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/files'):
+            file_id = self.llm.upload(raw)
+            self.send_json({'id': file_id, 'object': 'file', 'bytes': len(raw), 'created_at': int(time.time()),
+                            'filename': f'{file_id}.jsonl', 'purpose': 'batch', 'status': 'processed'})
+        elif self.path.endswith('/batches'):
+            batch_id = self.llm.create_batch(json.loads(raw)['input_file_id'])
+            self.send_json(dict(self.llm.batch_object(batch_id, poll=False), status='validating'))
+        elif self.path.endswith('/chat/completions'):
+            self.chat_completion(json.loads(raw))
+        else:
+            self.send_json({'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}}, status=404)
+
+    def chat_completion(self, body):
+        self.llm.count('requests')
+        status = self.llm.failure()
+        if status is not None:
+            headers = {'retry-after-ms': str(self.llm.retry_after_ms)} if status == 429 else {}
+            self.send_json({'error': {'message': f'Injected error {status}', 'type': 'mock_error', 'code': status}}, status=status, headers=headers)
+            return
+
+        latency = self.llm.draw(draw_latency, self.llm.latency, self.llm.rng)
+        self.llm.count('latency_seconds', latency)
+        time.sleep(latency)
+        content, usage = self.llm.completion(body)
+        self.llm.count('completions')
+        if not body.get('stream'):
+            self.send_json(completion_response(body, content, usage))
+            return
+
+        self.llm.count('streamed')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        base = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body.get('model', 'mock')}
+        events = [dict(base, choices=[{'index': 0, 'delta': {'content': content[i:i+40]}, 'finish_reason': None}]) for i in range(0, len(content), 40)]
+        events.append(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        events.append(dict(base, choices=[], usage=usage))
+        try:
+            for event in events:
+                self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(self.llm.chunk_delay)
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client aborted the generation
+
+
+def make_server(port=0, **config):
+    '''Return a server on 127.0.0.1 (port 0 picks a free port, see server.server_port) answering with MockLLM(**config).'''
+    handler = type('MockHandler', (Handler,), {'llm': MockLLM(**config)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def add_server_args(parser):
+    parser.add_argument('--latency', type=parse_latency, required=False, default='fixed:0', help='Latency of every answer in seconds: fixed:S, uniform:A,B, normal:MEAN,SD or lognormal:MEDIAN,SIGMA (default: fixed:0)')
+    parser.add_argument('--malformed_rate', type=float, required=False, default=0, help='Fraction of parsed answers with an invalid JSONL line')
+    parser.add_argument('--rate_limit_rate', type=float, required=False, default=0, help='Fraction of requests answered with 429 Too Many Requests')
+    parser.add_argument('--server_error_rate', type=float, required=False, default=0, help='Fraction of requests answered with 500 or 503')
+    parser.add_argument('--relevant_fraction', type=float, required=False, default=0.7, help='Fraction of abstracts screened as relevant')
+    parser.add_argument('--chunk_delay', type=float, required=False, default=0, help='Seconds between the chunks of a streamed answer')
+    parser.add_argument('--retry_after_ms', type=int, required=False, default=100, help='retry-after-ms header of 429 answers')
+    parser.add_argument('--seed', type=int, required=False, default=0, help='Seed of the random latencies and failures')
+
+
+def server_config(args):
+    return {name: getattr(args, name) for name in ('latency', 'malformed_rate', 'rate_limit_rate', 'server_error_rate',
+                                                   'relevant_fraction', 'chunk_delay', 'retry_after_ms', 'seed')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OpenAI-compatible server with canned LEPAMTIC answers')
+    parser.add_argument('--port', type=int, required=False, default=8765, help='Port on 127.0.0.1')
+    add_server_args(parser)
+    args = parser.parse_args()
+
+    server = make_server(args.port, **server_config(args))
+    print(f'Mock LLM server on http://127.0.0.1:{server.server_port}/v1 (use any model name which is not a gpt/o*/gemini model)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
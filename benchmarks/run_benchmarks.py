@@ -0,0 +1,171 @@
+'''Benchmark the screen, score and extract modes of extractor.py against the local mock LLM server.
+
+For every corpus size and mode extractor.py runs as a separate process against benchmarks/mock_server.py
+(started in this process). Reported are the throughput (abstracts per second of wall time), the CPU time
+of the extractor process per abstract (the overhead of the client itself, which does not include waiting
+for the server), its peak memory and the growth of the peak memory with the corpus size. Results are
+written to a JSON file which can be passed as --baseline to a later run to flag regressions.
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 --output_dir bench_runs --results_file bench_runs/results.json
+'''
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import platform
+import threading
+import subprocess
+
+from mock_server import make_server, add_server_args, server_config
+from make_corpus import write_corpus
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ['screen', 'score', 'extract']
+# result field -> True if larger is better
+COMPARED = {'abstracts_per_second': True, 'cpu_ms_per_abstract': False, 'peak_rss_mb': False}
+
+
+def extractor_command(mode, corpus_fn, run_dir, base_url, args):
+    command = [sys.executable, os.path.join(REPO_DIR, 'extractor.py'), mode,
+               '--input_file', corpus_fn, '--output_dir', run_dir, '--primary_key', 'id', '--abstract_column', 'abstract',
+               '--base_url', base_url]
+    if mode == 'screen':
+        command += ['--model_name', args.model_name]
+    elif mode == 'score':
+        command += ['--scoring_model_name', args.model_name]
+    else:
+        command += ['--model_name', args.model_name, '--scoring_model_name', args.model_name,
+                    '--actor_file', os.path.join(REPO_DIR, 'data', 'LLM_actors_list.csv'), '--workers', str(args.workers)]
+    return command + shlex.split(args.extractor_args)
+
+
+def peak_rss_mb(rusage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rusage.ru_maxrss / (1024**2 if platform.system() == 'Darwin' else 1024)
+
+
+def run_one(mode, n_abstracts, corpus_fn, server, args):
+    '''Run extractor.py once and return the measurements.'''
+    run_dir = os.path.join(args.output_dir, f'{mode}_{n_abstracts}')
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    command = extractor_command(mode, corpus_fn, run_dir, f'http://127.0.0.1:{server.server_port}/v1', args)
+
+    llm = server.RequestHandlerClass.llm
+    before = llm.snapshot()
+    started = time.perf_counter()
+    with open(os.path.join(run_dir, 'extractor.log'), 'w') as log:
+        process = subprocess.Popen(command, cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - started
+    after = llm.snapshot()
+
+    cpu = rusage.ru_utime + rusage.ru_stime
+    result = {'mode': mode, 'n_abstracts': n_abstracts, 'returncode': process.returncode,
+              'wall_seconds': round(wall, 3),
+              'abstracts_per_second': round(n_abstracts / wall, 2),
+              'cpu_seconds': round(cpu, 3),
+              'cpu_ms_per_abstract': round(1000 * cpu / n_abstracts, 3),
+              'peak_rss_mb': round(peak_rss_mb(rusage), 1)}
+    for key in ('requests', 'completions', 'rate_limited', 'server_errors', 'malformed', 'latency_seconds', 'prompt_tokens', 'completion_tokens'):
+        result[key] = round(after[key] - before[key], 3)
+    result['requests_per_abstract'] = round(result['requests'] / n_abstracts, 2)
+    return result
+
+
+def memory_growth(results):
+    '''Growth of the peak memory in MB per 1000 abstracts between the smallest and the largest corpus of every mode.'''
+    growth = {}
+    for mode in MODES:
+        runs = sorted((result['n_abstracts'], result['peak_rss_mb']) for result in results if result['mode'] == mode and result['returncode'] == 0)
+        if len(runs) > 1 and runs[-1][0] > runs[0][0]:
+            growth[mode] = round(1000 * (runs[-1][1] - runs[0][1]) / (runs[-1][0] - runs[0][0]), 3)
+    return growth
+
+
+def regressions(results, baseline, tolerance):
+    '''Return a list of messages for the results which are worse than the baseline by more than tolerance (a fraction).'''
+    previous = {(result['mode'], result['n_abstracts']): result for result in baseline['results']}
+    messages = []
+    for result in results:
+        old = previous.get((result['mode'], result['n_abstracts']))
+        if old is None or result['returncode'] != 0:
+            continue
+        for field, larger_is_better in COMPARED.items():
+            if not old[field]:
+                continue
+            change = (result[field] - old[field]) / old[field]
+            if (-change if larger_is_better else change) > tolerance:
+                messages.append(f"{result['mode']} {result['n_abstracts']}: {field} {old[field]} -> {result[field]} ({change:+.0%})")
+    return messages
+
+
+def print_report(results, growth):
+    print(f"{'mode':<8} {'abstracts':>9} {'wall s':>8} {'abs/s':>8} {'cpu ms/abs':>10} {'peak MB':>8} {'req/abs':>7} {'429':>5} {'5xx':>5} {'malf.':>5}")
+    for r in results:
+        status = '' if r['returncode'] == 0 else f"  FAILED (exit code {r['returncode']})"
+        print(f"{r['mode']:<8} {r['n_abstracts']:>9} {r['wall_seconds']:>8.1f} {r['abstracts_per_second']:>8.1f} {r['cpu_ms_per_abstract']:>10.2f} "
+              f"{r['peak_rss_mb']:>8.1f} {r['requests_per_abstract']:>7.2f} {r['rate_limited']:>5} {r['server_errors']:>5} {r['malformed']:>5}{status}")
+    for mode, mb in growth.items():
+        print(f'{mode}: peak memory grows by {mb:.2f} MB per 1000 abstracts')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark extractor.py against the local mock LLM server')
+    parser.add_argument('--sizes', type=int, nargs='+', required=False, default=[1000, 10000], help='Numbers of abstracts of the synthetic corpora')
+    parser.add_argument('--modes', type=str, nargs='+', required=False, choices=MODES, default=MODES, help='Modes of extractor.py to run')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory of the corpora and of the outputs of the runs')
+    parser.add_argument('--workers', type=int, required=False, default=8, help='--workers of the extract mode')
+    parser.add_argument('--model_name', type=str, required=False, default='mock', help='Model name sent to the server')
+    parser.add_argument('--extractor_args', type=str, required=False, default='', help='Additional arguments of extractor.py, e.g., "--chain compact --stream"')
+    parser.add_argument('--results_file', type=str, required=False, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, required=False, help='Results file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, required=False, default=0.2, help='Relative change of throughput, CPU time or memory reported as a regression')
+    add_server_args(parser)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    args.output_dir = os.path.abspath(args.output_dir)
+    server = make_server(0, **server_config(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        for n_abstracts in sorted(args.sizes):
+            corpus_fn = os.path.join(args.output_dir, f'corpus_{n_abstracts}.csv')
+            if not os.path.exists(corpus_fn):
+                write_corpus(corpus_fn, n_abstracts)
+            for mode in args.modes:
+                print(f'Running {mode} on {n_abstracts} abstracts ...', flush=True)
+                result = run_one(mode, n_abstracts, corpus_fn, server, args)
+                if result['returncode'] != 0:
+                    print(f"Error: extractor.py exited with code {result['returncode']}, see {os.path.join(args.output_dir, f'{mode}_{n_abstracts}', 'extractor.log')}")
+                results.append(result)
+    finally:
+        server.shutdown()
+
+    growth = memory_growth(results)
+    print_report(results, growth)
+    config = {name: value for name, value in vars(args).items() if name not in ('baseline', 'results_file')}
+    if args.results_file:
+        with open(args.results_file, 'w') as fp:
+            json.dump({'config': config, 'python': platform.python_version(), 'results': results, 'memory_growth_mb_per_1000': growth}, fp, indent=2)
+
+    failed = any(result['returncode'] != 0 for result in results)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            found = regressions(results, json.load(fp), args.tolerance)
+        if found:
+            print(f'{len(found)} regression(s) against {args.baseline} (tolerance {args.tolerance:.0%}):')
+            for message in found:
+                print(f'  {message}')
+            failed = True
+        else:
+            print(f'No regressions against {args.baseline}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,161 @@
+import os
+import gzip
+import json
+import hashlib
+import threading
+import logging
+
+import httpx
+from openai import APIError
+
+from metrics import call_tags
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+
+class CassetteMiss(APIError):
+    '''A call of a replayed run which was not recorded in the cassette.
+
+    It is an APIError, so the abstract is given up like after a failed API call (see extractor.repeat_on_error()).
+    '''
+    def __init__(self, path, call, reason):
+        super().__init__(f'No recorded answer in "{path}" for call {call}: {reason}',
+                         httpx.Request('POST', 'replay://chat/completions'), body=None)
+
+
+def call_id(tags=None):
+    '''Identity of a call in a run: primary key, stage, turn, attempt and repair call (see metrics.tagged()).'''
+    tags = call_tags() if tags is None else tags
+    return f"{tags.get('pk')}|{tags.get('stage')}|{tags.get('turn')}|{tags.get('attempt', 0)}|{tags.get('repair', 0)}"
+
+
+class Cassette:
+    '''Records the answers of all LLM calls of a run to a compact JSONL file or serves them offline.
+
+    In the 'record' mode one line is appended for every answer with the identity of the call (see call_id(),
+    e.g., the primary key, the stage and the turn), a hash of the conversation up to the question (model,
+    messages and call parameters, but not the base URL), the answer text and the token usage; the prompts
+    themselves are not stored. In the 'replay' mode the recorded answers are returned for the same calls
+    without any network access. An answer is only served to a call with the same identity and the same hash,
+    so identical conversations of different abstracts (or stages) never take each other's answers, whatever
+    the order of the calls. When the same call was made several times (e.g., a stage repeated after an error)
+    its answers are served in the recorded order. A call which was not recorded, whose messages differ from
+    the recorded ones or whose answers are used up raises CassetteMiss. Files ending with .gz are compressed.
+    One instance can be shared by all dialogs (and threads) of a process.
+    '''
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode "{mode}"')
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.served = 0
+        self.missed = 0
+        self.recorded = 0
+        self.answers = {}
+        self.positions = {}
+        self.calls = set()
+        self.fp = None
+        if self.replaying:
+            self.load()
+        else:
+            self.fp = gzip.open(path, 'at', encoding='utf-8') if path.endswith('.gz') else open(path, 'a', encoding='utf-8')
+
+    def __reduce__(self):
+        # dialogs are pickled with ChatDialog.save(); the loaded dialog gets the shared cassette of this process
+        return get_cassette, (self.path, self.mode)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    @staticmethod
+    def key(model, messages, kwargs):
+        data = json.dumps([model, messages, kwargs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+    def load(self):
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'rt', encoding='utf-8') as fp:
+            for n, line in enumerate(fp, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f'{self.path}: line {n} is not valid JSON (interrupted recording?), ignored')
+                    continue
+                if 'call' not in entry:
+                    logger.warning(f'{self.path}: line {n} has no call identity (recorded by an older version), ignored')
+                    continue
+                self.answers.setdefault((entry['call'], entry['key']), []).append((entry['answer'], entry.get('usage')))
+                self.calls.add(entry['call'])
+        logger.info(f'Cassette: {sum(map(len, self.answers.values()))} answer(s) of {len(self.calls)} call(s) loaded from {self.path}')
+
+    def record(self, model, messages, kwargs, response, call=None):
+        '''Append the answer (a dict in the chat completion format) to the question at the end of messages.
+
+        call is the identity of the call (by default call_id() of the current tags).
+        '''
+        answer = response['choices'][0]['message']['content']
+        usage = response.get('usage') or {}
+        details = usage.get('prompt_tokens_details') or {}
+        entry = {'call': call or call_id(), 'key': self.key(model, messages, kwargs), 'answer': answer,
+                 'usage': [usage.get('prompt_tokens') or 0, details.get('cached_tokens') or 0, usage.get('completion_tokens') or 0]}
+        with self.lock:
+            self.fp.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.fp.flush()
+            self.recorded += 1
+
+    def get(self, model, messages, kwargs, call=None):
+        '''Return the recorded answer to the question at the end of messages (in the chat completion format).
+
+        call is the identity of the call (by default call_id() of the current tags). Raises CassetteMiss
+        if there is no recorded answer for the call and the messages.
+        '''
+        call = call or call_id()
+        key = self.key(model, messages, kwargs)
+        with self.lock:
+            answers = self.answers.get((call, key), [])
+            position = self.positions.get((call, key), 0)
+            if position >= len(answers):
+                self.missed += 1
+                if call not in self.calls:
+                    reason = 'the call was not recorded'
+                elif answers:
+                    reason = f'all {len(answers)} recorded answer(s) were used'
+                else:
+                    reason = 'its messages or parameters differ from the recorded ones'
+                raise CassetteMiss(self.path, call, reason)
+            self.positions[call, key] = position + 1
+            self.served += 1
+        answer, usage = answers[position]
+        prompt_tokens, cached_tokens, completion_tokens = usage or (0, 0, 0)
+        return {'id': f'replay-{key}', 'object': 'chat.completion', 'created': 0, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                          'total_tokens': prompt_tokens + completion_tokens,
+                          'prompt_tokens_details': {'cached_tokens': cached_tokens}}}
+
+    def stats(self):
+        if self.replaying:
+            return f'Cassette: {self.served} answer(s) replayed, {self.missed} not recorded, from {self.path}'
+        return f'Cassette: {self.recorded} answer(s) recorded to {self.path}'
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+def get_cassette(path, mode):
+    '''Return the cassette shared by all dialogs of the process which use path.'''
+    path = os.path.abspath(path)
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path, mode)
+        return _cassettes[path]
@@ -5,12 +5,18 @@ import logging
 import pickle
 import argparse
 import time
+import asyncio
 import json
 import base64
+import random
 import mimetypes
 import logging
 
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, APIError, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from openai.types.chat import ChatCompletion
+
+from rate_limiter import estimate_tokens
 
 logger = logging.getLogger(f"lepamtic.{__name__}")
 
@@ -25,7 +31,98 @@ def image_to_base64(image_path):
     return image_base64
 
 
+# errors of the openai client after which a call is repeated
+TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+class ContextTooLong(APIError):
+    '''The messages of a call are longer than ChatDialog.max_context_tokens (estimated with rate_limiter.estimate_tokens()).
+
+    It is raised before the call is made and, like the provider's context length error, it is an APIError.
+    '''
+    def __init__(self, model, n_tokens, max_tokens):
+        super().__init__(f'The messages for {model} have about {n_tokens} tokens, more than the context limit of {max_tokens} tokens',
+                         httpx.Request('POST', 'context://chat/completions'), body=None)
+
+
+class LineAssembler:
+    '''Collects the text of a streamed answer and calls on_line(line) for every line as soon as it is complete.
+
+    on_line may raise an exception to abort the generation.
+    '''
+    def __init__(self, on_line=None):
+        self.on_line = on_line
+        self.parts = []
+        self.pending = ''
+
+    def feed(self, delta):
+        self.parts.append(delta)
+        *complete, self.pending = (self.pending + delta).split('\n')
+        if self.on_line is not None:
+            for line in complete:
+                self.on_line(line)
+
+    def finish(self):
+        if self.pending and self.on_line is not None:
+            self.on_line(self.pending)
+        self.pending = ''
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+
+def feed_lines(text, on_line):
+    '''Call on_line for every line of text (see LineAssembler).'''
+    lines = LineAssembler(on_line)
+    lines.feed(text)
+    lines.finish()
+
+
+def completion_from_chunks(chunks, content, model):
+    '''Assemble a ChatCompletion (as returned without streaming) from the chunks of a streamed response.'''
+    first = chunks[0] if chunks else None
+    finish_reason = next((c.choices[0].finish_reason for c in reversed(chunks) if c.choices and c.choices[0].finish_reason), 'stop')
+    usage = next((c.usage for c in reversed(chunks) if c.usage), None)
+    return ChatCompletion.model_validate({'id': first.id if first else '',
+                                          'object': 'chat.completion',
+                                          'created': first.created if first else 0,
+                                          'model': first.model if first else model,
+                                          'choices': [{'index': 0,
+                                                       'message': {'role': 'assistant', 'content': content},
+                                                       'finish_reason': finish_reason}],
+                                          'usage': usage.model_dump() if usage else None})
+
+
 class ChatDialog:
+    # number of times a call is repeated after each class of transient errors
+    max_retries = {'RateLimitError': 5, 'APITimeoutError': 3, 'APIConnectionError': 3, 'InternalServerError': 3}
+    # exponential backoff between repeated calls: up to backoff_base * 2**(n-1) seconds (with full jitter), at most backoff_max
+    backoff_base = 1
+    backoff_max = 60
+    # number of times a turn with an invalid answer is asked again (see LEPAMTIC.ask_JSONL())
+    turn_retries = 0
+    # cache key of the last call (see forget_responses())
+    last_cache_key = None
+    # receive answers as streams (see ask())
+    stream = False
+    # request JSONL answers as strict JSON schema structured outputs (see LEPAMTIC.ask_JSONL())
+    structured_outputs = False
+    # number of times invalid lines of a JSONL answer are asked for again (see LEPAMTIC.ask_JSONL())
+    salvage_attempts = 0
+    # per-call metrics (see metrics.CallMetrics) and the failed attempts and rate limiter waits of the last call
+    metrics = None
+    last_attempts = {}
+    last_wait = 0
+    # records all answers or replays recorded ones without calling the API (see cassette.Cassette)
+    cassette = None
+    # context policy (see fit_context()): approximate limit of the prompt tokens of a call (None: no limit) and what
+    # to do when it is exceeded, 'fail' before the call or 'drop' the oldest exchanges
+    max_context_tokens = None
+    context_overflow = 'fail'
+    # send only the exported patterns with the conjunction splitting turn of the prompt chains (see LEPAMTIC.trim_for_split())
+    trim_context = False
+
     def __init__(self, 
                  api_key,
                  organization=None,
@@ -34,7 +131,19 @@ class ChatDialog:
                  role='You act as a helpful assistant.',
                  as_json=False,
                  call_wait_time=0.05,
-                 reset_for_each_call=False):
+                 reset_for_each_call=False,
+                 rate_limiter=None,
+                 cache=None,
+                 structured_outputs=False,
+                 salvage_attempts=0,
+                 turn_retries=0,
+                 max_retries=None,
+                 stream=False,
+                 metrics=None,
+                 cassette=None,
+                 max_context_tokens=None,
+                 context_overflow='fail',
+                 trim_context=False):
         self.base_url = base_url
         self.organization = organization
         self.api_key = api_key
@@ -47,6 +156,22 @@ class ChatDialog:
         self.reset_for_each_call = reset_for_each_call
         self.last_api_event_timestamp = None
         self.call_wait_time = call_wait_time
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.structured_outputs = structured_outputs
+        self.salvage_attempts = salvage_attempts
+        self.turn_retries = turn_retries
+        self.stream = stream
+        self.metrics = metrics
+        self.cassette = cassette
+        if context_overflow not in ('fail', 'drop'):
+            raise ValueError(f'Unknown context_overflow "{context_overflow}" (use "fail" or "drop")')
+        self.max_context_tokens = max_context_tokens
+        self.context_overflow = context_overflow
+        self.trim_context = trim_context
+        self.max_retries = dict(self.max_retries, **(max_retries or {}))
+        # tokens used by the API calls of this dialog (responses from the cache are not counted)
+        self.usage = {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
 
         self.messages = []
         if self.role:
@@ -54,9 +179,11 @@ class ChatDialog:
         self.client = self.create_client()
 
     def create_client(self):
+        # retries are done by create_completion()
         return OpenAI(api_key=self.api_key,
                       base_url=self.base_url,
-                      organization=self.organization)
+                      organization=self.organization,
+                      max_retries=0)
     
     @classmethod
     def load(klas, pickle_file):
@@ -67,18 +194,20 @@ class ChatDialog:
 
     def save(self, pickle_file):
         self.client = None  # this will avoid pickling _thread.RLock' object
-        with open(pickle_file, 'wb') as fp:
-            pickle.dump(self, fp)
-        self.client = self.create_client()
+        try:
+            with open(pickle_file, 'wb') as fp:
+                pickle.dump(self, fp)
+        finally:
+            self.client = self.create_client()
 
     def enforce_limits(self):
         if not self.last_api_event_timestamp:
             return
-        else:
-            while (time.time() - self.last_api_event_timestamp) < self.call_wait_time:
-                time.sleep(0.5)
+        remaining = self.call_wait_time - (time.time() - self.last_api_event_timestamp)
+        if remaining > 0:
+            time.sleep(remaining)
 
-    def analyze_image(self, impath, prompt, model='gpt-4-vision-preview', max_tokens=300):
+    def image_messages(self, impath, prompt):
         imgb64 = image_to_base64(impath)
         if self.as_json:
             messages = [{"role": "system", "content": self.role}]
@@ -96,9 +225,12 @@ class ChatDialog:
                              }
                          ]
                         })
+        return messages
+
+    def analyze_image(self, impath, prompt, model='gpt-4-vision-preview', max_tokens=300):
         response = self.client.chat.completions.create(
             model=model,
-            messages=messages,
+            messages=self.image_messages(impath, prompt),
             max_tokens=max_tokens,
         )
         
@@ -106,12 +238,60 @@ class ChatDialog:
         return json.loads(result) if self.as_json else result
 
     
-    def ask(self, question, print_answer=False, **kwargs):
-        self.enforce_limits()            
+    def prepare_call(self, question, kwargs):
+        '''Add the question to the dialog and return the keyword arguments for the API call.
+
+        The dialog is not changed if the question does not fit the context (see fit_context()).
+        '''
         if self.reset_for_each_call:
             self.reset()
-            
-        self.messages.append({"role": "user", "content": question})
+
+        self.messages = self.fit_context(self.messages + [{"role": "user", "content": question}])
+        kwargs = self.call_kwargs(kwargs)
+        logger.debug(f'API call: model: {self.model}, kwargs: {kwargs}')
+        return kwargs
+
+    @staticmethod
+    def last_turns(messages, keep_turns):
+        '''Return the system messages and the last keep_turns exchanges (a question and its answer) of messages.'''
+        n_system = next((i for i, message in enumerate(messages) if message['role'] != 'system'), len(messages))
+        starts = [i for i in range(n_system, len(messages)) if messages[i]['role'] == 'user']
+        if keep_turns >= len(starts):
+            return messages
+        kept = messages[starts[len(starts) - keep_turns]:] if keep_turns > 0 else []
+        return messages[:n_system] + kept
+
+    def drop_turns(self, keep_turns):
+        '''Remove all but the last keep_turns exchanges (a question and its answer) from the dialog; system messages are kept.'''
+        self.messages = self.last_turns(self.messages, keep_turns)
+
+    def fit_context(self, messages):
+        '''Apply the context policy to the messages of the next call (the question is the last message) and return them.
+
+        If the estimated number of tokens is above max_context_tokens, the oldest exchanges are dropped
+        (only with context_overflow='drop') until the messages fit. ContextTooLong is raised if they do
+        not fit; the dialog is left as it was, so the call fails before anything is sent or changed.
+        '''
+        if self.max_context_tokens is None:
+            return messages
+        n_tokens = estimate_tokens(messages)
+        if n_tokens <= self.max_context_tokens:
+            return messages
+        if self.context_overflow == 'drop':
+            n_turns = sum(message['role'] == 'user' for message in messages)
+            fitted = messages
+            while n_tokens > self.max_context_tokens and n_turns > 1:
+                n_turns -= 1
+                fitted = self.last_turns(messages, n_turns)
+                n_tokens = estimate_tokens(fitted)
+            if n_tokens <= self.max_context_tokens:
+                logger.debug(f'Context: {n_turns - 1} earlier exchange(s) kept, about {n_tokens} tokens')
+                return fitted
+        raise ContextTooLong(self.model, n_tokens, self.max_context_tokens)
+
+    def call_kwargs(self, kwargs):
+        '''Adapt the keyword arguments of a call to the model and the provider.'''
+        kwargs = dict(kwargs)
         if self.as_json:
             kwargs['response_format']= {"type": "json_object"}
 
@@ -126,14 +306,46 @@ class ChatDialog:
             del kwargs['reasoning_effort']
         if 'openai' in self.base_url and 'verbosity' in kwargs and not self.model.startswith('gpt-5'):
             del kwargs['verbosity']
+        return kwargs
 
-        logger.debug(f'API call: model: {self.model}, kwargs: {kwargs}')
+    def initial_messages(self):
+        '''Messages at the start of a conversation (the system role, if any).'''
+        return [{"role": "system", "content": self.role}] if self.role else []
 
-        response = self.client.chat.completions.create(model=self.model,
-                                                       messages=self.messages,
-                                                       **kwargs)
-        self.last_api_event_timestamp = time.time()
-        
+    def cache_key(self, kwargs):
+        return self.cache.key(self.base_url, self.model, self.messages, kwargs) if self.cache is not None else None
+
+    def cached_response(self, key):
+        if key is None:
+            return None
+        response = self.cache.get(key)
+        return ChatCompletion.model_validate(response) if response is not None else None
+
+    def replayed_response(self, kwargs):
+        '''Return the recorded answer to the current messages if the cassette is replayed, otherwise None.
+
+        Calls which were not recorded raise cassette.CassetteMiss.
+        '''
+        if self.cassette is None or not self.cassette.replaying:
+            return None
+        return ChatCompletion.model_validate(self.cassette.get(self.model, self.messages, kwargs))
+
+    def record_response(self, kwargs, response):
+        if self.cassette is not None and not self.cassette.replaying:
+            self.cassette.record(self.model, self.messages, kwargs, response.model_dump(mode='json', exclude_unset=True))
+
+    def store_response(self, key, response):
+        if key is not None:
+            self.cache.put(key, response.model_dump(mode='json', exclude_unset=True))
+
+    def forget_responses(self, keys):
+        '''Remove responses (e.g., invalid answers) from the cache so that repeated calls go to the API.'''
+        for key in keys:
+            if key is not None:
+                self.cache.delete(key)
+
+    def process_response(self, response, print_answer=False):
+        '''Add the answer from the API response to the dialog and return it.'''
         answer = response.choices[0].message.content
         self.messages.append({"role": "assistant", "content": answer})
         if self.as_json:
@@ -143,6 +355,161 @@ class ChatDialog:
             print(answer)
         return answer
 
+    def retry_delay(self, error, attempts):
+        '''Return the number of seconds to wait before repeating a call which failed with a transient error.
+
+        attempts counts the failures of the call per error class. The error is raised again when
+        the retries of its class (see max_retries) are used up.
+        '''
+        name = type(error).__name__
+        attempts[name] = attempts.get(name, 0) + 1
+        if attempts[name] > self.max_retries.get(name, 0):
+            raise error
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempts[name] - 1)))
+        if isinstance(error, RateLimitError) and self.rate_limiter is not None:
+            # the shared limiter makes all dialogs of the model wait for the time suggested by the server,
+            # repeated 429s of this call still back off exponentially
+            delay = max(self.rate_limiter.penalize(error.response.headers), delay)
+        logger.warning(f'{name} from {self.model}, retry {attempts[name]} of {self.max_retries[name]} in {delay:.1f} s')
+        return delay
+
+    def create_completion(self, kwargs):
+        '''Call the API with the current messages, respecting the shared rate limiter (if any)
+        and repeating the call after transient errors.'''
+        attempts = self.last_attempts = {}
+        self.last_wait = 0
+        while True:
+            try:
+                return self.create_completion_once(kwargs)
+            except TRANSIENT_ERRORS as e:
+                time.sleep(self.retry_delay(e, attempts))
+
+    def create_completion_once(self, kwargs):
+        if self.rate_limiter is None:
+            return self.client.chat.completions.create(model=self.model,
+                                                       messages=self.messages,
+                                                       **kwargs)
+        n_tokens = estimate_tokens(self.messages)
+        self.acquire(n_tokens)
+        raw = self.client.chat.completions.with_raw_response.create(model=self.model,
+                                                                    messages=self.messages,
+                                                                    **kwargs)
+        return self.process_raw_response(raw, n_tokens)
+
+    def acquire(self, n_tokens):
+        '''Wait for the shared rate limiter; the waiting time is not counted as latency of the call.'''
+        started = time.perf_counter()
+        self.rate_limiter.acquire(n_tokens)
+        self.last_wait += time.perf_counter() - started
+
+    def record_metrics(self, started, response=None, from_cache=False, error=None):
+        '''Record the call which started at time.perf_counter() value `started` (see metrics.CallMetrics).'''
+        if self.metrics is None:
+            return
+        if from_cache:
+            self.metrics.record(self.model, time.perf_counter() - started, usage=response.usage, from_cache=True)
+            return
+        self.metrics.record(self.model, time.perf_counter() - started - self.last_wait, wait_seconds=self.last_wait,
+                            usage=response.usage if response is not None else None,
+                            retries=sum(self.last_attempts.values()), error=error)
+
+    def record_usage(self, response):
+        '''Add the token usage of an API response to self.usage.
+
+        cached_tokens is the part of the prompt served from the provider's prompt (prefix) cache.
+        '''
+        usage = response.usage
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+        self.usage['calls'] += 1
+        self.usage['prompt_tokens'] += usage.prompt_tokens or 0
+        self.usage['cached_tokens'] += cached_tokens
+        self.usage['completion_tokens'] += usage.completion_tokens or 0
+        logger.debug(f'API usage: {usage.prompt_tokens} prompt tokens ({cached_tokens} cached), {usage.completion_tokens} completion tokens')
+
+    def create_streamed_completion(self, kwargs, on_line=None):
+        '''Streaming counterpart of create_completion(). Returns the assembled ChatCompletion.'''
+        attempts = self.last_attempts = {}
+        self.last_wait = 0
+        while True:
+            try:
+                return self.create_streamed_completion_once(kwargs, on_line)
+            except TRANSIENT_ERRORS as e:
+                time.sleep(self.retry_delay(e, attempts))
+
+    def create_streamed_completion_once(self, kwargs, on_line):
+        n_tokens = estimate_tokens(self.messages)
+        if self.rate_limiter is not None:
+            self.acquire(n_tokens)
+        raw = self.client.chat.completions.with_raw_response.create(model=self.model,
+                                                                    messages=self.messages,
+                                                                    stream=True,
+                                                                    stream_options={'include_usage': True},
+                                                                    **kwargs)
+        stream = raw.parse()
+        lines = LineAssembler(on_line)
+        chunks = []
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    lines.feed(chunk.choices[0].delta.content)
+            lines.finish()
+        except Exception:
+            logger.debug(f'Generation aborted after {len(lines.text)} characters')
+            raise
+        finally:
+            stream.close()
+        return self.process_streamed_response(raw, n_tokens, chunks, lines.text)
+
+    def process_streamed_response(self, raw, n_tokens, chunks, content):
+        response = completion_from_chunks(chunks, content, self.model)
+        if self.rate_limiter is not None:
+            self.rate_limiter.update(raw.headers, n_tokens, response.usage.total_tokens if response.usage else None)
+        return response
+
+    def process_raw_response(self, raw, n_tokens):
+        response = raw.parse()
+        used_tokens = response.usage.total_tokens if response.usage else None
+        self.rate_limiter.update(raw.headers, n_tokens, used_tokens)
+        return response
+
+    def ask(self, question, print_answer=False, on_line=None, **kwargs):
+        '''Ask the question and return the answer.
+
+        If on_line is given it is called with every line of the answer. With self.stream the lines are
+        passed as soon as they arrive and on_line can abort the generation by raising an exception.
+        '''
+        kwargs = self.prepare_call(question, kwargs)
+        key = self.last_cache_key = self.cache_key(kwargs)
+        started = time.perf_counter()
+        response = self.replayed_response(kwargs) or self.cached_response(key)
+        streamed = False
+        if response is None:
+            self.enforce_limits()            
+            started = time.perf_counter()
+            try:
+                if self.stream:
+                    response = self.create_streamed_completion(kwargs, on_line)
+                    streamed = True
+                else:
+                    response = self.create_completion(kwargs)
+            except Exception as e:
+                self.record_metrics(started, error=e)
+                raise
+            self.last_api_event_timestamp = time.time()
+            self.record_usage(response)
+            self.record_metrics(started, response)
+            self.store_response(key, response)
+        else:
+            self.record_metrics(started, response, from_cache=True)
+        self.record_response(kwargs, response)
+        if on_line is not None and not streamed:
+            feed_lines(response.choices[0].message.content or '', on_line)
+        return self.process_response(response, print_answer=print_answer)
+
     def get_last_answer(self):
         for message in self.messages[::-1]:
             if message['role'] == 'assistant':
@@ -150,9 +517,15 @@ class ChatDialog:
         raise ValueError('No answers found')
     
     def reset(self):
-        self.messages = []
-        if self.role:
-            self.messages.append({"role": "system", "content": self.role})
+        self.messages = self.initial_messages()
+
+    def snapshot(self):
+        '''Return a copy of the messages which can be replayed with restore().'''
+        return [dict(message) for message in self.messages]
+
+    def restore(self, messages):
+        '''Continue the dialog from messages (e.g., a snapshot of a fixed conversation prefix).'''
+        self.messages = [dict(message) for message in messages]
 
     def forced_dialog(self, questions, **kwargs): #, print_intermediate_answers=False, print_final_answer=True):
         '''Here we ask a series of questions and not show the answers except the last one.
@@ -190,3 +563,138 @@ class ChatDialog:
                 fp.write('\n'.join(lines))
         else:
             print('\n'.join(lines))
+
+
+class AsyncChatDialog(ChatDialog):
+    '''Asyncio counterpart of ChatDialog built on AsyncOpenAI.
+
+    The methods which talk to the API are coroutines. Many dialogs can share one event loop
+    so hundreds of conversations can be in flight without a thread per request.
+    '''
+    def create_client(self):
+        return AsyncOpenAI(api_key=self.api_key,
+                           base_url=self.base_url,
+                           organization=self.organization,
+                           max_retries=0)
+
+    async def acquire(self, n_tokens):
+        started = time.perf_counter()
+        await self.rate_limiter.acquire_async(n_tokens)
+        self.last_wait += time.perf_counter() - started
+
+    async def enforce_limits(self):
+        if not self.last_api_event_timestamp:
+            return
+        remaining = self.call_wait_time - (time.time() - self.last_api_event_timestamp)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+    async def analyze_image(self, impath, prompt, model='gpt-4-vision-preview', max_tokens=300):
+        response = await self.client.chat.completions.create(
+            model=model,
+            messages=self.image_messages(impath, prompt),
+            max_tokens=max_tokens,
+        )
+        result = response.choices[0].message.content
+        return json.loads(result) if self.as_json else result
+
+    async def create_completion(self, kwargs):
+        attempts = self.last_attempts = {}
+        self.last_wait = 0
+        while True:
+            try:
+                return await self.create_completion_once(kwargs)
+            except TRANSIENT_ERRORS as e:
+                await asyncio.sleep(self.retry_delay(e, attempts))
+
+    async def create_completion_once(self, kwargs):
+        if self.rate_limiter is None:
+            return await self.client.chat.completions.create(model=self.model,
+                                                             messages=self.messages,
+                                                             **kwargs)
+        n_tokens = estimate_tokens(self.messages)
+        await self.acquire(n_tokens)
+        raw = await self.client.chat.completions.with_raw_response.create(model=self.model,
+                                                                          messages=self.messages,
+                                                                          **kwargs)
+        return self.process_raw_response(raw, n_tokens)
+
+    async def create_streamed_completion(self, kwargs, on_line=None):
+        attempts = self.last_attempts = {}
+        self.last_wait = 0
+        while True:
+            try:
+                return await self.create_streamed_completion_once(kwargs, on_line)
+            except TRANSIENT_ERRORS as e:
+                await asyncio.sleep(self.retry_delay(e, attempts))
+
+    async def create_streamed_completion_once(self, kwargs, on_line):
+        n_tokens = estimate_tokens(self.messages)
+        if self.rate_limiter is not None:
+            await self.acquire(n_tokens)
+        raw = await self.client.chat.completions.with_raw_response.create(model=self.model,
+                                                                          messages=self.messages,
+                                                                          stream=True,
+                                                                          stream_options={'include_usage': True},
+                                                                          **kwargs)
+        stream = raw.parse()
+        lines = LineAssembler(on_line)
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    lines.feed(chunk.choices[0].delta.content)
+            lines.finish()
+        except Exception:
+            logger.debug(f'Generation aborted after {len(lines.text)} characters')
+            raise
+        finally:
+            await stream.close()
+        return self.process_streamed_response(raw, n_tokens, chunks, lines.text)
+
+    async def ask(self, question, print_answer=False, on_line=None, **kwargs):
+        kwargs = self.prepare_call(question, kwargs)
+        key = self.last_cache_key = self.cache_key(kwargs)
+        started = time.perf_counter()
+        response = self.replayed_response(kwargs) or self.cached_response(key)
+        streamed = False
+        if response is None:
+            await self.enforce_limits()
+            started = time.perf_counter()
+            try:
+                if self.stream:
+                    response = await self.create_streamed_completion(kwargs, on_line)
+                    streamed = True
+                else:
+                    response = await self.create_completion(kwargs)
+            except Exception as e:
+                self.record_metrics(started, error=e)
+                raise
+            self.last_api_event_timestamp = time.time()
+            self.record_usage(response)
+            self.record_metrics(started, response)
+            self.store_response(key, response)
+        else:
+            self.record_metrics(started, response, from_cache=True)
+        self.record_response(kwargs, response)
+        if on_line is not None and not streamed:
+            feed_lines(response.choices[0].message.content or '', on_line)
+        return self.process_response(response, print_answer=print_answer)
+
+    async def forced_dialog(self, questions, **kwargs):
+        '''See ChatDialog.forced_dialog().'''
+        if self.reset_for_each_call:
+            raise ValueError('Please set reset_for_each_call to False!')
+
+        self.reset()
+        for q in questions:
+            if (isinstance(q, tuple) or isinstance(q, list)) and callable(q[0]):
+                function = q[0]
+                args = q[1:]
+                text = self.messages[-1]['content']
+                function(text, *args)
+            elif isinstance(q, str):
+                await self.ask(q, print_answer=False, **kwargs)
+            else:
+                print(f'Ignoring invalid entry "{repr(q)}"')
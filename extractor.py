@@ -4,15 +4,33 @@ import LEPAMTIC as lepamtic
 import os
 import argparse
 import sys
+import json
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 
 import traceback
 from json import JSONDecodeError
 from tqdm import tqdm
+from openai import APIError
 
 import logging
 
 from chat_via_api import ChatDialog
+from rate_limiter import get_rate_limiter
+from llm_cache import get_response_cache
+from cassette import get_cassette
+from journal import Journal, read_journal
+from result_sink import ResultSink, SINK_FORMATS
+from batch_api import BatchRunner, run_batch_conversations
+from unification import UNIFY_FUNCTIONS, IncompleteUnification, split_known, match_unified, unify_items, unification_batches, map_unified, unify_batch, apply_unification
+from lexicon import Lexicon
+from input_reader import InputReader
+from sharding import parse_shard, in_shard, shard_tag, merge_shards
+from pipeline import run_stages
+from metrics import get_metrics, tagged
 
 
 logger = logging.getLogger("lepamtic.extractor")
@@ -22,25 +40,51 @@ def get_LLM(model_name, args):
     role = 'You act as a data scientist specialized in text mining. Your research domain is soil health, soil biology and land management practices.'
 
     if 'gpt' in model_name or 'o3' in model_name or 'o4' in model_name or 'o1' in model_name:
-        if not args.openai_keyfile:
+        if not args.openai_keyfile and not args.replay:
             raise ValueError(f'{model_name} needs the "--openai_keyfile" parameter to be set')
 
-        llm = ChatDialog(api_key=open(args.openai_keyfile).read().strip(),
+        base_url = 'https://api.openai.com/v1'
+        llm = ChatDialog(api_key=open(args.openai_keyfile).read().strip() if args.openai_keyfile else 'replay',
                         model=model_name,
                         role=role,
-                        call_wait_time=1,
-                        reset_for_each_call=False)
+                        call_wait_time=0,
+                        reset_for_each_call=False,
+                        rate_limiter=get_LLM_rate_limiter(base_url, model_name, args),
+                        cache=get_LLM_cache(args),
+                        structured_outputs=args.structured_outputs,
+                        salvage_attempts=args.salvage_attempts,
+                        turn_retries=args.turn_retries,
+                        max_retries=args.api_retries,
+                        stream=args.stream,
+                        metrics=get_call_metrics(args),
+                        cassette=get_LLM_cassette(args),
+                        max_context_tokens=args.max_context_tokens,
+                        context_overflow=args.context_overflow,
+                        trim_context=args.trim_context)
     
     elif 'gemini' in model_name:
-        if not args.openai_keyfile:
+        if not args.google_keyfile and not args.replay:
             raise ValueError(f'{model_name} needs the "--google_keyfile" parameter to be set')
 
-        llm = ChatDialog(api_key=open(args.google_keyfile).read().strip(),
-                        base_url='https://generativelanguage.googleapis.com/v1beta/openai/',
+        base_url = 'https://generativelanguage.googleapis.com/v1beta/openai/'
+        llm = ChatDialog(api_key=open(args.google_keyfile).read().strip() if args.google_keyfile else 'replay',
+                        base_url=base_url,
                         model=model_name,
                         role=role,
-                        call_wait_time=15,
-                        reset_for_each_call=False)    
+                        call_wait_time=0,
+                        reset_for_each_call=False,
+                        rate_limiter=get_LLM_rate_limiter(base_url, model_name, args, default_rpm=4),
+                        cache=get_LLM_cache(args),
+                        structured_outputs=args.structured_outputs,
+                        salvage_attempts=args.salvage_attempts,
+                        turn_retries=args.turn_retries,
+                        max_retries=args.api_retries,
+                        stream=args.stream,
+                        metrics=get_call_metrics(args),
+                        cassette=get_LLM_cassette(args),
+                        max_context_tokens=args.max_context_tokens,
+                        context_overflow=args.context_overflow,
+                        trim_context=args.trim_context)
     
     else:
         if not args.base_url:
@@ -49,11 +93,98 @@ def get_LLM(model_name, args):
                         api_key = "ollama",
                         model=model_name,
                         role=role,
-                        call_wait_time=1,
-                        reset_for_each_call=False)
+                        call_wait_time=0,
+                        reset_for_each_call=False,
+                        rate_limiter=get_LLM_rate_limiter(args.base_url, model_name, args),
+                        cache=get_LLM_cache(args),
+                        structured_outputs=args.structured_outputs,
+                        salvage_attempts=args.salvage_attempts,
+                        turn_retries=args.turn_retries,
+                        max_retries=args.api_retries,
+                        stream=args.stream,
+                        metrics=get_call_metrics(args),
+                        cassette=get_LLM_cassette(args),
+                        max_context_tokens=args.max_context_tokens,
+                        context_overflow=args.context_overflow,
+                        trim_context=args.trim_context)
+    with _dialogs_lock:
+        _dialogs.append(llm)
     return llm
 
 
+# all dialogs created by get_LLM() (for the token usage summary)
+_dialogs = []
+_dialogs_lock = threading.Lock()
+
+def usage_summary():
+    '''Return a summary of the tokens used by all dialogs, one line per model.'''
+    totals = {}
+    with _dialogs_lock:
+        for llm in _dialogs:
+            model_totals = totals.setdefault(llm.model, dict.fromkeys(llm.usage, 0))
+            for name, value in llm.usage.items():
+                model_totals[name] += value
+    return '\n'.join(f"Token usage of {model}: {t['calls']} API call(s), {t['prompt_tokens']} prompt tokens ({t['cached_tokens']} cached), {t['completion_tokens']} completion tokens"
+                     for model, t in totals.items() if t['calls'])
+
+
+_score_prefixes = {}
+_score_prefixes_lock = threading.Lock()
+
+def get_score_prefix(scoring_llm, llm_parameters):
+    '''Return the scoring protocol exchange (see lepamtic.score_protocol_prefix()) computed once per model and parameters.'''
+    key = (scoring_llm.base_url, scoring_llm.model, json.dumps(llm_parameters, sort_keys=True))
+    with _score_prefixes_lock:
+        if key not in _score_prefixes:
+            with tagged(pk=None, stage='score_prefix'):
+                _score_prefixes[key] = lepamtic.score_protocol_prefix(scoring_llm, **llm_parameters)
+        return _score_prefixes[key]
+
+
+def get_LLM_rate_limiter(base_url, model_name, args, default_rpm=None):
+    '''Return the rate limiter shared by all dialogs of the model.
+
+    Without --rpm/--tpm there is no configured limit (except default_rpm) and the limits are taken from the
+    x-ratelimit-* headers of the responses, so endpoints which do not send them (e.g., local servers) are not
+    limited. --rpm/--tpm 0 disables the limit.
+    '''
+    rpm = default_rpm if args.rpm is None else args.rpm
+    return get_rate_limiter((base_url, model_name), rpm=rpm or None, tpm=args.tpm or None)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_call_metrics(args):
+    '''Return the per-call metrics shared by all dialogs (written to --metrics_file, see metrics.CallMetrics).'''
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            path = args.metrics_file or os.path.join(args.output_dir, f'{output_basename(args)}__{args.mode}__metrics.jsonl')
+            prices = None
+            if args.prices:
+                with open(args.prices, encoding='utf-8') as fp:
+                    prices = {model: tuple(price) for model, price in json.load(fp).items()}
+            _metrics = get_metrics(path, prices=prices)
+        return _metrics
+
+
+def get_LLM_cassette(args):
+    '''Return the cassette shared by all dialogs (recorded with --record or replayed with --replay) or None.'''
+    if args.replay:
+        return get_cassette(args.replay, 'replay')
+    if args.record:
+        return get_cassette(args.record, 'record')
+    return None
+
+
+def get_LLM_cache(args):
+    '''Return the response cache shared by all dialogs or None if --cache_dir is not set.'''
+    if not args.cache_dir:
+        return None
+    return get_response_cache(args.cache_dir, max_size=args.cache_size * 1024**2)
+
+
 def read_data(fname):
     name, ext = os.path.splitext(fname)
     ext = ext.lower()
@@ -87,6 +218,645 @@ def read_data(fname):
     return df
 
 
+def repeat_on_error(function, n_repeats):
+    '''Call function up to n_repeats times to get over some erratic one-time-only behaviour of LLMs.
+
+    API errors which remain after the retries of the dialog (see ChatDialog.max_retries) are not repeated.
+    Returns a tuple (success, result).
+    '''
+    for cnt in range(n_repeats):
+        try:
+            result = function()
+        except (JSONDecodeError, IncompleteUnification) as e:
+            print(e)
+            print(f'Error, attempt {cnt+1} of {n_repeats}')
+        except APIError as e:
+            print(f'API error: {e}')
+            break
+        else:
+            return True, result
+    return False, None
+
+
+def screen_record(llm, pk, abstract, llm_parameters, n_repeats):
+    '''Prescreen one abstract. Returns the result columns (a dict) or None if all attempts failed.'''
+    def screen_abstract():
+        llm.reset()
+        with tagged(pk=pk, stage='screen'):
+            return lepamtic.prescreen(llm, abstract, **llm_parameters)[0]
+
+    ok, score = repeat_on_error(screen_abstract, n_repeats)
+    return {'abstract_relevance': score['relevance'], 'abstract_relevance_explanation': score['comment']} if ok else None
+
+
+def score_record(scoring_llm, pk, abstract, llm_parameters, n_repeats, reuse_score_prefix=True):
+    '''Score one abstract. Returns the result columns (a dict) or None if all attempts failed.'''
+    def score_abstract():
+        prefix = get_score_prefix(scoring_llm, llm_parameters) if reuse_score_prefix else None
+        scoring_llm.reset()
+        with tagged(pk=pk, stage='score'):
+            return lepamtic.extract_score(scoring_llm, abstract, prefix=prefix, **llm_parameters)[0]
+
+    ok, score = repeat_on_error(score_abstract, n_repeats)
+    return {'abstract_score': score['score'], 'abstract_score_explanation': score['score_explanation'], 'abstract_score_model': scoring_llm.model} if ok else None
+
+
+def parse_api_retries(value):
+    '''argparse type of --api_retries: ErrorClass=N'''
+    name, sep, n = value.partition('=')
+    if not sep or not n.isdigit():
+        raise argparse.ArgumentTypeError(f'"{value}" is not of the form ErrorClass=N (e.g., RateLimitError=8)')
+    if name not in ChatDialog.max_retries:
+        raise argparse.ArgumentTypeError(f'"{name}" is not one of the retried errors {", ".join(ChatDialog.max_retries)}')
+    return name, int(n)
+
+
+def run_stage_graph(stages, concurrent=True):
+    '''Run a small dependency graph of stages given as a dict name -> (dependencies, function).
+
+    Every function is called without arguments and returns a tuple (success, result) (see repeat_on_error()).
+    With concurrent=True a stage starts as soon as all of its dependencies succeeded, so independent stages
+    run at the same time (they must not share a dialog). Otherwise the stages run one after the other in the
+    order of the dict. No new stage is started after a failure.
+    Returns a dict name -> (success, result) of the stages which were run.
+    '''
+    results = {}
+    if not concurrent:
+        for name, (dependencies, function) in stages.items():
+            results[name] = function()
+            if not results[name][0]:
+                break
+        return results
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        running = {}
+        failed = False
+        while True:
+            if not failed:
+                for name, (dependencies, function) in stages.items():
+                    if name not in results and name not in running.values() and all(dep in results for dep in dependencies):
+                        running[pool.submit(function)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                failed = failed or not results[name][0]
+    return results
+
+
+def below_min_score(score, min_score):
+    '''True if the score (a dict or row with "score") is below min_score (never if min_score is None).'''
+    return min_score is not None and score is not None and float(score['score']) < min_score
+
+
+def below_min_score_row(pk, score, pkey):
+    '''The single row written for an abstract which is not extracted because of --min_score: only its score and explanation.'''
+    row = dict.fromkeys(extraction_columns(pkey))
+    row.update({pkey: pk, 'score': score['score'], 'score_explanation': score['score_explanation']})
+    return pd.DataFrame([row])
+
+
+def extract_abstract(pk, abstract, llm, scoring_llm, unified_actors, llm_parameters, n_repeats, pkey, score=None, chain='full', reuse_score_prefix=True,
+                     unify=True, lexicon=None, property_llm=None, concurrent_stages=True, min_score=None, split_by='llm'):
+    '''Score the abstract, extract patterns and unify actors and properties.
+
+    If score (a dict with "score" and "score_explanation") is given, the abstract is not scored again.
+    Abstracts with a score below min_score are not extracted (see below_min_score_row()); pattern
+    extraction then waits for the score.
+    chain is the name of the prompt chain used to extract patterns (see lepamtic.pattern_chains) and split_by
+    selects how its conjunctions are split (see lepamtic.split_locally()).
+    With reuse_score_prefix the scoring protocol exchange is computed once and replayed (see get_score_prefix()).
+    With unify=False actors and properties are left for unify_patterns() which unifies many abstracts at once.
+    Values known to the lexicon (see lexicon.Lexicon) are not sent to the LLM.
+
+    The stages form a dependency graph (see run_stage_graph()): scoring and pattern extraction only need the
+    abstract, the unification of actors and of properties only needs the patterns. With concurrent_stages the
+    independent stages run at the same time, each on its own dialog; properties are unified with property_llm
+    (after the actors, with llm, if it is not given).
+    Returns a dataframe with one row per pattern (possibly empty) or None if any of the steps failed.
+    '''
+    def score_abstract():
+        prefix = get_score_prefix(scoring_llm, llm_parameters) if reuse_score_prefix else None
+        scoring_llm.reset()
+        with tagged(pk=pk, stage='score'):
+            return lepamtic.extract_score(scoring_llm, abstract, prefix=prefix, **llm_parameters)[0]
+
+    extract_patterns = lepamtic.pattern_chains[chain][0]
+
+    def find_patterns():
+        if min_score is not None and below_min_score(score or stage_results['score'][1], min_score):
+            return pd.DataFrame()
+        llm.reset()
+        with tagged(pk=pk, stage='patterns'):
+            patterns_df = pd.DataFrame(extract_patterns(llm, abstract, split_by=split_by, **llm_parameters))
+        patterns_df.insert(0, pkey, pk)
+        return patterns_df
+
+    def patterns():
+        return stage_results['patterns'][1]
+
+    def unify_actors():
+        if patterns().empty:
+            return None
+        llm.reset()
+        actor_sentence_dicts = patterns()[['actor', 'sentences']].to_dict(orient="records")
+        with tagged(pk=pk, stage='unify_actor'):
+            return pd.DataFrame(unify_items(llm, 'actor', actor_sentence_dicts, unified_actors, llm_parameters, lexicon))
+
+    unify_llm = property_llm or llm
+
+    def unify_property():
+        if patterns().empty:
+            return None
+        unify_llm.reset()
+        property_sentence_dicts = patterns()[['property', 'sentences']].to_dict(orient="records")
+        with tagged(pk=pk, stage='unify_property'):
+            return pd.DataFrame(unify_items(unify_llm, 'property', property_sentence_dicts, lepamtic.unified_properties, llm_parameters, lexicon))
+
+    # stage name -> (dependencies, function, error message)
+    stages = {}
+    if score is None:
+        stages['score'] = ([], score_abstract, f'Error while scoring {pk}')
+    stages['patterns'] = (['score'] if score is None and min_score is not None else [], find_patterns, f'Error while finding patterns for {pk}')
+    if unify:
+        stages['actors'] = (['patterns'], unify_actors, f'Error while unifying actors for {pk}')
+        stages['properties'] = (['patterns'] if property_llm else ['actors'], unify_property, f'Error while unifying property for {pk}')
+
+    stage_results = {}
+    def run_stage(name):
+        stage_results[name] = repeat_on_error(stages[name][1], n_repeats)
+        return stage_results[name]
+
+    run_stage_graph({name: (dependencies, lambda name=name: run_stage(name)) for name, (dependencies, _, _) in stages.items()},
+                    concurrent=concurrent_stages)
+
+    for name, (_, _, message) in stages.items():
+        ok, result = stage_results.get(name, (True, None))
+        if not ok:
+            print(message)
+            return None
+    if 'score' in stage_results:
+        score = stage_results['score'][1]
+    if below_min_score(score, min_score):
+        return below_min_score_row(pk, score, pkey)
+
+    patterns_df = patterns()
+    if patterns_df.empty:
+        return patterns_df
+
+    if unify:
+        patterns_df.insert(7, 'actor_unified', stage_results['actors'][1]['actor_unified'])
+        patterns_df.insert(6, 'property_unified', stage_results['properties'][1]['property_unified'])
+
+    patterns_df.insert(len(patterns_df.columns), 'score', score['score'])
+    patterns_df.insert(len(patterns_df.columns), 'score_explanation', score['score_explanation'])
+    return patterns_df
+
+
+def unify_patterns(patterns_dfs, unified_actors, llm_parameters, args, lexicon=None, llms=None):
+    '''Unify actors and properties of many abstracts at once (see extract_abstract() with unify=False).
+
+    Distinct values are sent in batches of at most --unify_batch_size items which are processed by the worker threads.
+    Values known to the lexicon are not sent. llms is a queue.SimpleQueue of idle dialogs which is shared by the
+    calls of a run (a dialog is created when none is idle, so there are at most --workers of them).
+    Returns a dict primary key -> complete patterns dataframe or None if unification failed.
+    '''
+    if llms is None:
+        llms = queue.SimpleQueue()
+    unified_lists = {'actor': unified_actors, 'property': lepamtic.unified_properties}
+    mappings = {}
+    batches = []
+    for field in UNIFY_FUNCTIONS:
+        items = itertools.chain.from_iterable(df[[field, 'sentences']].to_dict(orient='records') for df in patterns_dfs.values())
+        mappings[field], unknown = split_known(lexicon, field, items, unified_lists[field])
+        batches += [(field, batch) for batch in unification_batches(unknown, field, args.unify_batch_size)]
+
+    def process(field, batch):
+        try:
+            llm = llms.get_nowait()
+        except queue.Empty:
+            llm = get_LLM(args.model_name, args)
+        try:
+            with tagged(pk=None, stage=f'unify_{field}_batch'):
+                return unify_batch(llm, field, batch, unified_lists[field], llm_parameters, args.n_repeats)
+        finally:
+            llms.put(llm)
+
+    failed = {field: set() for field in UNIFY_FUNCTIONS}
+    for (field, batch), mapping in run_workers(process, batches, args.workers):
+        if mapping is None:
+            failed[field].update(item[field] for item in batch)
+        else:
+            mappings[field].update(mapping)
+            if lexicon is not None:
+                lexicon.add(field, unified_lists[field], mapping)
+    logger.info(f'Unified {sum(map(len, patterns_dfs.values()))} pattern(s) of {len(patterns_dfs)} abstract(s) in {len(batches)} call(s)')
+    return apply_unification(patterns_dfs, mappings, failed)
+
+
+_worker_state = threading.local()
+
+def get_worker_LLM(slot, model_name, args):
+    '''Return the ChatDialog for the given slot (e.g., "extract" or "score") owned by the calling thread.
+
+    Dialogs keep the conversation in `messages` so they must never be shared between threads.
+    '''
+    if not hasattr(_worker_state, 'llms'):
+        _worker_state.llms = {}
+    if slot not in _worker_state.llms:
+        _worker_state.llms[slot] = get_LLM(model_name, args)
+    return _worker_state.llms[slot]
+
+
+def run_workers(function, items, workers):
+    '''Call function(*item) for every item using a pool of worker threads.
+
+    Yields (item, result) pairs in the order of completion. At most 2*workers items are submitted
+    at any time so that items can be produced lazily. With workers=1 everything runs in the calling thread.
+    '''
+    if workers <= 1:
+        for item in items:
+            yield item, function(*item)
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for item in itertools.islice(items, 2 * workers):
+            pending[pool.submit(function, *item)] = item
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                for next_item in itertools.islice(items, 1):
+                    pending[pool.submit(function, *next_item)] = next_item
+                yield item, future.result()
+
+
+def resume_from_journal(journal, data):
+    '''Return the journal entries which belong to data and the part of data which is not in the journal yet.'''
+    entries = {pk: entry for pk, entry in journal.load().items() if pk in data.index}
+    if entries:
+        print(f'Resuming: {len(entries)} abstract(s) already processed, {len(data) - len(entries)} left')
+    return entries, data[~data.index.isin(list(entries))]
+
+
+def output_basename(args):
+    '''Start of the names of all output files: the input file name without the extension and the shard tag (see --shard).'''
+    ifnb, ifnext = os.path.splitext(os.path.split(args.input_file)[1])
+    return ifnb + shard_tag(args.shard)
+
+
+def select_shard(df, args):
+    '''Return the rows of df which belong to the shard given by --shard (all rows without it).'''
+    if args.shard is None:
+        return df
+    df = df[df[args.primary_key].map(lambda pk: in_shard(pk, args.shard))]
+    print(f'Shard {args.shard[0]}/{args.shard[1]}: {len(df)} abstract(s)')
+    return df
+
+
+def write_screening_results(original_data, results, error_data, args):
+    results_df = pd.DataFrame(results).set_index(args.primary_key)
+    merged_data = original_data.set_index(args.primary_key)
+    output_df = merged_data.merge(results_df, how='left', left_index=True, right_index=True)
+    output_df = output_df.reset_index()
+    
+    ifnb = output_basename(args)
+    output_df[output_df['abstract_relevance']==1].to_csv(os.path.join(args.output_dir, f"{ifnb}__relevance_1.csv"), index=False)
+    output_df[output_df['abstract_relevance']==0].to_csv(os.path.join(args.output_dir, f"{ifnb}__relevance_0.csv"), index=False)    
+
+    errors_df = pd.DataFrame(error_data)
+    if len(errors_df):
+        errors_df.to_excel(os.path.join(args.output_dir, f"{ifnb}__errors.csv"), index=False)
+
+
+def write_scoring_results(original_data, results, error_data, args):
+    results_df = pd.DataFrame(results).set_index(args.primary_key)
+    merged_data = original_data.set_index(args.primary_key)
+    output_df = merged_data.merge(results_df, how='left', left_index=True, right_index=True)
+    output_df = output_df.reset_index()
+    
+    ifnb = output_basename(args)
+    output_df.to_csv(os.path.join(args.output_dir, f"{ifnb}__scored.csv"), index=False)
+
+    errors_df = pd.DataFrame(error_data)
+    if len(errors_df):
+        errors_df.to_excel(os.path.join(args.output_dir, f"{ifnb}__errors.csv"), index=False)
+
+
+def extraction_columns(pkey):
+    '''Columns of the extraction table in the order produced by extract_abstract().'''
+    fields = lepamtic.pattern_fields
+    i_property, i_actor = fields.index('property'), fields.index('actor')
+    return ([pkey] + fields[:i_property + 1] + ['property_unified'] + fields[i_property + 1:i_actor + 1] + ['actor_unified']
+            + fields[i_actor + 1:] + ['score', 'score_explanation'])
+
+
+def write_extraction_results(entries, positions, pkey, output_fn, err_fn):
+    '''Write patterns and errors from the journal entries in the order of the input (positions maps primary keys to it).'''
+    rows = []
+    errors = []
+    for pk in sorted(entries, key=positions.get):
+        status, pk_rows = entries[pk]
+        if status == Journal.OK:
+            rows.extend(pk_rows)
+        else:
+            errors.append({pkey: pk})
+
+    if rows:
+        columns = set(rows[0].keys())
+        for row in rows[1:]:
+            if set(row.keys()) != columns:
+                print('ERROR: columns do not match across all extraction results! NaNs will be present after concatenation.')
+                break
+
+        patterns_df = pd.DataFrame(rows)
+        patterns_df.to_excel(output_fn, index=False)
+
+    errors_df = pd.DataFrame(errors)
+    if len(errors_df):
+        errors_df.to_excel(err_fn, index=False)
+
+
+def journal_results(entries, pkey):
+    '''Split journal entries of the screen and score modes into a list of results and a list of errors.'''
+    results = []
+    error_data = []
+    for pk, (status, result) in entries.items():
+        if status == Journal.OK:
+            results.append({pkey: pk, **result})
+        else:
+            error_data.append({pkey: pk})
+    return results, error_data
+
+
+def record_result(journal, sink, pk, result, pkey):
+    '''Record a finished abstract (result is a dict or a list of rows) or a failed one (result is None).'''
+    if result is None:
+        journal.record(pk, Journal.ERROR)
+    else:
+        journal.record(pk, Journal.OK, result)
+        sink.append([{pkey: pk, **result}] if isinstance(result, dict) else result)
+
+
+def open_journal_and_sink(journal_fn, sink_fn, columns, data, args, overwrite=False):
+    '''Open the journal (resuming if requested) and a fresh result sink which already contains the journaled results.
+
+    Without --resume an existing journal is replaced if overwrite is set (see journal.Journal) and refused otherwise.
+    Returns (journal, sink, todo) where todo is the part of data which is not in the journal yet.
+    '''
+    journal = Journal(journal_fn, resume=args.resume, overwrite=overwrite)
+    entries, todo = resume_from_journal(journal, data)
+    sink = ResultSink(sink_fn, columns=columns)
+    for pk in data.index:
+        if pk in entries and entries[pk][0] == Journal.OK:
+            result = entries[pk][1]
+            sink.append([{args.primary_key: pk, **result}] if isinstance(result, dict) else result)
+    return journal, sink, todo
+
+
+def open_journal_and_sink_for_stream(journal_fn, sink_fn, columns, args, overwrite=False):
+    '''Like open_journal_and_sink() for an input which is read as a stream of records (see input_reader.InputReader).
+
+    All journal entries are assumed to belong to the input. Returns (journal, sink, entries) where entries are the
+    journal entries of the abstracts which are already processed.
+    '''
+    journal = Journal(journal_fn, resume=args.resume, overwrite=overwrite)
+    entries = journal.load()
+    if entries:
+        print(f'Resuming: {len(entries)} abstract(s) already processed')
+    sink = ResultSink(sink_fn, columns=columns)
+    for pk, (status, result) in entries.items():
+        if status == Journal.OK:
+            sink.append([{args.primary_key: pk, **result}] if isinstance(result, dict) else result)
+    return journal, sink, entries
+
+
+def load_scores(fname, pkey):
+    '''Read abstract scores computed by the score mode from its output table (`__scored.csv`) or journal (`.jsonl`).
+
+    Returns a dict str(primary key) -> {"score": ..., "score_explanation": ..., "model": ...}; abstracts without a
+    score are left out. The model is None for scores written before the scoring model was recorded.
+    '''
+    scores = {}
+    if fname.endswith('.jsonl'):
+        for pk, (status, result) in read_journal(fname).items():
+            if status == Journal.OK:
+                scores[str(pk)] = {'score': result['abstract_score'], 'score_explanation': result['abstract_score_explanation'],
+                                   'model': result.get('abstract_score_model')}
+        return scores
+
+    df = pd.read_excel(fname) if fname.lower().endswith(('.xls', '.xlsx')) else pd.read_csv(fname)
+    for col in [pkey, 'abstract_score', 'abstract_score_explanation']:
+        if col not in df.columns:
+            raise SyntaxError(f'Column "{col}" not present in scores file "{fname}"')
+    df = df[df['abstract_score'].notna()]
+    models = df['abstract_score_model'] if 'abstract_score_model' in df.columns else [None] * len(df)
+    for pk, score, explanation, model in zip(df[pkey], df['abstract_score'], df['abstract_score_explanation'], models):
+        scores[str(pk)] = {'score': score, 'score_explanation': explanation, 'model': model if isinstance(model, str) else None}
+    return scores
+
+
+def scores_of_model(scores, fname, model, explicit):
+    '''Return the scores (see load_scores()) which can be used for the scoring model.
+
+    The outputs of the extract mode are named after the scoring model, so scores found in --output_dir are only
+    used if they were computed by it (the others are scored again). Scores of --scores_file (explicit) are all used.
+    '''
+    others = sorted({score['model'] or 'an unrecorded model' for score in scores.values() if score['model'] != model})
+    if not others:
+        return scores
+    if explicit:
+        print(f'Warning: some scores in "{fname}" were computed by {", ".join(others)}, not by {model}')
+        return scores
+    matching = {pk: score for pk, score in scores.items() if score['model'] == model}
+    print(f'Warning: {len(scores) - len(matching)} score(s) in "{fname}" were not computed by {model} ({", ".join(others)}), these abstracts are scored again')
+    return matching
+
+
+def find_scores_file(args, ifnb):
+    '''Return --scores_file or the output of a previous score run on the same input found in --output_dir (or None).'''
+    if args.scores_file:
+        return args.scores_file
+    for fn in [f'{ifnb}__score_journal.jsonl', f'{ifnb}__scored.csv']:
+        path = os.path.join(args.output_dir, fn)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def get_batch_runner(llm, args):
+    ifnb = output_basename(args)
+    work_dir = os.path.join(args.output_dir, f'{ifnb}__batch')
+    return BatchRunner(llm, work_dir, poll_interval=args.batch_poll_interval)
+
+
+def extraction_file_names(args):
+    '''Return the paths (output table, error table, journal, result file) of the extract mode.'''
+    ifnb = output_basename(args)
+    # results of other prompt chains and conjunction splitting modes are kept apart for comparison
+    run_name = f'{args.model_name}__{args.scoring_model_name}' + ('' if args.chain == 'full' else f'__{args.chain}')
+    if args.split_conjuncts != 'llm' and args.chain != 'single':
+        run_name += f'__{args.split_conjuncts}_split'
+    return (os.path.join(args.output_dir, f'{ifnb}__patterns__{run_name}.xlsx'),
+            os.path.join(args.output_dir, f'{ifnb}__errors__{run_name}.xlsx'),
+            os.path.join(args.output_dir, f'{ifnb}__journal__{run_name}.jsonl'),
+            os.path.join(args.output_dir, f'{ifnb}__patterns__{run_name}.{args.sink_format}'))
+
+
+def run_extraction(items, process, journal, sink, unified_actors, llm_parameters, args, lexicon=None, total=None, write_outputs=None):
+    '''Call process(pk, abstract, ...) (see extract_abstract()) for all items using --workers threads and record the patterns.
+
+    With --unify_batch_size the patterns wait until there are enough distinct actors or properties to fill a batch
+    for every worker and are then unified together (see unify_patterns()). write_outputs() is called every
+    --write_every abstracts.
+    '''
+    PKEY = args.primary_key
+    pending = {}
+    pending_values = {field: set() for field in UNIFY_FUNCTIONS}
+    unify_llms = queue.SimpleQueue()
+
+    def record(pk, patterns_df):
+        record_result(journal, sink, pk, None if patterns_df is None else patterns_df.to_dict(orient='records'), PKEY)
+
+    def unify_pending():
+        for pk, patterns_df in unify_patterns(pending, unified_actors, llm_parameters, args, lexicon=lexicon, llms=unify_llms).items():
+            record(pk, patterns_df)
+        pending.clear()
+        for values in pending_values.values():
+            values.clear()
+
+    for n, (item, patterns_df) in enumerate(tqdm(run_workers(process, items, args.workers), total=total), start=1):
+        pk = item[0]
+        if args.unify_batch_size and patterns_df is not None and not patterns_df.empty and not below_min_score(patterns_df.iloc[0], args.min_score):
+            pending[pk] = patterns_df
+            for field, values in pending_values.items():
+                values.update(patterns_df[field])
+            if max(map(len, pending_values.values())) >= args.unify_batch_size * max(args.workers, 1):
+                unify_pending()
+        else:
+            record(pk, patterns_df)
+
+        if write_outputs and args.write_every and n % args.write_every == 0:
+            write_outputs()
+    if pending:
+        unify_pending()
+
+
+def order_by_score(items, scores):
+    '''Sort (primary key, abstract) items by decreasing score (scores is a dict str(primary key) -> score, see
+    load_scores()). Items without a score come last; items with the same score keep their order.'''
+    def key(item):
+        score = scores.get(str(item[0]))
+        return -float(score['score']) if score is not None else float('inf')
+    return sorted(items, key=key)
+
+
+def extract_batch(data, llm, scoring_llm, unified_actors, llm_parameters, args, precomputed_scores=None, lexicon=None):
+    '''Batch API counterpart of extract_abstract() which processes all abstracts stage by stage.
+
+    precomputed_scores is a dict (see load_scores()) of scores which are not computed again.
+    Returns a tuple (result_dfs, failed) with a dict primary key -> patterns dataframe and a list of failed primary keys.
+    '''
+    PKEY = args.primary_key
+    precomputed_scores = precomputed_scores or {}
+    abstracts = data[args.abstract_column].to_dict()
+    runner = get_batch_runner(llm, args)
+    scoring_runner = get_batch_runner(scoring_llm, args)
+
+    conversations = {pk: lepamtic.extract_score_turns(abstract) for pk, abstract in abstracts.items() if str(pk) not in precomputed_scores}
+    scores, failed = run_batch_conversations(scoring_runner, 'score', conversations, args.n_repeats, **llm_parameters)
+    scores = {pk: score[0] for pk, score in scores.items()}
+    scores.update({pk: precomputed_scores[str(pk)] for pk in abstracts if str(pk) in precomputed_scores})
+    skipped = {pk: below_min_score_row(pk, score, PKEY) for pk, score in scores.items() if below_min_score(score, args.min_score)}
+
+    extract_patterns_turns = lepamtic.pattern_chains[args.chain][2]
+    conversations = {pk: extract_patterns_turns(abstracts[pk], args.split_conjuncts) for pk in abstracts if pk in scores and pk not in skipped}
+    patterns, failed_patterns = run_batch_conversations(runner, 'patterns', conversations, args.n_repeats, **llm_parameters)
+    failed += failed_patterns
+    if args.split_conjuncts != 'llm' and args.chain != 'single':
+        # there is no conversation to continue for the ambiguous values, so 'auto' keeps them as 'local' does
+        patterns = {pk: lepamtic.split_conjunctions(pk_patterns)[0] for pk, pk_patterns in patterns.items()}
+
+    patterns_dfs = {}
+    for pk, pk_patterns in patterns.items():
+        patterns_df = pd.DataFrame(pk_patterns)
+        if patterns_df.empty:
+            continue
+        patterns_df.insert(0, PKEY, pk)
+        patterns_dfs[pk] = patterns_df
+
+    if args.unify_batch_size:
+        result_dfs, failed_unification = unify_patterns_batch(runner, patterns_dfs, scores, unified_actors, llm_parameters, args, lexicon=lexicon)
+        return {**result_dfs, **skipped}, failed + failed_unification
+
+    conversations = {pk: lepamtic.unify_actors_turns(df[['actor', 'sentences']].to_dict(orient="records"), unified_actors)
+                     for pk, df in patterns_dfs.items()}
+    uactors, failed_actors = run_batch_conversations(runner, 'unify_actors', conversations, args.n_repeats, **llm_parameters)
+
+    conversations = {pk: lepamtic.unify_property_turns(df[['property', 'sentences']].to_dict(orient="records"), lepamtic.unified_properties)
+                     for pk, df in patterns_dfs.items() if pk in uactors}
+    uproperties, failed_properties = run_batch_conversations(runner, 'unify_property', conversations, args.n_repeats, **llm_parameters)
+    failed += failed_actors + failed_properties
+
+    result_dfs = {}
+    for pk, patterns_df in patterns_dfs.items():
+        if pk not in uproperties:
+            continue
+        actors, missing_actors = match_unified(patterns_df['actor'], uactors[pk], 'actor')
+        properties, missing_properties = match_unified(patterns_df['property'], uproperties[pk], 'property')
+        if missing_actors or missing_properties:
+            print(f'Error while unifying {"actors" if missing_actors else "property"} for {pk}')
+            failed.append(pk)
+            continue
+        patterns_df.insert(7, 'actor_unified', patterns_df['actor'].map(actors))
+        patterns_df.insert(6, 'property_unified', patterns_df['property'].map(properties))
+        patterns_df.insert(len(patterns_df.columns), 'score', scores[pk]['score'])
+        patterns_df.insert(len(patterns_df.columns), 'score_explanation', scores[pk]['score_explanation'])
+        result_dfs[pk] = patterns_df
+    return {**result_dfs, **skipped}, failed
+
+
+def unify_patterns_batch(runner, patterns_dfs, scores, unified_actors, llm_parameters, args, lexicon=None):
+    '''Batch API counterpart of unify_patterns() which also adds the scores.
+
+    Returns a tuple (result_dfs, failed) with a dict primary key -> patterns dataframe and a list of primary keys
+    of abstracts which could not be unified.
+    '''
+    unified_lists = {'actor': unified_actors, 'property': lepamtic.unified_properties}
+    mappings = {}
+    failed = {}
+    for field, (_, turns) in UNIFY_FUNCTIONS.items():
+        items = itertools.chain.from_iterable(df[[field, 'sentences']].to_dict(orient='records') for df in patterns_dfs.values())
+        mappings[field], unknown = split_known(lexicon, field, items, unified_lists[field])
+        batches = unification_batches(unknown, field, args.unify_batch_size)
+        conversations = {i: turns(batch, unified_lists[field]) for i, batch in enumerate(batches)}
+        answers, _ = run_batch_conversations(runner, f'unify_{field}', conversations, args.n_repeats, **llm_parameters)
+        failed[field] = set()
+        for i, batch in enumerate(batches):
+            mapping = map_unified(batch, answers[i], field) if i in answers else None
+            if mapping is None:
+                failed[field].update(item[field] for item in batch)
+            else:
+                mappings[field].update(mapping)
+                if lexicon is not None:
+                    lexicon.add(field, unified_lists[field], mapping)
+
+    result_dfs = {}
+    failed_pks = []
+    for pk, patterns_df in apply_unification(patterns_dfs, mappings, failed).items():
+        if patterns_df is None:
+            failed_pks.append(pk)
+            continue
+        patterns_df.insert(len(patterns_df.columns), 'score', scores[pk]['score'])
+        patterns_df.insert(len(patterns_df.columns), 'score_explanation', scores[pk]['score_explanation'])
+        result_dfs[pk] = patterns_df
+    return result_dfs, failed_pks
+
+
 def setup_logging(debug):
     # Keep everyone else quiet
     logging.getLogger().handlers.clear()
@@ -103,11 +873,6 @@ def setup_logging(debug):
 
 if __name__ == '__main__':
 
-    def store_error(error_data):
-        # error_text = traceback.format_exc()
-        error_data.append({PKEY: pk}) #, 'error': error_text})
-
-
     def add_common_args(subparser):
         subparser.add_argument('--output_dir', type=str, required=True, help='Directory to store output files')
         subparser.add_argument('--input_file', type=str, required=True, help='Path to the input CSV file')
@@ -121,8 +886,45 @@ if __name__ == '__main__':
         subparser.add_argument('--openai_keyfile', type=str, required=False, help="A file containing OpenAI API key")
         subparser.add_argument('--google_keyfile', type=str, required=False, help="A file containing Google API key")
         subparser.add_argument('--base_url', type=str, required=False, help="URL of the local LLM")
+        subparser.add_argument('--rpm', type=int, required=False, default=None, help="Requests per minute allowed for each model, shared by all workers; an upper bound of the limits sent by the provider (default: the limits sent by the provider, 4 for Gemini; 0 means no limit)")
+        subparser.add_argument('--tpm', type=int, required=False, default=None, help="Tokens per minute allowed for each model, shared by all workers; an upper bound of the limits sent by the provider (default: the limits sent by the provider)")
+        subparser.add_argument('--cache_dir', type=str, required=False, help="Directory of the persistent LLM response cache (no caching if not set)")
+        subparser.add_argument('--cache_size', type=int, required=False, default=1024, help="Maximal size of the LLM response cache in MB")
+        subparser.add_argument('--record', type=str, required=False, metavar='CASSETTE', help="Append every LLM answer to this cassette file (JSONL, compressed if it ends with .gz) for --replay")
+        subparser.add_argument('--replay', type=str, required=False, metavar='CASSETTE', help="Answer all LLM calls from a cassette written with --record, without network access (calls which were not recorded fail)")
+        subparser.add_argument('--structured_outputs', action="store_true", help="Request strict JSON schema structured outputs for every parsed answer (the model/provider must support json_schema response formats)")
+        subparser.add_argument('--salvage_attempts', type=int, required=False, default=1, help="Number of times only the invalid lines of a JSONL answer are asked for again before the whole step is repeated")
+        subparser.add_argument('--turn_retries', type=int, required=False, default=2, help="Number of times a turn with an invalid answer is asked again before the whole step is repeated")
+        subparser.add_argument('--api_retries', type=parse_api_retries, nargs='+', required=False, default=[], metavar='ERROR=N',
+                               help=f"Retries of API calls per openai error class with exponential backoff (default: {' '.join(f'{k}={v}' for k, v in ChatDialog.max_retries.items())})")
+        subparser.add_argument('--stream', action="store_true", help="Receive answers as streams: JSONL lines are checked as they arrive and a generation is aborted (and the turn repeated) at the first invalid line")
+        subparser.add_argument('--trim_context', action="store_true", help="Send only the exported patterns (not the instructions and the abstract) with the conjunction splitting turn of the full and compact chains")
+        subparser.add_argument('--max_context_tokens', type=int, required=False, default=None, help="Approximate limit of the prompt tokens of a call (leave room for the answer in the model's context window); longer calls fail before they are sent")
+        subparser.add_argument('--context_overflow', type=str, required=False, choices=['fail', 'drop'], default='fail', help="What to do with a call longer than --max_context_tokens: fail the abstract or drop the oldest turns of the conversation until it fits")
+        subparser.add_argument('--batch', action="store_true", help="Use the provider's Batch API (all abstracts are sent as one batch per step)")
+        subparser.add_argument('--batch_poll_interval', type=float, required=False, default=60, help="Seconds between checks of the batch status")
+        subparser.add_argument('--sink_format', type=str, required=False, choices=SINK_FORMATS, default='csv', help="Format of the file to which results are appended as soon as each abstract is processed")
+        subparser.add_argument('--write_every', type=int, required=False, default=0, help="Rebuild the final output tables every N abstracts (default: only at the end)")
+        subparser.add_argument('--shard', type=parse_shard, required=False, default=None, metavar='i/N', help="Process only the i-th of N parts of the input (abstracts are assigned by a stable hash of the primary key); combine the outputs with the merge mode")
+        subparser.add_argument('--resume', action="store_true", help="Continue an interrupted run: abstracts already recorded in the journal file are skipped")
+        subparser.add_argument('--metrics_file', type=str, required=False, help="JSONL file to which the latency, tokens and retries of every LLM call are appended (default: __<mode>__metrics.jsonl in --output_dir)")
+        subparser.add_argument('--prices', type=str, required=False, help='JSON file with model prices for the cost estimate, {"model name prefix": [input, cached input, output]} in USD per million tokens')
         subparser.add_argument("--debug", action="store_true", help="Enable debug output")
 
+    def add_extraction_args(subparser):
+        subparser.add_argument('--model_name', type=str, required=True, help='Name of the LLM model to use (e.g., gpt-4)')
+        subparser.add_argument('--scoring_model_name', type=str, required=True, help='Name of the LLM model to use for scoring abstracts (e.g., o3)')
+        subparser.add_argument('--actor_file', type=str, required=True, help='Path to the actor CSV file')
+        subparser.add_argument('--chain', type=str, required=False, choices=list(lepamtic.pattern_chains), default='full', help='Prompt chain for pattern extraction: full (six calls), compact (instructions and abstract in one call, then conjunction splitting) or single (one call)')
+        subparser.add_argument('--split_conjuncts', type=str, required=False, choices=lepamtic.split_modes, default='llm', help='How the full and compact chains split conjunctions in properties and actors: with an LLM call (llm), locally (local, ambiguous values are kept) or locally with an LLM call only for abstracts with ambiguous values (auto)')
+        subparser.add_argument('--no_score_prefix', action="store_true", help='Send the scoring protocol again for every abstract instead of replaying its first exchange')
+        subparser.add_argument('--unify_batch_size', type=int, required=False, default=0, help='Unify actors and properties of many abstracts together, sending at most this many distinct values per call (default: one call per abstract)')
+        subparser.add_argument('--lexicon_file', type=str, required=False, help='SQLite file of the unification lexicon: actors and properties unified before are answered without the LLM and new answers are added (created if it does not exist)')
+        subparser.add_argument('--lexicon_min_count', type=int, required=False, default=2, help='Number of identical LLM answers needed before a term is answered from the lexicon (curated entries are always used)')
+        subparser.add_argument('--workers', type=int, required=False, default=1, help='Number of abstracts processed at the same time (each worker uses its own LLM dialogs)')
+        subparser.add_argument('--sequential_stages', action="store_true", help='Run the stages of an abstract one after the other (by default scoring runs alongside pattern extraction and actors are unified alongside properties)')
+        subparser.add_argument('--min_score', type=float, required=False, default=None, help='Do not extract patterns from abstracts with a score below this value (0-5); they are written with only their score and explanation')
+
     parser = argparse.ArgumentParser(description='Run LLM processing on CSV input.')
     subparsers = parser.add_subparsers(dest="mode", required=True, help="Select a mode to run")
 
@@ -131,20 +933,71 @@ if __name__ == '__main__':
     add_common_args(screen_parser)
 
     extract_parser = subparsers.add_parser("extract", help="Run extraction mode")
-    extract_parser.add_argument('--model_name', type=str, required=True, help='Name of the LLM model to use (e.g., gpt-4)')
-    extract_parser.add_argument('--scoring_model_name', type=str, required=True, help='Name of the LLM model to use for scoring abstracts (e.g., o3)')
-    extract_parser.add_argument('--actor_file', type=str, required=True, help='Path to the actor CSV file')
+    add_extraction_args(extract_parser)
+    extract_parser.add_argument('--scores_file', type=str, required=False, help='Scores computed by the score mode (__scored.csv or __score_journal.jsonl); by default they are looked up in --output_dir')
+    extract_parser.add_argument('--order_by_score', action="store_true", help='Score all abstracts first and extract them in the order of decreasing score (the input is read at once)')
     add_common_args(extract_parser)
 
     score_parser = subparsers.add_parser("score", help="Run scoring mode")
     score_parser.add_argument('--scoring_model_name', type=str, required=True, help='Name of the LLM model to use for scoring abstracts (e.g., o3)')
+    score_parser.add_argument('--no_score_prefix', action="store_true", help='Send the scoring protocol again for every abstract instead of replaying its first exchange')
     add_common_args(score_parser)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Run screen, score and extract in one process (relevant abstracts are scored and extracted while the rest is screened)")
+    pipeline_parser.add_argument('--screening_model_name', type=str, required=False, help='Name of the LLM model to use for prescreening (default: --model_name)')
+    add_extraction_args(pipeline_parser)
+    pipeline_parser.add_argument('--queue_size', type=int, required=False, default=16, help='Maximal number of abstracts waiting between two stages')
+    add_common_args(pipeline_parser)
+
+    lexicon_parser = subparsers.add_parser("lexicon", help="Export or import the unification lexicon for curation")
+    lexicon_parser.add_argument('--lexicon_file', type=str, required=True, help='SQLite file of the unification lexicon')
+    lexicon_parser.add_argument('--export', type=str, required=False, help='Write all entries to this CSV file')
+    lexicon_parser.add_argument('--import_curated', type=str, required=False, help='Read entries from a CSV file in the export format (rows with curated=1 override the LLM answers)')
+    lexicon_parser.add_argument("--debug", action="store_true", help="Enable debug output")
+
+    merge_parser = subparsers.add_parser("merge", help="Combine the outputs of a run split with --shard into the outputs of an unsharded run")
+    merge_parser.add_argument('--input_file', type=str, required=True, help='Path to the input file of the sharded run')
+    merge_parser.add_argument('--primary_key', type=str, required=True, help='Unique column to serve as primary key')
+    merge_parser.add_argument('--abstract_column', type=str, required=True, help='Name of the column containing abstract')
+    merge_parser.add_argument('--output_dir', type=str, required=True, help='Directory to store the merged output files')
+    merge_parser.add_argument('--shards', type=int, required=True, help='Number of shards (N of --shard i/N)')
+    merge_parser.add_argument('--shard_dirs', type=str, nargs='+', required=False, help='Directories with the outputs of the shards (default: --output_dir)')
+    merge_parser.add_argument("--debug", action="store_true", help="Enable debug output")
     
     args = parser.parse_args()
+    if hasattr(args, 'api_retries'):
+        args.api_retries = dict(args.api_retries)
 
     setup_logging(args.debug)
     logger.debug('Debug mode ON')
 
+    if args.mode == 'lexicon':
+        if not os.path.isfile(args.lexicon_file):
+            print(f"Error: Lexicon file '{args.lexicon_file}' does not exist.", file=sys.stderr)
+            sys.exit(1)
+        lexicon = Lexicon(args.lexicon_file)
+        if args.import_curated:
+            print(f'Imported {lexicon.import_csv(args.import_curated)} entries from "{args.import_curated}"')
+        if args.export:
+            print(f'Exported {lexicon.export_csv(args.export)} entries to "{args.export}"')
+        sys.exit(0)
+
+    if args.mode == 'merge':
+        for path in [args.output_dir] + (args.shard_dirs or []):
+            if not os.path.isdir(path):
+                print(f"Error: Directory '{path}' does not exist.", file=sys.stderr)
+                sys.exit(1)
+        complete = merge_shards(args.input_file, args.primary_key, args.abstract_column, args.output_dir, args.shards, args.shard_dirs or [args.output_dir])
+        print('Merge complete.' if complete else 'Merge incomplete.')
+        sys.exit(0 if complete else 1)
+
+    if args.record and args.replay:
+        print("Error: --record and --replay cannot be used together.", file=sys.stderr)
+        sys.exit(1)
+    if args.replay and not os.path.isfile(args.replay):
+        print(f"Error: Cassette file '{args.replay}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+
     llm_parameters = {'seed': args.seed, 'temperature': args.temperature,
                       'reasoning_effort': args.reasoning_effort, 'verbosity': args.verbosity}
 
@@ -162,218 +1015,309 @@ if __name__ == '__main__':
     PKEY = args.primary_key
     ACOL = args.abstract_column
 
+    ifnb = output_basename(args)
+
     if args.mode == 'screen':
         llm = get_LLM(args.model_name, args)
 
-        original_data = read_data(args.input_file)
+        original_data = select_shard(read_data(args.input_file), args)
         data = original_data[[PKEY, ACOL]].copy()
         data = data.set_index(PKEY)
 
-        error_data = []
-        results = []
-
-        # for pk, row in data.iterrows():
-        for pk, row in tqdm(data.iterrows(), total=len(data)):            
-            abstract = row[ACOL]
-            # try n_repeats fimes to get over some erratic one-time-only behaviour of LLMs
-            for cnt in range(args.n_repeats):
-                try:
-                    llm.reset()
-                    score = lepamtic.prescreen(llm, abstract, **llm_parameters)[0]
-                except JSONDecodeError as e:
-                    print(e)
-                    print(f'Error, attempt {cnt+1} of {args.n_repeats}')
+        journal, sink, todo = open_journal_and_sink(os.path.join(args.output_dir, f"{ifnb}__screen_journal.jsonl"),
+                                                    os.path.join(args.output_dir, f"{ifnb}__screened.{args.sink_format}"),
+                                                    [PKEY, 'abstract_relevance', 'abstract_relevance_explanation'], data, args, overwrite=True)
+
+        def write_outputs():
+            entries = {pk: entry for pk, entry in journal.load().items() if pk in data.index}
+            results, error_data = journal_results(entries, PKEY)
+            write_screening_results(original_data, results, error_data, args)
+
+        if args.batch:
+            conversations = {pk: lepamtic.prescreen_turns(row[ACOL]) for pk, row in todo.iterrows()}
+            answers, failed = run_batch_conversations(get_batch_runner(llm, args), 'screen', conversations, args.n_repeats, **llm_parameters)
+            for pk in todo.index:
+                if answers.get(pk):
+                    score = answers[pk][0]
+                    record_result(journal, sink, pk, {'abstract_relevance': score['relevance'], 'abstract_relevance_explanation': score['comment']}, PKEY)
                 else:
-                    results.append({PKEY: pk, 'abstract_relevance': score['relevance'], 'abstract_relevance_explanation': score['comment']})
-                    break
-            else:
-                store_error(error_data)                
-                print(f'Error while screening {pk}')
-                continue
-
-            # write every results into output files
-            results_df = pd.DataFrame(results).set_index(PKEY)
-            merged_data = original_data.set_index(PKEY)
-            output_df = merged_data.merge(results_df, how='left', left_index=True, right_index=True)
-            output_df = output_df.reset_index()
-            
-            ifn = os.path.split(args.input_file)[1]
-            ifnb, ifnext = os.path.splitext(ifn)
-            output_df[output_df['abstract_relevance']==1].to_csv(os.path.join(args.output_dir, f"{ifnb}__relevance_1.csv"), index=False)
-            output_df[output_df['abstract_relevance']==0].to_csv(os.path.join(args.output_dir, f"{ifnb}__relevance_0.csv"), index=False)    
-
-            errors_df = pd.DataFrame(error_data)
-            if len(errors_df):
-                errors_df.to_excel(os.path.join(args.output_dir, f"{ifnb}__errors.csv"), index=False)
+                    record_result(journal, sink, pk, None, PKEY)
+                    print(f'Error while screening {pk}')
+
+        else:
+            # for pk, row in todo.iterrows():
+            for n, (pk, row) in enumerate(tqdm(todo.iterrows(), total=len(todo)), start=1):
+                result = screen_record(llm, pk, row[ACOL], llm_parameters, args.n_repeats)
+                record_result(journal, sink, pk, result, PKEY)
+                if result is None:
+                    print(f'Error while screening {pk}')
+
+                if args.write_every and n % args.write_every == 0:
+                    write_outputs()
+
+        sink.close()
+        write_outputs()
+        journal.close()
         print('Prescreening complete.')
 
     elif args.mode == 'score':
         scoring_llm = get_LLM(args.scoring_model_name, args)
 
-        original_data = read_data(args.input_file)
+        original_data = select_shard(read_data(args.input_file), args)
         data = original_data[[PKEY, ACOL]].copy()
         data = data.set_index(PKEY)
 
-        error_data = []
-        results = []
-
-        # for pk, row in data.iterrows():
-        for pk, row in tqdm(data.iterrows(), total=len(data)):
-            abstract = row[ACOL]
-            # try n_repeats fimes to get over some erratic one-time-only behaviour of LLMs
-            for cnt in range(args.n_repeats):
-                try:
-                    scoring_llm.reset()
-                    score = lepamtic.extract_score(scoring_llm, abstract, **llm_parameters)[0]
-                except JSONDecodeError as e:
-                    print(e)
-                    print(f'Error, attempt {cnt+1} of {args.n_repeats}')
+        journal, sink, todo = open_journal_and_sink(os.path.join(args.output_dir, f"{ifnb}__score_journal.jsonl"),
+                                                    os.path.join(args.output_dir, f"{ifnb}__score_stream.{args.sink_format}"),
+                                                    [PKEY, 'abstract_score', 'abstract_score_explanation', 'abstract_score_model'], data, args, overwrite=True)
+
+        def write_outputs():
+            entries = {pk: entry for pk, entry in journal.load().items() if pk in data.index}
+            results, error_data = journal_results(entries, PKEY)
+            write_scoring_results(original_data, results, error_data, args)
+
+        if args.batch:
+            conversations = {pk: lepamtic.extract_score_turns(row[ACOL]) for pk, row in todo.iterrows()}
+            answers, failed = run_batch_conversations(get_batch_runner(scoring_llm, args), 'score', conversations, args.n_repeats, **llm_parameters)
+            for pk in todo.index:
+                if answers.get(pk):
+                    score = answers[pk][0]
+                    record_result(journal, sink, pk, {'abstract_score': score['score'], 'abstract_score_explanation': score['score_explanation'],
+                                                      'abstract_score_model': scoring_llm.model}, PKEY)
                 else:
-                    results.append({PKEY: pk, 'abstract_score': score['score'], 'abstract_score_explanation': score['score_explanation']})
-                    break
-            else:
-                store_error(error_data)                
-                print(f'Error while scoring {pk}')
-                continue
-        
-            # write every results into output files
-            results_df = pd.DataFrame(results).set_index(PKEY)
-            merged_data = original_data.set_index(PKEY)
-            output_df = merged_data.merge(results_df, how='left', left_index=True, right_index=True)
-            output_df = output_df.reset_index()
-            
-            ifn = os.path.split(args.input_file)[1]
-            ifnb, ifnext = os.path.splitext(ifn)
-            output_df.to_csv(os.path.join(args.output_dir, f"{ifnb}__scored.csv"), index=False)
-
-            errors_df = pd.DataFrame(error_data)
-            if len(errors_df):
-                errors_df.to_excel(os.path.join(args.output_dir, f"{ifnb}__errors.csv"), index=False)
+                    record_result(journal, sink, pk, None, PKEY)
+                    print(f'Error while scoring {pk}')
+
+        else:
+            # for pk, row in todo.iterrows():
+            for n, (pk, row) in enumerate(tqdm(todo.iterrows(), total=len(todo)), start=1):
+                result = score_record(scoring_llm, pk, row[ACOL], llm_parameters, args.n_repeats, reuse_score_prefix=not args.no_score_prefix)
+                record_result(journal, sink, pk, result, PKEY)
+                if result is None:
+                    print(f'Error while scoring {pk}')
+
+                if args.write_every and n % args.write_every == 0:
+                    write_outputs()
+
+        sink.close()
+        write_outputs()
+        journal.close()
         print('Scoring complete.')
 
-    else: # args.mode == 'extract':
+    elif args.mode == 'pipeline':
+        if args.batch:
+            print("Error: the pipeline mode streams abstracts through all stages and cannot use --batch (run screen, score and extract with --batch instead).", file=sys.stderr)
+            sys.exit(1)
         if not os.path.isfile(args.actor_file):
             print(f"Error: Actor file '{args.actor_file}' does not exist.", file=sys.stderr)
             sys.exit(1)
 
-        # check output files
-        ifp, ifn = os.path.split(args.input_file)
-        ifnb, ifnext = os.path.splitext(ifn)
-        output_fn = os.path.join(args.output_dir, f'{ifnb}__patterns__{args.model_name}__{args.scoring_model_name}.xlsx')
-        err_fn = os.path.join(args.output_dir, f'{ifnb}__errors__{args.model_name}__{args.scoring_model_name}.xlsx')
-
-        if os.path.exists(output_fn):
-            raise FileExistsError(f'Output file "{output_fn}" already exists')
-        if os.path.exists(err_fn):
-            raise FileExistsError(f'Error file "{err_fn}" already exists')
-
-        ##################
-        # The main part is here instead of in a function for easy debugging
-
-        llm = get_LLM(args.model_name, args)
+        # scoring and extraction write the same files as the score and extract modes run on the __relevance_1.csv output of screen
+        relevant_fn = os.path.join(args.output_dir, f"{ifnb}__relevance_1.csv")
+        relevant_args = argparse.Namespace(**{**vars(args), 'input_file': relevant_fn, 'shard': None})
+        relevant_ifnb = output_basename(relevant_args)
+        output_fn, err_fn, journal_fn, sink_fn = extraction_file_names(relevant_args)
+
+        # checked before the screen and score journals are started anew, so a crashed run can still be resumed
+        if not args.resume:
+            if os.path.exists(output_fn):
+                raise FileExistsError(f'Output file "{output_fn}" already exists')
+            if os.path.exists(err_fn):
+                raise FileExistsError(f'Error file "{err_fn}" already exists')
+            if os.path.exists(journal_fn):
+                raise FileExistsError(f'Journal file "{journal_fn}" already exists (use --resume to continue the run)')
+
+        screening_llm = get_LLM(args.screening_model_name or args.model_name, args)
         scoring_llm = get_LLM(args.scoring_model_name, args)
-
         unified_actors = pd.read_csv(args.actor_file, header=None)[0].to_list()
-
-        data = read_data(args.input_file)
-        data = data[[PKEY, ACOL]].copy()
-        data = data.set_index(PKEY)
-
-        error_data = []
-        result_dfs = []
-        # for pk, row in data.iterrows():
-        for pk, row in tqdm(data.iterrows(), total=len(data)):
-
-            abstract = row[ACOL]
-
-            # try every step n_repeats fimes to get over some erratic one-time-only behaviour of LLMs
-            for cnt in range(args.n_repeats):
-                try:
-                    scoring_llm.reset()
-                    score = lepamtic.extract_score(scoring_llm, abstract, **llm_parameters)[0]
-                except JSONDecodeError as e:
-                    print(e)
-                    print(f'Error, attempt {cnt+1} of {args.n_repeats}')
-                else:
-                    break
+        lexicon = Lexicon(args.lexicon_file, min_count=args.lexicon_min_count) if args.lexicon_file else None
+
+        screen_journal, screen_sink, screened = open_journal_and_sink_for_stream(os.path.join(args.output_dir, f"{ifnb}__screen_journal.jsonl"),
+                                                                                 os.path.join(args.output_dir, f"{ifnb}__screened.{args.sink_format}"),
+                                                                                 [PKEY, 'abstract_relevance', 'abstract_relevance_explanation'], args, overwrite=True)
+        score_journal, score_sink, scored = open_journal_and_sink_for_stream(os.path.join(args.output_dir, f"{relevant_ifnb}__score_journal.jsonl"),
+                                                                             os.path.join(args.output_dir, f"{relevant_ifnb}__score_stream.{args.sink_format}"),
+                                                                             [PKEY, 'abstract_score', 'abstract_score_explanation', 'abstract_score_model'], args, overwrite=True)
+        journal, sink, extracted = open_journal_and_sink_for_stream(journal_fn, sink_fn, extraction_columns(PKEY), args)
+
+        def write_outputs():
+            # the whole input table is only needed for the screening tables
+            original_data = select_shard(read_data(args.input_file), args)
+            positions = set(original_data[PKEY])
+            results, error_data = journal_results({pk: entry for pk, entry in screen_journal.load().items() if pk in positions}, PKEY)
+            if not results:
+                return
+            write_screening_results(original_data, results, error_data, args)
+
+            relevant_data = read_data(relevant_fn)
+            positions = {pk: i for i, pk in enumerate(relevant_data[PKEY])}
+            results, error_data = journal_results({pk: entry for pk, entry in score_journal.load().items() if pk in positions}, PKEY)
+            if results:
+                write_scoring_results(relevant_data, results, error_data, relevant_args)
+            entries = {pk: entry for pk, entry in journal.load().items() if pk in positions}
+            write_extraction_results(entries, positions, PKEY, output_fn, err_fn)
+
+        def records():
+            for pk, abstract in InputReader(args.input_file, PKEY, ACOL):
+                if in_shard(pk, args.shard):
+                    yield pk, abstract
+
+        # every stage runs in its own thread with its own dialog (see pipeline.run_stages())
+        def screen_stage(record):
+            pk, abstract = record
+            if pk in screened:
+                status, result = screened[pk]
             else:
-                store_error(error_data)                
-                print(f'Error while scoring {pk}')
-                continue
-
-
-            for cnt in range(args.n_repeats):
-                try:
-                    llm.reset()
-                    patterns_df = pd.DataFrame(lepamtic.extract_patterns(llm, abstract, **llm_parameters))
-                    patterns_df.insert(0, PKEY, pk)
-                except JSONDecodeError as e:
-                    print(e)
-                    print(f'Error, attempt {cnt+1} of {args.n_repeats}')
-                else:
-                    break
-            else:
-                store_error(error_data)                
-                print(f'Error while finding patterns for {pk}')
-                continue
-
-            if patterns_df.empty:
-                continue
-
-            for cnt in range(args.n_repeats):
-                try:
-                    llm.reset()
-                    actor_sentence_dicts = patterns_df[['actor', 'sentences']].to_dict(orient="records")
-                    uactors_df = pd.DataFrame(lepamtic.unify_actors(llm, actor_sentence_dicts, unified_actors, **llm_parameters))
-                    patterns_df.insert(7, 'actor_unified', uactors_df['actor_unified'])
-                except JSONDecodeError as e:
-                    print(e)
-                    print(f'Error, attempt {cnt+1} of {args.n_repeats}')
-                else:
-                    break
+                result = screen_record(screening_llm, pk, abstract, llm_parameters, args.n_repeats)
+                record_result(screen_journal, screen_sink, pk, result, PKEY)
+                if result is None:
+                    print(f'Error while screening {pk}')
+            if result is not None and result['abstract_relevance'] == 1:
+                yield pk, abstract
+
+        def score_stage(record):
+            pk, abstract = record
+            if pk in scored:
+                status, result = scored[pk]
             else:
-                store_error(error_data)                
-                print(f'Error while unifying actors for {pk}')
-                continue
-
-            for cnt in range(args.n_repeats):
-                try:
-                    llm.reset()
-                    property_sentence_dicts = patterns_df[['property', 'sentences']].to_dict(orient="records")
-                    uproperties_df = pd.DataFrame(lepamtic.unify_property(llm, property_sentence_dicts, lepamtic.unified_properties, **llm_parameters))
-                    patterns_df.insert(6, 'property_unified', uproperties_df['property_unified'])
-                except JSONDecodeError as e:
-                    print(e)
-                    print(f'Error, attempt {cnt+1} of {args.n_repeats}')
-                else:
-                    break
-            else:
-                store_error(error_data)                
-                print(f'Error while unifying property for {pk}')
-                continue
-
-            patterns_df.insert(len(patterns_df.columns), 'score', score['score'])
-            patterns_df.insert(len(patterns_df.columns), 'score_explanation', score['score_explanation'])
-            result_dfs.append(patterns_df)
+                result = score_record(scoring_llm, pk, abstract, llm_parameters, args.n_repeats, reuse_score_prefix=not args.no_score_prefix)
+                record_result(score_journal, score_sink, pk, result, PKEY)
+                if result is None:
+                    print(f'Error while scoring {pk}')
+            if pk not in extracted:
+                # like the extract mode, an abstract which could not be scored is scored again during extraction
+                score = None if result is None else {'score': result['abstract_score'], 'score_explanation': result['abstract_score_explanation']}
+                yield pk, abstract, score
+
+        def process(pk, abstract, score):
+            llm = get_worker_LLM('extract', args.model_name, args)
+            scoring_llm = get_worker_LLM('score', args.scoring_model_name, args) if score is None else None
+            property_llm = None if args.sequential_stages else get_worker_LLM('unify_property', args.model_name, args)
+            return extract_abstract(pk, abstract, llm, scoring_llm, unified_actors, llm_parameters, args.n_repeats, PKEY,
+                                    score=score, chain=args.chain, reuse_score_prefix=not args.no_score_prefix,
+                                    unify=not args.unify_batch_size, lexicon=lexicon, property_llm=property_llm,
+                                    concurrent_stages=not args.sequential_stages, min_score=args.min_score, split_by=args.split_conjuncts)
+
+        relevant = run_stages(records(), [screen_stage, score_stage], queue_size=args.queue_size)
+        try:
+            run_extraction(relevant, process, journal, sink, unified_actors, llm_parameters, args, lexicon=lexicon, write_outputs=write_outputs)
+        finally:
+            relevant.close()
+
+        for finished in [screen_sink, score_sink, sink]:
+            finished.close()
+        write_outputs()
+        for finished in [screen_journal, score_journal, journal]:
+            finished.close()
+        print('Pipeline complete.')
+        if lexicon is not None:
+            print(lexicon.stats())
 
+    else: # args.mode == 'extract':
+        if not os.path.isfile(args.actor_file):
+            print(f"Error: Actor file '{args.actor_file}' does not exist.", file=sys.stderr)
+            sys.exit(1)
 
-            # write every results into output files
-            if result_dfs:
-                columns = set(result_dfs[0].columns)
-                for df in result_dfs[1:]:
-                    if set(df.columns) != columns:
-                        print('ERROR: columns do not match across all extraction results! NaNs will be present after concatenation.')
+        # check output files
+        output_fn, err_fn, journal_fn, sink_fn = extraction_file_names(args)
 
-            patterns_df = pd.concat(result_dfs, ignore_index=True)
-            errors_df = pd.DataFrame(error_data)
+        if not args.resume:
+            if os.path.exists(output_fn):
+                raise FileExistsError(f'Output file "{output_fn}" already exists')
+            if os.path.exists(err_fn):
+                raise FileExistsError(f'Error file "{err_fn}" already exists')
 
-            patterns_df.to_excel(output_fn, index=False)
-            if len(errors_df):
-                errors_df.to_excel(err_fn, index=False)
+        ##################
+        # The main part is here instead of in a function for easy debugging
+        # (see extract_abstract() for the per-abstract chain)
 
-        # if there were only errors nothing was written so let's do it again
-        errors_df = pd.DataFrame(error_data)
-        if len(errors_df):
-            errors_df.to_excel(err_fn, index=False)
+        # every worker thread creates its own dialogs (one per stage which can run at the same time, see extract_abstract())
+        get_worker_LLM('extract', args.model_name, args)
+        get_worker_LLM('score', args.scoring_model_name, args)
 
+        unified_actors = pd.read_csv(args.actor_file, header=None)[0].to_list()
+        lexicon = Lexicon(args.lexicon_file, min_count=args.lexicon_min_count) if args.lexicon_file else None
+
+        # the input is streamed: abstracts are processed while the file is still being read
+        reader = InputReader(args.input_file, PKEY, ACOL)
+        journal, sink, done = open_journal_and_sink_for_stream(journal_fn, sink_fn, extraction_columns(PKEY), args)
+
+        # the output keeps the order of the input
+        positions = {}
+
+        def records():
+            for pk, abstract in reader:
+                if not in_shard(pk, args.shard):
+                    continue
+                positions[pk] = len(positions)
+                if pk not in done:
+                    yield pk, abstract
+
+        def write_outputs():
+            entries = {pk: entry for pk, entry in journal.load().items() if pk in positions}
+            write_extraction_results(entries, positions, PKEY, output_fn, err_fn)
+
+        # reuse the results of the score mode
+        precomputed_scores = {}
+        scores_fn = find_scores_file(args, ifnb)
+        if scores_fn:
+            precomputed_scores = scores_of_model(load_scores(scores_fn, PKEY), scores_fn, args.scoring_model_name, explicit=bool(args.scores_file))
+            print(f'Using precomputed scores of {len(precomputed_scores)} abstract(s) from "{scores_fn}"')
+
+        def process(pk, abstract):
+            llm = get_worker_LLM('extract', args.model_name, args)
+            scoring_llm = get_worker_LLM('score', args.scoring_model_name, args)
+            property_llm = None if args.sequential_stages else get_worker_LLM('unify_property', args.model_name, args)
+            return extract_abstract(pk, abstract, llm, scoring_llm, unified_actors, llm_parameters, args.n_repeats, PKEY,
+                                    score=precomputed_scores.get(str(pk)), chain=args.chain, reuse_score_prefix=not args.no_score_prefix,
+                                    unify=not args.unify_batch_size, lexicon=lexicon, property_llm=property_llm,
+                                    concurrent_stages=not args.sequential_stages, min_score=args.min_score, split_by=args.split_conjuncts)
+
+        if args.batch:
+            todo = pd.DataFrame(list(records()), columns=[PKEY, ACOL]).set_index(PKEY)
+            result_dfs, failed = extract_batch(todo, get_worker_LLM('extract', args.model_name, args), get_worker_LLM('score', args.scoring_model_name, args),
+                                               unified_actors, llm_parameters, args, precomputed_scores=precomputed_scores, lexicon=lexicon)
+            failed = set(failed)
+            for pk in todo.index:
+                if pk in failed:
+                    record_result(journal, sink, pk, None, PKEY)
+                else:
+                    record_result(journal, sink, pk, result_dfs[pk].to_dict(orient='records') if pk in result_dfs else [], PKEY)
+
+        elif args.order_by_score:
+            todo = list(records())
+            unscored = [(pk, abstract) for pk, abstract in todo if str(pk) not in precomputed_scores]
+
+            def score(pk, abstract):
+                scoring_llm = get_worker_LLM('score', args.scoring_model_name, args)
+                return score_record(scoring_llm, pk, abstract, llm_parameters, args.n_repeats, reuse_score_prefix=not args.no_score_prefix)
+
+            for (pk, abstract), result in tqdm(run_workers(score, unscored, args.workers), total=len(unscored), desc='Scoring'):
+                if result is not None:
+                    precomputed_scores[str(pk)] = {'score': result['abstract_score'], 'score_explanation': result['abstract_score_explanation']}
+            # abstracts which could not be scored come last and are scored again during extraction
+            todo = order_by_score(todo, precomputed_scores)
+            run_extraction(todo, process, journal, sink, unified_actors, llm_parameters, args, lexicon=lexicon, total=len(todo), write_outputs=write_outputs)
+
+        else:
+            total = reader.n_rows - len(done) if reader.n_rows is not None and args.shard is None else None
+            run_extraction(records(), process, journal, sink, unified_actors, llm_parameters, args, lexicon=lexicon, total=total, write_outputs=write_outputs)
+
+        sink.close()
+        write_outputs()
+        journal.close()
         print('Extraction complete.')
+        if lexicon is not None:
+            print(lexicon.stats())
+
+    if (summary := usage_summary()):
+        print(summary)
+    if _metrics is not None and (summary := _metrics.summary()):
+        print(f'LLM calls per stage (metrics in "{_metrics.path}"):')
+        print(summary)
+        _metrics.close()
+    if args.cache_dir:
+        print(get_LLM_cache(args).stats())
+    if (cassette := get_LLM_cassette(args)) is not None:
+        print(cassette.stats())
+        cassette.close()
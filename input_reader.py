@@ -0,0 +1,115 @@
+import os
+import hashlib
+import logging
+
+import pandas as pd
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+
+def key_hash(key):
+    '''Stable 64-bit hash of a primary key (the same on every machine and in every run).'''
+    return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def is_missing(value):
+    return value is None or value == '' or (not isinstance(value, str) and pd.isna(value))
+
+
+class KeySet:
+    '''A compact set of primary keys which keeps an 8-byte hash of every key instead of the key itself.
+
+    Two different keys are mistaken for duplicates only if their 64-bit hashes collide, which is
+    practically impossible for the sizes of bibliographic exports.
+    '''
+    def __init__(self):
+        self.hashes = set()
+
+    def add(self, key):
+        '''Add the key and return False if it was already in the set.'''
+        digest = key_hash(key)
+        if digest in self.hashes:
+            return False
+        self.hashes.add(digest)
+        return True
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class InputReader:
+    '''Streams (primary key, abstract) records from a CSV or Excel file without loading the whole table.
+
+    CSV files are read in chunks of `chunksize` rows, .xlsx files row by row with openpyxl in read-only
+    mode (old .xls files are read at once). Only the primary key and abstract columns are kept. Records are
+    validated while they are read: empty abstracts are skipped (and counted in `n_empty`), an empty or
+    repeated primary key raises SyntaxError as soon as it is reached, so processing can start before the
+    whole file is parsed.
+    '''
+    def __init__(self, path, pkey, acol, chunksize=10000):
+        self.path = path
+        self.pkey = pkey
+        self.acol = acol
+        self.chunksize = chunksize
+        self.format = os.path.splitext(path)[1].lower().lstrip('.')
+        if self.format not in ('csv', 'xls', 'xlsx'):
+            raise SyntaxError(f'Unsupported input file format "{self.format}" (use csv, xls or xlsx)')
+        self.n_rows = None  # number of rows if it is known in advance (including empty abstracts)
+        self.n_empty = 0
+
+    def check_columns(self, columns):
+        if self.acol not in columns:
+            raise SyntaxError(f'Abstract column "{self.acol}" not present')
+        if self.pkey not in columns:
+            raise SyntaxError(f'Primary key column "{self.pkey}" not present')
+
+    def read_csv(self):
+        self.check_columns(pd.read_csv(self.path, nrows=0).columns)
+        with pd.read_csv(self.path, usecols=[self.pkey, self.acol], chunksize=self.chunksize) as chunks:
+            for chunk in chunks:
+                yield from zip(chunk[self.pkey].tolist(), chunk[self.acol].tolist())
+
+    def read_xls(self):
+        df = pd.read_excel(self.path)
+        self.check_columns(df.columns)
+        self.n_rows = len(df)
+        yield from zip(df[self.pkey].tolist(), df[self.acol].tolist())
+
+    def read_xlsx(self):
+        try:
+            import openpyxl
+        except ImportError:
+            raise ImportError('Reading .xlsx files needs the openpyxl package (pip install openpyxl)')
+        workbook = openpyxl.load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            if sheet.max_row:
+                self.n_rows = sheet.max_row - 1
+            rows = sheet.iter_rows(values_only=True)
+            header = [str(name) if name is not None else None for name in next(rows, ())]
+            self.check_columns(header)
+            pk_index, abstract_index = header.index(self.pkey), header.index(self.acol)
+            for row in rows:
+                if row is None or all(value is None for value in row):
+                    continue  # formatted but otherwise empty rows are not records
+                row = tuple(row) + (None,) * (len(header) - len(row))
+                yield row[pk_index], row[abstract_index]
+        finally:
+            workbook.close()
+
+    def __iter__(self):
+        rows = {'csv': self.read_csv, 'xls': self.read_xls, 'xlsx': self.read_xlsx}[self.format]()
+        keys = KeySet()
+        self.n_empty = 0
+        for pk, abstract in rows:
+            if is_missing(abstract):
+                self.n_empty += 1
+                continue
+            if is_missing(pk):
+                raise SyntaxError(f'Primary key column "{self.pkey}" contains empty cells')
+            if not keys.add(pk):
+                raise SyntaxError(f'Primary key column "{self.pkey}" contains duplicates ("{pk}")')
+            yield pk, abstract
+        if self.n_empty > 0:
+            print(f'Warning: {self.n_empty} empty abstract(s) ignored!')
@@ -0,0 +1,67 @@
+import os
+import json
+import logging
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+
+def to_builtin(value):
+    '''json.dumps() default for numpy/pandas scalars.'''
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def read_journal(path):
+    '''Return a dict primary key -> (status, data) of all entries of a journal file (later entries win).'''
+    entries = {}
+    with open(path, encoding='utf-8') as fp:
+        for i, line in enumerate(fp):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be incomplete if the run was killed while writing it
+                logger.warning(f'Ignoring invalid line {i+1} in journal "{path}"')
+                continue
+            entries[entry['pk']] = (entry['status'], entry.get('data'))
+    return entries
+
+
+class Journal:
+    '''An append-only JSONL record of processed abstracts, one line per primary key.
+
+    Every line is written (and flushed) as soon as the abstract is finished or failed, so a crashed
+    run can be resumed by skipping the primary keys which are already in the journal.
+    '''
+    OK = 'ok'
+    ERROR = 'error'
+
+    def __init__(self, path, resume=False, overwrite=False):
+        '''Open the journal at path. An existing journal is continued with resume, started anew with overwrite
+        (like the outputs of the screen and score modes) and refused otherwise.'''
+        self.path = path
+        if os.path.exists(path) and not resume and not overwrite:
+            raise FileExistsError(f'Journal file "{path}" already exists (use --resume to continue the run)')
+        self.fp = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if self.fp.tell() > 0:
+            with open(path, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b'\n':
+                    self.fp.write('\n')  # do not continue an incomplete last line
+
+    def load(self):
+        '''Return a dict primary key -> (status, data) of all journal entries (later entries win).'''
+        self.fp.flush()
+        return read_journal(self.path)
+
+    def record(self, pk, status, data=None):
+        self.fp.write(json.dumps({'pk': pk, 'status': status, 'data': data}, default=to_builtin) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
@@ -0,0 +1,116 @@
+import re
+import csv
+import json
+import sqlite3
+import hashlib
+import threading
+import logging
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+EXPORT_COLUMNS = ['field', 'targets', 'term', 'unified', 'count', 'curated']
+
+
+def normalize_term(term):
+    '''Normalized surface string of an extracted actor or property (case, whitespace and surrounding punctuation are ignored).'''
+    return re.sub(r'\s+', ' ', str(term)).strip(' \t\'".,;:').lower()
+
+
+def targets_key(unified_list):
+    '''Short key of a list of unified names (the order of the list does not matter).'''
+    data = json.dumps(sorted(map(str, unified_list)), ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:12]
+
+
+class Lexicon:
+    '''A persistent record of unification answers stored in SQLite.
+
+    Answers are keyed by the pattern field ("actor" or "property"), the list of unified names and the
+    normalized extracted term. A term is answered locally if it was unified to the same name at least
+    `min_count` times and never to a different one, or if its mapping was curated (see import_csv()).
+    The lexicon can be shared by all threads of a process.
+    '''
+    def __init__(self, path, min_count=2):
+        self.path = path
+        self.min_count = min_count
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS lexicon (field TEXT, targets TEXT, term TEXT, unified TEXT,
+                           count INTEGER, curated INTEGER, PRIMARY KEY (field, targets, term, unified))''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS target_lists (targets TEXT PRIMARY KEY, names TEXT)')
+        self.db.commit()
+
+    def register_targets(self, unified_list):
+        key = targets_key(unified_list)
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO target_lists VALUES (?, ?)', (key, json.dumps(list(unified_list), ensure_ascii=False)))
+            self.db.commit()
+        return key
+
+    def lookup(self, field, unified_list, terms):
+        '''Return a dict term -> unified name for the terms which can be answered locally.'''
+        key = targets_key(unified_list)
+        known = {}
+        with self.lock:
+            for term in set(terms):
+                rows = self.db.execute('SELECT unified, count, curated FROM lexicon WHERE field = ? AND targets = ? AND term = ?',
+                                       (field, key, normalize_term(term))).fetchall()
+                curated = [unified for unified, count, is_curated in rows if is_curated]
+                if curated:
+                    known[term] = curated[0]
+                elif len(rows) == 1 and rows[0][1] >= self.min_count:
+                    known[term] = rows[0][0]
+            n_terms = len(terms)
+            n_known = sum(term in known for term in terms)
+            self.hits += n_known
+            self.misses += n_terms - n_known
+        return known
+
+    def add(self, field, unified_list, mapping):
+        '''Record the answers of the LLM (a dict term -> unified name).'''
+        if not mapping:
+            return
+        key = self.register_targets(unified_list)
+        with self.lock:
+            for term, unified in mapping.items():
+                self.db.execute('''INSERT INTO lexicon VALUES (?, ?, ?, ?, 1, 0)
+                                   ON CONFLICT (field, targets, term, unified) DO UPDATE SET count = count + 1''',
+                                (field, key, normalize_term(term), str(unified)))
+            self.db.commit()
+
+    def export_csv(self, path):
+        '''Write all entries to a CSV file for curation. Returns the number of entries.'''
+        with self.lock:
+            rows = self.db.execute(f'SELECT {", ".join(EXPORT_COLUMNS)} FROM lexicon ORDER BY field, targets, term, count DESC').fetchall()
+        with open(path, 'w', encoding='utf-8', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(EXPORT_COLUMNS)
+            writer.writerows(rows)
+        return len(rows)
+
+    def import_csv(self, path):
+        '''Read entries from a (curated) CSV file in the export format.
+
+        Rows with a true "curated" value replace all other answers for their term. Returns the number of rows read.
+        '''
+        with open(path, encoding='utf-8', newline='') as fp:
+            rows = list(csv.DictReader(fp))
+        with self.lock:
+            for row in rows:
+                term = normalize_term(row['term'])
+                curated = str(row.get('curated', '')).strip().lower() in ('1', 'true', 'yes', 'y')
+                if curated:
+                    self.db.execute('DELETE FROM lexicon WHERE field = ? AND targets = ? AND term = ?', (row['field'], row['targets'], term))
+                self.db.execute('INSERT OR REPLACE INTO lexicon VALUES (?, ?, ?, ?, ?, ?)',
+                                (row['field'], row['targets'], term, row['unified'], int(row.get('count') or 1), int(curated)))
+            self.db.commit()
+        return len(rows)
+
+    def stats(self):
+        with self.lock:
+            n_entries = self.db.execute('SELECT COUNT(*) FROM lexicon').fetchone()[0]
+        return f'Unification lexicon: {self.hits} term(s) answered locally, {self.misses} sent to the LLM, {n_entries} entries in {self.path}'
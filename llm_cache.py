@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+
+class ResponseCache:
+    '''A persistent, content-addressed cache of chat completion responses stored in SQLite.
+
+    Responses are keyed by a hash of the base URL, model, the full list of messages and the call
+    parameters. When the stored responses exceed `max_size` bytes the least recently used ones are evicted.
+    The cache can be shared by all dialogs (and threads) of a process.
+    '''
+    def __init__(self, cache_dir, max_size=1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'responses.sqlite'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def __reduce__(self):
+        # dialogs are pickled with ChatDialog.save(); the loaded dialog gets the shared cache of this process
+        return get_response_cache, (self.cache_dir, self.max_size)
+
+    @staticmethod
+    def key(base_url, model, messages, kwargs):
+        data = json.dumps([base_url, model, messages, kwargs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''Return the cached response (a dict in the chat completion format) or None.'''
+        with self.lock:
+            row = self.db.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        response = json.dumps(response, ensure_ascii=False)
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, response, size, time.time()))
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_size:
+                self.evict()
+            self.db.commit()
+
+    def delete(self, key):
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= old[0]
+                self.db.commit()
+
+    def evict(self):
+        '''Remove the least recently used responses until the cache is below 90% of max_size.'''
+        target = 0.9 * self.max_size
+        removed = 0
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall():
+            if self.size <= target:
+                break
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.size -= size
+            removed += 1
+        logger.debug(f'Cache: evicted {removed} response(s)')
+
+    def stats(self):
+        return f'LLM cache: {self.hits} hit(s), {self.misses} miss(es), {self.size / 1024**2:.1f} MB in {self.cache_dir}'
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_response_cache(cache_dir, max_size=1024**3):
+    '''Return the cache shared by all dialogs of the process which use cache_dir.'''
+    cache_dir = os.path.abspath(cache_dir)
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = ResponseCache(cache_dir, max_size=max_size)
+        return _caches[cache_dir]
@@ -0,0 +1,174 @@
+import json
+import math
+import threading
+import contextlib
+import contextvars
+import logging
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+# estimated USD per million tokens: (input, cached input, output); the longest matching model name prefix is used
+DEFAULT_PRICES = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'gpt-4.1-nano': (0.10, 0.025, 0.40),
+    'gpt-5': (1.25, 0.125, 10.00),
+    'gpt-5-mini': (0.25, 0.025, 2.00),
+    'gpt-5-nano': (0.05, 0.005, 0.40),
+    'o1': (15.00, 7.50, 60.00),
+    'o3': (2.00, 0.50, 8.00),
+    'o3-mini': (1.10, 0.55, 4.40),
+    'o4-mini': (1.10, 0.275, 4.40),
+    'gemini-2.5-pro': (1.25, 0.31, 10.00),
+    'gemini-2.5-flash': (0.30, 0.075, 2.50),
+    'gemini-2.0-flash': (0.10, 0.025, 0.40),
+}
+
+# share of the prices paid for requests of the Batch API (OpenAI and Gemini bill them at half price)
+BATCH_DISCOUNT = 0.5
+
+FIELDS = ['pk', 'stage', 'turn', 'attempt', 'repair', 'model', 'seconds', 'wait_seconds', 'prompt_tokens', 'cached_tokens', 'completion_tokens',
+          'reasoning_tokens', 'retries', 'from_cache', 'batch', 'error']
+
+_tags = contextvars.ContextVar('lepamtic_metrics_tags', default={})
+
+
+@contextlib.contextmanager
+def tagged(**tags):
+    '''Tag all LLM calls made in the block (in this thread or task), e.g., with pk=... and stage="patterns".
+
+    The prompt chains tag their calls with the turn of the chain, the attempt of the turn (0 for the first
+    one, see LEPAMTIC.ask_JSONL()) and the number of the repair call of invalid lines (0 for the answer itself).
+    '''
+    token = _tags.set({**_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def call_tags():
+    '''The tags of the calls made at this point (see tagged()).'''
+    return _tags.get()
+
+
+def percentile(values, q):
+    '''Nearest-rank percentile (q in 0-100) of a non-empty list.'''
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def model_prices(model, prices):
+    matches = [name for name in prices if model.startswith(name)]
+    return prices[max(matches, key=len)] if matches else None
+
+
+def usage_tokens(usage):
+    '''Return (prompt, cached, completion, reasoning) tokens of an API usage object (zeros if it is missing).'''
+    if usage is None:
+        return 0, 0, 0, 0
+    prompt_details = getattr(usage, 'prompt_tokens_details', None)
+    completion_details = getattr(usage, 'completion_tokens_details', None)
+    return (usage.prompt_tokens or 0,
+            (getattr(prompt_details, 'cached_tokens', None) or 0) if prompt_details is not None else 0,
+            usage.completion_tokens or 0,
+            (getattr(completion_details, 'reasoning_tokens', None) or 0) if completion_details is not None else 0)
+
+
+class CallMetrics:
+    '''Records every LLM call of a run and summarizes them per stage.
+
+    Every call (see ChatDialog.ask()) is written as one line to a JSONL file (if `path` is given) with the tags
+    of the enclosing tagged() block, the wall time (without waiting for the rate limiter, which is reported as
+    wait_seconds), the token usage and the number of retries. Answers from the response cache are marked with
+    from_cache and use no tokens. Requests of the Batch API are marked with batch (their time is the time until
+    the batch completed) and are priced with BATCH_DISCOUNT. `prices` maps model name prefixes to (input, cached input, output) USD per
+    million tokens for the cost estimate. One instance can be shared by all dialogs and threads.
+    '''
+    def __init__(self, path=None, prices=None):
+        self.path = path
+        self.prices = dict(DEFAULT_PRICES, **(prices or {}))
+        self.lock = threading.Lock()
+        self.fp = open(path, 'a', encoding='utf-8') if path else None
+        self.calls = []
+
+    def __reduce__(self):
+        # dialogs are pickled with ChatDialog.save(); the loaded dialog gets the shared metrics of this process
+        return get_metrics, (self.path, self.prices)
+
+    def record(self, model, seconds, wait_seconds=0, usage=None, retries=0, from_cache=False, batch=False, error=None):
+        tags = _tags.get()
+        prompt_tokens, cached_tokens, completion_tokens, reasoning_tokens = (0, 0, 0, 0) if from_cache else usage_tokens(usage)
+        call = {'pk': tags.get('pk'), 'stage': tags.get('stage'), 'turn': tags.get('turn'),
+                'attempt': tags.get('attempt', 0), 'repair': tags.get('repair', 0), 'model': model, 'seconds': round(seconds, 3), 'wait_seconds': round(wait_seconds, 3),
+                'prompt_tokens': prompt_tokens, 'cached_tokens': cached_tokens, 'completion_tokens': completion_tokens,
+                'reasoning_tokens': reasoning_tokens, 'retries': retries, 'from_cache': from_cache, 'batch': batch,
+                'error': type(error).__name__ if error is not None else None}
+        with self.lock:
+            self.calls.append(tuple(call[field] for field in FIELDS))
+            if self.fp is not None:
+                self.fp.write(json.dumps(call, default=str) + '\n')
+                self.fp.flush()
+
+    def cost(self, model, prompt_tokens, cached_tokens, completion_tokens, batch=False):
+        '''Estimated USD cost of the tokens or None if the price of the model is not known.'''
+        prices = model_prices(model, self.prices)
+        if prices is None:
+            return None
+        price_in, price_cached, price_out = prices
+        cost = ((prompt_tokens - cached_tokens) * price_in + cached_tokens * price_cached + completion_tokens * price_out) / 1e6
+        return cost * BATCH_DISCOUNT if batch else cost
+
+    def summary(self):
+        '''Return a table with one line per stage (and per turn of stages with several turns): calls, repeated
+        turns, repair calls, p50/p95 latency, tokens per abstract and estimated cost.'''
+        with self.lock:
+            calls = [dict(zip(FIELDS, call)) for call in self.calls]
+        if not calls:
+            return ''
+
+        def line(label, group):
+            api_calls = [call for call in group if not call['from_cache']]
+            latencies = [call['seconds'] for call in api_calls if call['error'] is None]
+            n_abstracts = len({call['pk'] for call in group if call['pk'] is not None}) or 1
+            costs = [self.cost(call['model'], call['prompt_tokens'], call['cached_tokens'], call['completion_tokens'], call['batch']) for call in api_calls]
+            cost = f"{sum(costs):9.4f}" if None not in costs else f"{'n/a':>9}"
+            per_abstract = lambda field: sum(call[field] for call in api_calls) / n_abstracts
+            return (f"{label:<22} {len(group):>6} {sum(call['error'] is not None for call in group):>6} {sum(call['retries'] for call in group):>7} "
+                    f"{sum(call['attempt'] > 0 and call['repair'] == 0 for call in group):>7} {sum(call['repair'] > 0 for call in group):>7} "
+                    f"{percentile(latencies, 50) if latencies else 0:>7.2f} {percentile(latencies, 95) if latencies else 0:>7.2f} "
+                    f"{per_abstract('prompt_tokens'):>10.0f} {per_abstract('completion_tokens'):>10.0f} {per_abstract('reasoning_tokens'):>11.0f} {cost}")
+
+        stages = {}
+        for call in calls:
+            stages.setdefault(call['stage'] or '-', []).append(call)
+        lines = [f"{'stage':<22} {'calls':>6} {'errors':>6} {'retries':>7} {'repeats':>7} {'repairs':>7} {'p50 s':>7} {'p95 s':>7} {'prompt/abs':>10} {'compl./abs':>10} {'reason./abs':>11} {'cost $':>9}"]
+        for stage, group in stages.items():
+            lines.append(line(stage, group))
+            # repair calls have other prompts than their turn and get lines of their own
+            turns = {}
+            for call in group:
+                turns.setdefault((call['turn'], call['repair'] > 0), []).append(call)
+            if len(turns) > 1:
+                lines.extend(line(f'  turn {turn}' + (' repairs' if repair else ''), turns[turn, repair])
+                             for turn, repair in sorted(turns, key=lambda key: (key[0] or 0, key[1])))
+        lines.append(line('total', calls))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def get_metrics(path=None, prices=None):
+    '''Return the metrics shared by all dialogs of the process which write to path.'''
+    with _metrics_lock:
+        if path not in _metrics:
+            _metrics[path] = CallMetrics(path, prices=prices)
+        return _metrics[path]
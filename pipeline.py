@@ -0,0 +1,71 @@
+import queue
+import threading
+import logging
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+_END = object()
+
+
+def run_stages(source, stages, queue_size=16):
+    '''Stream items through a chain of stages which run at the same time.
+
+    Every stage is a function which takes one item and returns an iterable of output items (possibly empty)
+    for the next stage. Every stage runs in its own thread and consecutive stages are connected by queues of
+    at most queue_size items, so a slow stage holds back the ones before it instead of letting items pile up.
+    The source is iterated in the thread of the first stage. The outputs of the last stage are yielded in
+    the calling thread; an exception in any stage stops all of them and is raised there.
+    '''
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def items_of(q):
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def run(stage, inputs, output):
+        try:
+            for item in inputs:
+                for result in stage(item):
+                    if not put(output, result):
+                        return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(output, _END)
+
+    threads = []
+    for i, stage in enumerate(stages):
+        inputs = source if i == 0 else items_of(queues[i-1])
+        threads.append(threading.Thread(target=run, args=(stage, inputs, queues[i]), name=f'stage-{i}', daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        yield from items_of(queues[-1])
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,193 @@
+import re
+import time
+import json
+import asyncio
+import threading
+import logging
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+
+def estimate_tokens(messages):
+    '''A rough estimate of the number of tokens in a list of chat messages (about 4 characters per token).'''
+    n_chars = 0
+    for message in messages:
+        content = message['content']
+        n_chars += len(content) if isinstance(content, str) else len(json.dumps(content))
+    return n_chars // 4 + 4 * len(messages)
+
+
+def parse_duration(text):
+    '''Parse durations used in rate limit headers, e.g., "1s", "20ms", "6m0s" or "0.5" (seconds).'''
+    if text is None:
+        return None
+    text = str(text).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', text)
+    if not parts:
+        return None
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+class TokenBucket:
+    '''A bucket which holds up to `per_minute` units and refills at `per_minute` units per minute.
+
+    Reservations are allowed to take the level below zero. The caller then waits until the
+    bucket refills which gives a fair first come, first served order of the waiting callers.
+    '''
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.timestamp = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.per_minute / 60
+
+    def refill(self, now):
+        self.level = min(self.per_minute, self.level + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def reserve(self, amount, now):
+        '''Take amount from the bucket and return the number of seconds to wait before using it.'''
+        self.refill(now)
+        self.level -= min(amount, self.per_minute)
+        return 0 if self.level >= 0 else -self.level / self.rate
+
+    def set_limit(self, per_minute, now):
+        self.refill(now)
+        self.per_minute = per_minute
+        self.level = min(self.level, per_minute)
+
+
+class RateLimiter:
+    '''Requests per minute (RPM) and tokens per minute (TPM) limits for one model or endpoint.
+
+    A limiter is shared by all dialogs in the process which talk to the same model (see get_rate_limiter())
+    and it is safe to use from threads and coroutines. The limits are taken from the `x-ratelimit-*` headers
+    of the responses (rpm and tpm, if given, cap them) and the calls are paused after a 429 response.
+    '''
+    def __init__(self, key, rpm=None, tpm=None):
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        # dialogs are pickled with ChatDialog.save(); the loaded dialog gets the shared limiter of this process
+        return get_rate_limiter, (self.key, self.rpm, self.tpm)
+
+    def reserve(self, n_tokens):
+        '''Reserve one request and n_tokens tokens. Returns the number of seconds to wait.'''
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.blocked_until - now)
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens:
+                wait = max(wait, self.tokens.reserve(n_tokens, now))
+        if wait > 0:
+            logger.debug(f'Rate limit {self.key}: waiting {wait:.2f}s')
+        return wait
+
+    def acquire(self, n_tokens):
+        wait = self.reserve(n_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, n_tokens):
+        wait = self.reserve(n_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def update(self, headers, reserved_tokens=0, used_tokens=None):
+        '''Correct the token reservation with the actual usage and adapt the limits to the response headers.'''
+        with self.lock:
+            now = time.monotonic()
+            if self.tokens and used_tokens is not None:
+                self.tokens.refill(now)
+                self.tokens.level -= used_tokens - reserved_tokens
+
+            for name, configured in [('requests', self.rpm), ('tokens', self.tpm)]:
+                limit = headers.get(f'x-ratelimit-limit-{name}')
+                remaining = headers.get(f'x-ratelimit-remaining-{name}')
+                if limit is None:
+                    continue
+                try:
+                    limit = int(float(limit))
+                except ValueError:
+                    continue
+                # a limit of 0 (sent for exhausted or restricted keys) means no limit, as --rpm/--tpm 0 does
+                if limit <= 0:
+                    continue
+                # a configured limit is an upper bound (e.g., for a quota shared with other programs)
+                if configured:
+                    limit = min(limit, configured)
+                bucket = getattr(self, name)
+                if bucket is None:
+                    bucket = TokenBucket(limit)
+                    setattr(self, name, bucket)
+                elif bucket.per_minute != limit:
+                    bucket.set_limit(limit, now)
+                if remaining is not None:
+                    try:
+                        bucket.level = min(bucket.level, float(remaining))
+                    except ValueError:
+                        pass
+
+    def penalize(self, headers):
+        '''Pause all calls after a 429 response for the time suggested by the server (1 second by default).
+
+        Returns the length of the pause in seconds.
+        '''
+        wait = None
+        if headers is not None:
+            if headers.get('retry-after-ms') is not None:
+                wait = float(headers['retry-after-ms']) / 1000
+            else:
+                wait = parse_duration(headers.get('retry-after'))
+            if wait is None:
+                waits = [parse_duration(headers.get(f'x-ratelimit-reset-{name}')) for name in ['requests', 'tokens']]
+                waits = [w for w in waits if w is not None]
+                wait = max(waits) if waits else None
+        if wait is None:
+            wait = 1
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + wait)
+        logger.info(f'Rate limit {self.key}: 429 received, pausing for {wait:.2f}s')
+        return wait
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(key, rpm=None, tpm=None):
+    '''Return the limiter shared by all dialogs using key (e.g., base_url and model name).
+
+    rpm and tpm are the configured limits (None for no limit). If the limiter already exists
+    its configured limits are replaced.
+    '''
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(key, rpm=rpm, tpm=tpm)
+        elif (limiter.rpm, limiter.tpm) != (rpm, tpm):
+            with limiter.lock:
+                now = time.monotonic()
+                for attr, value in [('requests', rpm), ('tokens', tpm)]:
+                    if not value:
+                        setattr(limiter, attr, None)
+                    elif getattr(limiter, attr) is None:
+                        setattr(limiter, attr, TokenBucket(value))
+                    else:
+                        getattr(limiter, attr).set_limit(value, now)
+                limiter.rpm, limiter.tpm = rpm, tpm
+    return limiter
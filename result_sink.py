@@ -0,0 +1,79 @@
+import os
+import csv
+import json
+import logging
+
+from journal import to_builtin
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+SINK_FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+class ResultSink:
+    '''Appends result rows (dicts) to a CSV, JSONL or Parquet file in constant time per abstract.
+
+    The format is given by the file extension. CSV and Parquet files have a fixed set of columns:
+    either `columns` or the keys of the first appended row. Rows with other keys are reported and
+    written with the missing values left empty (unknown keys are dropped).
+    '''
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower().lstrip('.')
+        if self.format not in SINK_FORMATS:
+            raise ValueError(f'Unsupported result file format "{self.format}" (use one of {SINK_FORMATS})')
+        self.columns = list(columns) if columns else None
+        self.n_rows = 0
+        self.fp = None
+        self.writer = None
+        self.mismatch_reported = False
+        if self.format == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('Parquet result files need the pyarrow package (pip install pyarrow)')
+            self.pa = pyarrow
+        else:
+            self.fp = open(path, 'w', encoding='utf-8', newline='')
+
+    def check_columns(self, row):
+        if set(row.keys()) != set(self.columns) and not self.mismatch_reported:
+            print(f'ERROR: columns do not match across all extraction results! ({self.path})')
+            self.mismatch_reported = True
+
+    def append(self, rows):
+        if not rows:
+            return
+        if self.columns is None:
+            self.columns = list(rows[0].keys())
+        for row in rows:
+            self.check_columns(row)
+
+        if self.format == 'jsonl':
+            for row in rows:
+                self.fp.write(json.dumps(row, default=to_builtin) + '\n')
+        elif self.format == 'csv':
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.fp, fieldnames=self.columns, extrasaction='ignore')
+                self.writer.writeheader()
+            self.writer.writerows(rows)
+        else:
+            table = self.pa.Table.from_pylist([{c: row.get(c) for c in self.columns} for row in rows])
+            if self.writer is None:
+                # columns without any value in the first rows are assumed to hold strings
+                self.schema = self.pa.schema([self.pa.field(f.name, self.pa.string()) if self.pa.types.is_null(f.type) else f
+                                              for f in table.schema])
+                self.writer = self.pa.parquet.ParquetWriter(self.path, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+        if self.fp is not None:
+            self.fp.flush()
+        self.n_rows += len(rows)
+
+    def close(self):
+        if self.format == 'parquet':
+            if self.writer is not None:
+                self.writer.close()
+        else:
+            self.fp.close()
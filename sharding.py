@@ -0,0 +1,165 @@
+import os
+import argparse
+import logging
+
+import pandas as pd
+
+from input_reader import InputReader, key_hash
+from journal import Journal, read_journal
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+
+def parse_shard(value):
+    '''argparse type of --shard: i/N'''
+    i, sep, n = value.partition('/')
+    if not sep or not i.isdigit() or not n.isdigit() or not 1 <= int(i) <= int(n):
+        raise argparse.ArgumentTypeError(f'"{value}" is not of the form i/N with 1 <= i <= N (e.g., 2/4)')
+    return int(i), int(n)
+
+
+def shard_of(pk, n_shards):
+    '''Number (1 to n_shards) of the shard a primary key belongs to; it only depends on the key and n_shards.'''
+    return key_hash(pk) % n_shards + 1
+
+
+def in_shard(pk, shard):
+    '''True if the primary key belongs to the shard (a tuple (i, N) or None for the whole input).'''
+    return shard is None or shard_of(pk, shard[1]) == shard[0]
+
+
+def shard_tag(shard):
+    '''Part of the output file names of a shard (empty for the whole input).'''
+    return f'__shard{shard[0]}of{shard[1]}' if shard else ''
+
+
+def shard_files(directories, ifnb, n_shards):
+    '''Return a dict suffix -> list of (shard number, path) of the output files of all shards of the input.'''
+    files = {}
+    for directory in directories:
+        for fn in sorted(os.listdir(directory)):
+            path = os.path.join(directory, fn)
+            for i in range(1, n_shards + 1):
+                prefix = ifnb + shard_tag((i, n_shards))
+                if fn.startswith(prefix) and os.path.isfile(path):
+                    files.setdefault(fn[len(prefix):], []).append((i, path))
+    return files
+
+
+def is_journal(suffix):
+    return suffix.endswith('.jsonl') and 'journal' in suffix
+
+
+def is_excel(path):
+    with open(path, 'rb') as fp:
+        return fp.read(4) == b'PK\x03\x04'
+
+
+def read_table(path):
+    # the error tables of screen and score are Excel files with a .csv name, so the content decides
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith('.jsonl'):
+        return pd.read_json(path, lines=True, dtype=False)
+    if is_excel(path):
+        return pd.read_excel(path, engine='openpyxl')
+    return pd.read_csv(path)
+
+
+def write_table(df, path, like):
+    '''Write df to path in the format of the file `like`.'''
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    elif path.endswith('.jsonl'):
+        df.to_json(path, orient='records', lines=True, force_ascii=False)
+    elif is_excel(like):
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def find_duplicates(keys_per_shard):
+    '''Return a dict key -> list of shards for the keys which occur in more than one shard.'''
+    shards = {}
+    for i, keys in keys_per_shard:
+        for key in set(keys):
+            shards.setdefault(key, []).append(i)
+    return {key: found for key, found in shards.items() if len(found) > 1}
+
+
+def merge_shards(input_file, pkey, acol, output_dir, n_shards, directories):
+    '''Combine the outputs (final tables, result files and journals) of the shards of a run into the files of an unsharded run.
+
+    Every primary key of the input must be in the journal of exactly one shard. Duplicated keys stop the merge
+    before anything is written; missing keys are reported and listed in `__missing_keys.csv` (the merged
+    journal can be used with --resume to process them). Returns True if the merged outputs are complete.
+    '''
+    ifnb = os.path.splitext(os.path.split(input_file)[1])[0]
+    positions = {str(pk): n for n, (pk, abstract) in enumerate(InputReader(input_file, pkey, acol))}
+
+    files = shard_files(directories, ifnb, n_shards)
+    if not files:
+        print(f'Error: no output files of {n_shards} shard(s) of "{ifnb}" found in {", ".join(directories)}')
+        return False
+
+    complete = True
+    for suffix, shard_paths in sorted(files.items()):
+        shards = [i for i, path in shard_paths]
+        if len(set(shards)) != len(shards):
+            print(f'Error: more than one "{suffix}" file for shard(s) {sorted({i for i in shards if shards.count(i) > 1})}')
+            return False
+        if absent := sorted(set(range(1, n_shards + 1)) - set(shards)):
+            print(f'Warning: no "{suffix}" file for shard(s) {absent}')
+            complete = False
+
+    # read everything first, nothing is written if a key is duplicated
+    journals = {}
+    tables = {}
+    for suffix, shard_paths in files.items():
+        if is_journal(suffix):
+            journals[suffix] = [(i, {str(pk): (pk, entry) for pk, entry in read_journal(path).items()}) for i, path in shard_paths]
+            keys_per_shard = [(i, entries.keys()) for i, entries in journals[suffix]]
+        else:
+            tables[suffix] = [(i, path, read_table(path)) for i, path in shard_paths]
+            keys_per_shard = [(i, df[pkey].astype(str)) for i, path, df in tables[suffix] if pkey in df.columns]
+        if duplicates := find_duplicates(keys_per_shard):
+            examples = ', '.join(f'{key} (shards {found})' for key, found in list(duplicates.items())[:5])
+            print(f'Error: {len(duplicates)} primary key(s) of "{suffix}" occur in more than one shard, e.g., {examples}')
+            return False
+
+    for suffix in list(journals) + list(tables):
+        path = os.path.join(output_dir, ifnb + suffix)
+        if os.path.exists(path):
+            raise FileExistsError(f'Output file "{path}" already exists')
+
+    order = lambda key: positions.get(key, len(positions))
+    for suffix, shard_entries in journals.items():
+        entries = {key: value for i, found in shard_entries for key, value in found.items()}
+        misplaced = sum(shard_of(key, n_shards) != i for i, found in shard_entries for key in found)
+        if misplaced:
+            print(f'Warning: {misplaced} primary key(s) of "{suffix}" were processed by another shard than --shard i/{n_shards} assigns')
+        journal = Journal(os.path.join(output_dir, ifnb + suffix))
+        for key in sorted(entries, key=order):
+            pk, (status, data) = entries[key]
+            journal.record(pk, status, data)
+        journal.close()
+
+        n_errors = sum(status == Journal.ERROR for pk, (status, data) in entries.values())
+        missing = [key for key in positions if key not in entries]
+        print(f'{ifnb + suffix}: {len(entries)} abstract(s) from {len(shard_entries)} shard(s), {n_errors} error(s), {len(missing)} missing')
+        if missing:
+            complete = False
+            missing_fn = os.path.join(output_dir, f'{ifnb}{os.path.splitext(suffix)[0]}__missing_keys.csv')
+            pd.DataFrame({pkey: missing}).to_csv(missing_fn, index=False)
+            print(f'Warning: {len(missing)} primary key(s) of the input are in no shard (listed in "{missing_fn}")')
+
+    for suffix, shard_tables in tables.items():
+        dfs = [df for i, path, df in sorted(shard_tables, key=lambda item: item[0])]
+        merged = pd.concat(dfs, ignore_index=True)
+        if pkey in merged.columns:
+            merged = merged.sort_values(pkey, key=lambda column: column.astype(str).map(order), kind='stable', ignore_index=True)
+        write_table(merged, os.path.join(output_dir, ifnb + suffix), shard_tables[0][1])
+        print(f'{ifnb + suffix}: {len(merged)} row(s) from {len(dfs)} shard(s)')
+
+    return complete
@@ -0,0 +1,24 @@
+import os
+import sys
+import threading
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+
+@pytest.fixture(scope='session')
+def mock_server():
+    '''The local mock LLM server of the benchmarks (see benchmarks/mock_server.py) running in a thread.'''
+    from mock_server import make_server
+    server = make_server(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def base_url(mock_server):
+    return f'http://127.0.0.1:{mock_server.server_port}/v1'
@@ -0,0 +1,34 @@
+import LEPAMTIC as lepamtic
+from metrics import CallMetrics, FIELDS
+from batch_api import BatchRunner, run_batch_conversations
+from chat_via_api import ChatDialog
+from llm_cache import ResponseCache
+
+
+ABSTRACT = 'Compared to conventional tillage, no tillage increased the abundance of earthworms.'
+
+
+def test_invalid_cached_answers_are_sent_again(base_url, tmp_path):
+    llm = ChatDialog(api_key='mock', base_url=base_url, model='mock', call_wait_time=0, cache=ResponseCache(str(tmp_path / 'cache')))
+    runner = BatchRunner(llm, str(tmp_path / 'batch'), poll_interval=0.01)
+    conversations = {'a': lepamtic.prescreen_turns(ABSTRACT)}
+    messages = llm.initial_messages() + [{'role': 'user', 'content': conversations['a'][0][0]}]
+    llm.cache.put(llm.cache.key(llm.base_url, llm.model, messages, llm.call_kwargs({})),
+                  {'id': 'cached', 'object': 'chat.completion', 'created': 0, 'model': 'mock',
+                   'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': '{"relevance": 1'}, 'finish_reason': 'stop'}]})
+
+    results, failed = run_batch_conversations(runner, 'screen', conversations, 2)
+    assert not failed and set(results['a'][0]) >= set(lepamtic.prescreen_fields)
+
+
+def test_batch_answers_are_recorded_in_the_metrics(base_url, tmp_path):
+    llm = ChatDialog(api_key='mock', base_url=base_url, model='gpt-4o-mini', call_wait_time=0, metrics=CallMetrics())
+    runner = BatchRunner(llm, str(tmp_path / 'batch'), poll_interval=0.01)
+    conversations = {pk: lepamtic.prescreen_turns(f'{ABSTRACT} ({pk})') for pk in 'ab'}
+    results, failed = run_batch_conversations(runner, 'screen', conversations, 2)
+    assert not failed
+    calls = sorted((call['pk'], call['stage'], call['turn'], call['batch'], call['prompt_tokens'] > 0)
+                   for call in (dict(zip(FIELDS, call)) for call in llm.metrics.calls))
+    assert calls == [('a', 'screen', 1, True, True), ('b', 'screen', 1, True, True)]
+    assert llm.usage['calls'] == 2 and llm.usage['prompt_tokens'] > 0
+    assert 'screen' in llm.metrics.summary()
@@ -0,0 +1,32 @@
+import pickle
+
+from chat_via_api import ChatDialog
+from llm_cache import ResponseCache, get_response_cache
+
+
+def test_repeated_calls_are_answered_from_the_cache(base_url, tmp_path):
+    llm = ChatDialog(api_key='mock', base_url=base_url, model='mock', call_wait_time=0, cache=get_response_cache(str(tmp_path)))
+    answer = llm.ask('Which soil biota are affected by tillage?')
+    llm.reset()
+    assert llm.ask('Which soil biota are affected by tillage?') == answer
+    assert llm.usage['calls'] == 1 and llm.cache.hits == 1
+
+    llm.forget_responses([llm.last_cache_key])
+    llm.reset()
+    llm.ask('Which soil biota are affected by tillage?')
+    assert llm.usage['calls'] == 2
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_size=1000)
+    response = {'choices': [{'message': {'content': 'x' * 200}}]}
+    for key in 'abcde':
+        cache.put(key, response)
+        cache.get('a')
+    assert cache.size <= cache.max_size
+    assert cache.get('a') is not None and cache.get('b') is None and cache.get('e') is not None
+
+
+def test_the_cache_is_shared_after_unpickling(tmp_path):
+    cache = get_response_cache(str(tmp_path))
+    assert pickle.loads(pickle.dumps(cache)) is cache
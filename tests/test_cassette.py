@@ -0,0 +1,30 @@
+import pytest
+
+from cassette import Cassette, CassetteMiss
+from chat_via_api import ChatDialog
+from metrics import tagged
+
+
+QUESTION = 'Which soil biota are affected by tillage?'
+
+
+def ask(llm, pk):
+    llm.reset()
+    with tagged(pk=pk, stage='patterns', turn=1):
+        return llm.ask(QUESTION)
+
+
+def test_recorded_answers_are_replayed_offline(base_url, tmp_path):
+    path = str(tmp_path / 'run.jsonl.gz')
+    cassette = Cassette(path, 'record')
+    llm = ChatDialog(api_key='mock', base_url=base_url, model='mock', call_wait_time=0, cassette=cassette)
+    answers = [ask(llm, pk) for pk in ('a', 'b')]
+    cassette.close()
+
+    # nothing listens on port 9: every answer must come from the cassette
+    llm = ChatDialog(api_key='mock', base_url='http://127.0.0.1:9/v1', model='mock', call_wait_time=0, cassette=Cassette(path, 'replay'))
+    assert [ask(llm, pk) for pk in ('b', 'a')] == answers[::-1]
+    with pytest.raises(CassetteMiss, match='all 1 recorded'):
+        ask(llm, 'a')
+    with pytest.raises(CassetteMiss, match='not recorded'):
+        ask(llm, 'c')
@@ -0,0 +1,37 @@
+import pytest
+
+from chat_via_api import ChatDialog, ContextTooLong
+from rate_limiter import estimate_tokens
+
+
+def dialog(max_context_tokens, context_overflow):
+    llm = ChatDialog(api_key='mock', base_url='http://127.0.0.1:9/v1', model='mock', call_wait_time=0,
+                     max_context_tokens=max_context_tokens, context_overflow=context_overflow)
+    for i in range(3):
+        llm.messages += [{'role': 'user', 'content': f'question {i} ' + 'word ' * 100},
+                         {'role': 'assistant', 'content': f'answer {i} ' + 'word ' * 100}]
+    return llm
+
+
+@pytest.mark.parametrize('context_overflow', ['fail', 'drop'])
+def test_too_long_question_leaves_dialog_unchanged(context_overflow):
+    llm = dialog(500, context_overflow)
+    before = llm.snapshot()
+    with pytest.raises(ContextTooLong):
+        llm.prepare_call('word ' * 1000, {})
+    assert llm.messages == before
+
+
+def test_fail_does_not_drop_turns():
+    llm = dialog(estimate_tokens(dialog(None, 'fail').messages), 'fail')
+    before = llm.snapshot()
+    with pytest.raises(ContextTooLong):
+        llm.prepare_call('the next question ' + 'word ' * 50, {})
+    assert llm.messages == before
+
+
+def test_drop_keeps_last_turns_that_fit():
+    llm = dialog(estimate_tokens(dialog(None, 'fail').messages), 'drop')
+    llm.prepare_call('the next question ' + 'word ' * 50, {})
+    assert [m['content'].split(' ')[:2] for m in llm.messages if m['role'] != 'system'] == \
+           [['question', '1'], ['answer', '1'], ['question', '2'], ['answer', '2'], ['the', 'next']]
@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from input_reader import InputReader
+
+
+def write_input(path, ids, abstracts):
+    df = pd.DataFrame({'id': ids, 'title': 'A title', 'abstract': abstracts})
+    if str(path).endswith('.xlsx'):
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+@pytest.mark.parametrize('name', ['in.csv', 'in.xlsx'])
+def test_records_are_read_in_chunks_without_empty_abstracts(tmp_path, name):
+    path = tmp_path / name
+    write_input(path, ['a', 'b', 'c', 'd', 'e'], ['Abstract a.', None, 'Abstract c.', 'Abstract d.', 'Abstract e.'])
+    reader = InputReader(str(path), 'id', 'abstract', chunksize=2)
+    assert list(reader) == [('a', 'Abstract a.'), ('c', 'Abstract c.'), ('d', 'Abstract d.'), ('e', 'Abstract e.')]
+    assert reader.n_empty == 1
+
+
+def test_duplicated_keys_stop_the_reading_where_they_occur(tmp_path):
+    path = tmp_path / 'in.csv'
+    write_input(path, ['a', 'b', 'a'], ['Abstract a.', 'Abstract b.', 'Abstract a again.'])
+    records = iter(InputReader(str(path), 'id', 'abstract', chunksize=1))
+    assert [next(records), next(records)] == [('a', 'Abstract a.'), ('b', 'Abstract b.')]
+    with pytest.raises(SyntaxError, match='duplicates'):
+        next(records)
+
+
+def test_missing_columns_are_refused(tmp_path):
+    path = tmp_path / 'in.csv'
+    write_input(path, ['a'], ['Abstract a.'])
+    with pytest.raises(SyntaxError, match='Abstract column'):
+        list(InputReader(str(path), 'id', 'summary'))
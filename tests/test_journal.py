@@ -0,0 +1,54 @@
+import glob
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from journal import Journal
+from conftest import REPO_DIR
+
+
+def journal_with_entry(path):
+    journal = Journal(str(path))
+    journal.record('a', Journal.OK, {'score': 1})
+    journal.close()
+
+
+def test_existing_journal_is_refused_without_resume(tmp_path):
+    journal_with_entry(tmp_path / 'journal.jsonl')
+    with pytest.raises(FileExistsError):
+        Journal(str(tmp_path / 'journal.jsonl'))
+
+
+def test_resume_continues_and_overwrite_starts_anew(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    journal_with_entry(path)
+    assert list(Journal(str(path), resume=True).load()) == ['a']
+    assert Journal(str(path), overwrite=True).load() == {}
+
+
+def journal_lengths(output_dir):
+    return {os.path.basename(fn): sum(1 for _ in open(fn, encoding='utf-8')) for fn in glob.glob(os.path.join(output_dir, '*journal*.jsonl'))}
+
+
+def test_pipeline_rerun_keeps_the_journals_of_a_crashed_run(tmp_path, base_url):
+    input_fn = tmp_path / 'abstracts.csv'
+    pd.DataFrame({'id': ['a', 'b', 'c'],
+                  'abstract': [f'No tillage increased the abundance of earthworms in field {i}.' for i in range(3)]}).to_csv(input_fn, index=False)
+    output_dir = tmp_path / 'results'
+    output_dir.mkdir()
+    command = [sys.executable, os.path.join(REPO_DIR, 'extractor.py'), 'pipeline', '--model_name', 'mock', '--scoring_model_name', 'mock',
+               '--actor_file', os.path.join(REPO_DIR, 'data', 'LLM_actors_list.csv'), '--input_file', str(input_fn),
+               '--output_dir', str(output_dir), '--primary_key', 'id', '--abstract_column', 'abstract', '--base_url', base_url]
+    subprocess.run(command, check=True, capture_output=True)
+    # a crash before the extraction tables are written
+    for fn in glob.glob(os.path.join(output_dir, '*__patterns__*.xlsx')) + glob.glob(os.path.join(output_dir, '*__errors__*.xlsx')):
+        os.remove(fn)
+    lengths = journal_lengths(output_dir)
+    assert len(lengths) == 3 and all(lengths.values())
+
+    rerun = subprocess.run(command, capture_output=True, text=True)
+    assert rerun.returncode != 0 and 'already exists' in rerun.stderr
+    assert journal_lengths(output_dir) == lengths
@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+import LEPAMTIC as lepamtic
+
+
+def test_structured_outputs_are_parsed_like_JSONL():
+    items = [{'actor': 'earthworms', 'property': 'abundance'}, {'actor': 'nematodes', 'property': 'diversity'}]
+    answer = json.dumps({'items': items})
+    assert lepamtic.parse_answer(answer, ['actor']) == items
+    assert lepamtic.parse_answer('\n'.join(map(json.dumps, items)), ['actor']) == items
+    with pytest.raises(json.JSONDecodeError):
+        lepamtic.parse_answer(json.dumps({'items': [{'property': 'abundance'}]}), ['actor'])
+
+
+def test_salvage_keeps_the_valid_lines():
+    answer = 'Here are the patterns:\n{"actor": "earthworms"}\n{"actor": "nematodes",\n{"property": "diversity"}'
+    rows, lines = lepamtic.salvage_JSONL(answer, ['actor'])
+    assert rows == [{'actor': 'earthworms'}, None, None]
+    assert lines == ['{"actor": "earthworms"}', '{"actor": "nematodes",', '{"property": "diversity"}']
+
+
+def test_repaired_rows_replace_the_invalid_ones_in_order():
+    rows, lines = [{'actor': 'a'}, None, {'actor': 'c'}, None], ['a', 'b?', 'c', 'd?']
+    rows, lines = lepamtic.merge_repaired(rows, lines, [{'actor': 'b'}, None, {'actor': 'e'}], ['b', 'd?', 'e'])
+    assert rows == [{'actor': 'a'}, {'actor': 'b'}, {'actor': 'c'}, {'actor': 'e'}]
+    assert lines == ['a', 'b', 'c', 'e']
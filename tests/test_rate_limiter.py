@@ -0,0 +1,62 @@
+import argparse
+import random
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+import extractor
+from chat_via_api import ChatDialog
+from rate_limiter import RateLimiter
+
+
+def test_headers_set_the_limits_without_configured_limits():
+    limiter = RateLimiter('test')
+    limiter.update({'x-ratelimit-limit-requests': '500', 'x-ratelimit-limit-tokens': '30000'})
+    assert (limiter.requests.per_minute, limiter.tokens.per_minute) == (500, 30000)
+    limiter.update({'x-ratelimit-limit-requests': '5000'})
+    assert limiter.requests.per_minute == 5000
+
+
+def test_configured_limits_cap_the_headers():
+    limiter = RateLimiter('test', rpm=100)
+    limiter.update({'x-ratelimit-limit-requests': '500'})
+    assert limiter.requests.per_minute == 100
+
+
+def test_zero_limits_of_the_headers_are_ignored():
+    limiter = RateLimiter('test')
+    limiter.update({'x-ratelimit-limit-requests': '0', 'x-ratelimit-remaining-requests': '0'})
+    assert limiter.requests is None
+    limiter.update({'x-ratelimit-limit-requests': '500'})
+    limiter.update({'x-ratelimit-limit-requests': '0'})
+    assert limiter.requests.per_minute == 500
+    assert limiter.reserve(10) == 0
+
+
+def test_local_endpoints_are_not_limited_by_default():
+    args = argparse.Namespace(rpm=None, tpm=None)
+    limiter = extractor.get_LLM_rate_limiter('http://127.0.0.1:9/v1', 'llama', args)
+    assert limiter.requests is None and limiter.tokens is None
+    assert limiter.reserve(1000) == 0
+
+
+def rate_limit_error(retry_after):
+    request = httpx.Request('POST', 'http://127.0.0.1:9/v1/chat/completions')
+    return RateLimitError('Rate limit', response=httpx.Response(429, headers={'retry-after': retry_after}, request=request), body=None)
+
+
+def test_repeated_rate_limit_errors_back_off(monkeypatch):
+    monkeypatch.setattr(random, 'uniform', lambda low, high: high)
+    llm = ChatDialog(api_key='mock', base_url='http://127.0.0.1:9/v1', model='mock', rate_limiter=RateLimiter('test'))
+    attempts = {}
+    assert [llm.retry_delay(rate_limit_error('0.5'), attempts) for _ in range(4)] == [1, 2, 4, 8]
+    assert llm.retry_delay(rate_limit_error('30'), attempts) == 30
+    with pytest.raises(RateLimitError):
+        llm.retry_delay(rate_limit_error('0.5'), attempts)
+
+
+def test_api_retries_of_unknown_errors_are_refused():
+    assert extractor.parse_api_retries('RateLimitError=8') == ('RateLimitError', 8)
+    with pytest.raises(argparse.ArgumentTypeError):
+        extractor.parse_api_retries('RateLimitErorr=8')
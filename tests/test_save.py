@@ -0,0 +1,20 @@
+import argparse
+
+import extractor
+from chat_via_api import ChatDialog
+
+
+def test_save_dialog_with_metrics(tmp_path, base_url):
+    args = argparse.Namespace(model_name='llama', base_url=base_url, openai_keyfile=None, google_keyfile=None, rpm=None, tpm=None,
+                              cache_dir=None, record=None, replay=None, structured_outputs=False, salvage_attempts=0,
+                              turn_retries=0, api_retries=None, stream=False, max_context_tokens=None, context_overflow='fail',
+                              trim_context=False, metrics_file=str(tmp_path / 'metrics.jsonl'), prices=None)
+    llm = extractor.get_LLM(args.model_name, args)
+    assert llm.metrics is not None
+    llm.save(str(tmp_path / 'dialog.pickle'))
+    assert llm.client is not None
+
+    loaded = ChatDialog.load(str(tmp_path / 'dialog.pickle'))
+    assert loaded.metrics is llm.metrics and loaded.rate_limiter is llm.rate_limiter
+    loaded.ask('Hello')
+    assert loaded.metrics.calls
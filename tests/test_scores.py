@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+import extractor
+from conftest import REPO_DIR
+from journal import Journal
+
+
+def write_scores(tmp_path):
+    journal = Journal(str(tmp_path / 'in__score_journal.jsonl'))
+    journal.record('a', Journal.OK, {'abstract_score': 8, 'abstract_score_explanation': 'Relevant.', 'abstract_score_model': 'gpt-4o'})
+    journal.record('b', Journal.OK, {'abstract_score': 2, 'abstract_score_explanation': 'Not relevant.', 'abstract_score_model': 'gpt-4o-mini'})
+    journal.record('c', Journal.ERROR)
+    journal.close()
+    pd.DataFrame({'id': ['a', 'b'], 'abstract_score': [8, 2], 'abstract_score_explanation': ['Relevant.', 'Not relevant.']}).to_csv(tmp_path / 'old__scored.csv', index=False)
+
+
+def test_load_scores_with_their_model(tmp_path):
+    write_scores(tmp_path)
+    scores = extractor.load_scores(str(tmp_path / 'in__score_journal.jsonl'), 'id')
+    assert scores == {'a': {'score': 8, 'score_explanation': 'Relevant.', 'model': 'gpt-4o'},
+                      'b': {'score': 2, 'score_explanation': 'Not relevant.', 'model': 'gpt-4o-mini'}}
+    assert {score['model'] for score in extractor.load_scores(str(tmp_path / 'old__scored.csv'), 'id').values()} == {None}
+
+
+def test_found_scores_of_other_models_are_not_used(tmp_path):
+    write_scores(tmp_path)
+    fname = str(tmp_path / 'in__score_journal.jsonl')
+    scores = extractor.load_scores(fname, 'id')
+    assert list(extractor.scores_of_model(scores, fname, 'gpt-4o', explicit=False)) == ['a']
+    assert extractor.scores_of_model(scores, fname, 'gpt-4o', explicit=True) == scores
+    fname = str(tmp_path / 'old__scored.csv')
+    assert extractor.scores_of_model(extractor.load_scores(fname, 'id'), fname, 'gpt-4o', explicit=False) == {}
+
+
+def test_score_mode_streams_to_its_own_file(tmp_path, base_url):
+    input_fn = tmp_path / 'abstracts.csv'
+    pd.DataFrame({'id': ['a', 'b'], 'abstract': ['No tillage increased the abundance of earthworms.'] * 2}).to_csv(input_fn, index=False)
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'extractor.py'), 'score', '--scoring_model_name', 'mock', '--input_file', str(input_fn),
+                    '--output_dir', str(tmp_path), '--primary_key', 'id', '--abstract_column', 'abstract', '--base_url', base_url],
+                   check=True, capture_output=True)
+    assert {'abstracts__score_stream.csv', 'abstracts__scored.csv'} <= set(os.listdir(tmp_path))
+    assert len(pd.read_csv(tmp_path / 'abstracts__score_stream.csv')) == 2
+
+
+def test_abstracts_below_the_minimum_score_are_only_scored():
+    scores = {'a': {'score': 4, 'score_explanation': 'Relevant.'}, 'b': {'score': 1, 'score_explanation': 'Not relevant.'}}
+    assert not extractor.below_min_score(scores['b'], None)
+    assert [pk for pk, score in scores.items() if extractor.below_min_score(score, 2)] == ['b']
+    row = extractor.below_min_score_row('b', scores['b'], 'id')
+    assert len(row) == 1 and row.loc[0, 'score'] == 1 and list(row.columns) == extractor.extraction_columns('id')
+
+
+def test_abstracts_are_extracted_in_the_order_of_their_scores():
+    scores = {'a': {'score': 2}, 'b': {'score': 5}, '3': {'score': 2}}
+    items = [('a', 'A.'), (3, 'C.'), ('d', 'D.'), ('b', 'B.')]
+    assert [pk for pk, abstract in extractor.order_by_score(items, scores)] == ['b', 'a', 3, 'd']
@@ -0,0 +1,50 @@
+import argparse
+
+import pandas as pd
+import pytest
+
+from journal import Journal, read_journal
+from sharding import merge_shards, parse_shard, shard_of, shard_tag
+
+
+KEYS = [f'WOS:{i:06d}' for i in range(20)]
+
+
+def test_shards_split_the_keys():
+    assert parse_shard('2/4') == (2, 4)
+    for value in ('0/4', '5/4', '2', 'a/4'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
+    shards = [shard_of(pk, 3) for pk in KEYS]
+    assert set(shards) == {1, 2, 3} and shards == [shard_of(pk, 3) for pk in KEYS]
+
+
+def write_shards(tmp_path, keys):
+    '''Write the screen journal and result table of every shard of keys as a run with --shard i/2 does.'''
+    input_fn = tmp_path / 'in.csv'
+    pd.DataFrame({'id': KEYS, 'abstract': [f'Abstract {pk}.' for pk in KEYS]}).to_csv(input_fn, index=False)
+    shard_dir = tmp_path / 'shards'
+    shard_dir.mkdir()
+    for i in (1, 2):
+        shard_keys = [pk for pk in keys if shard_of(pk, 2) == i]
+        journal = Journal(str(shard_dir / f'in{shard_tag((i, 2))}__screen_journal.jsonl'))
+        for pk in shard_keys:
+            journal.record(pk, Journal.OK, {'relevance': 1})
+        journal.close()
+        pd.DataFrame({'id': shard_keys, 'relevance': 1}).to_csv(shard_dir / f'in{shard_tag((i, 2))}__screened.csv', index=False)
+    output_dir = tmp_path / 'merged'
+    output_dir.mkdir()
+    return str(input_fn), str(output_dir), [str(shard_dir)]
+
+
+def test_merged_shards_keep_the_input_order(tmp_path):
+    input_fn, output_dir, directories = write_shards(tmp_path, KEYS)
+    assert merge_shards(input_fn, 'id', 'abstract', output_dir, 2, directories)
+    assert list(read_journal(f'{output_dir}/in__screen_journal.jsonl')) == KEYS
+    assert pd.read_csv(f'{output_dir}/in__screened.csv')['id'].tolist() == KEYS
+
+
+def test_missing_keys_are_listed(tmp_path):
+    input_fn, output_dir, directories = write_shards(tmp_path, KEYS[:-2])
+    assert not merge_shards(input_fn, 'id', 'abstract', output_dir, 2, directories)
+    assert pd.read_csv(f'{output_dir}/in__screen_journal__missing_keys.csv')['id'].tolist() == KEYS[-2:]
@@ -0,0 +1,45 @@
+import pytest
+
+import LEPAMTIC as lepamtic
+
+
+@pytest.mark.parametrize('value, items', [
+    # no conjunction
+    ('earthworm abundance', ['earthworm abundance']),
+    (None, [None]),
+    # items which can be split
+    ('abundance and diversity', ['abundance', 'diversity']),
+    ('nematodes, earthworms and mites', ['nematodes', 'earthworms', 'mites']),
+    ('tillage or mulching', ['tillage', 'mulching']),
+    ('bacterial biomass and fungal biomass', ['bacterial biomass', 'fungal biomass']),
+    ('soil carbon and soil nitrogen', ['soil carbon', 'soil nitrogen']),
+    ('abundance of bacteria and diversity of fungi', ['abundance of bacteria', 'diversity of fungi']),
+    # relations and parentheses
+    ('fungi to bacteria ratio', ['fungi to bacteria ratio']),
+    ('fungi and bacteria ratio', None),
+    ('interaction between tillage and cover crops', None),
+    ('biomass (carbon and nitrogen)', None),
+    # a shared head noun
+    ('bacterial and fungal biomass', None),
+    # a prepositional phrase of the last item only
+    ('abundance and diversity of nematodes', None),
+    ('abundance of bacteria and fungi', None),
+    # a modifier of the first item
+    ('bacterial abundance and diversity', None),
+    ('microbial biomass carbon and nitrogen', None),
+    ('soil fauna and flora', None),
+    ('total carbon and nitrogen content', None),
+])
+def test_split_conjunct_value(value, items):
+    assert lepamtic.split_conjunct_value(value) == items
+
+
+def test_split_conjunctions():
+    patterns = [{'property': 'abundance and diversity', 'actor': 'tillage or mulching', 'effect': 'negative'},
+                {'property': 'soil fauna and flora', 'actor': 'tillage', 'effect': 'negative'}]
+    result, ambiguous = lepamtic.split_conjunctions(patterns)
+    assert [(p['property'], p['actor']) for p in result] == [('abundance', 'tillage'), ('abundance', 'mulching'),
+                                                             ('diversity', 'tillage'), ('diversity', 'mulching'),
+                                                             ('soil fauna and flora', 'tillage')]
+    assert all(p['effect'] == 'negative' for p in result)
+    assert ambiguous == ['soil fauna and flora']
@@ -0,0 +1,31 @@
+import asyncio
+
+import LEPAMTIC as lepamtic
+from chat_via_api import ChatDialog, AsyncChatDialog
+
+
+ABSTRACT = 'Compared to conventional tillage, no tillage increased the abundance and diversity of earthworms.'
+
+
+def test_streamed_score(base_url):
+    llm = ChatDialog(api_key='mock', base_url=base_url, model='mock', call_wait_time=0, stream=True)
+    score = lepamtic.extract_score(llm, ABSTRACT)
+    assert set(score[0]) >= {'score', 'score_explanation'}
+
+
+def test_streamed_score_async(base_url):
+    async def score_all():
+        dialogs = [AsyncChatDialog(api_key='mock', base_url=base_url, model='mock', call_wait_time=0, stream=True) for _ in range(3)]
+        return await asyncio.gather(*[lepamtic.extract_score_async(llm, f'{ABSTRACT} ({i})') for i, llm in enumerate(dialogs)])
+
+    scores = asyncio.run(score_all())
+    assert len(scores) == 3
+    assert all(set(score[0]) >= {'score', 'score_explanation'} for score in scores)
+
+
+def test_streamed_patterns_async(base_url):
+    llm = AsyncChatDialog(api_key='mock', base_url=base_url, model='mock', call_wait_time=0, stream=True)
+    streamed = []
+    patterns = asyncio.run(lepamtic.extract_patterns_async(llm, ABSTRACT, on_pattern=streamed.append))
+    assert patterns and streamed == patterns
+    assert all(set(pattern) >= set(lepamtic.pattern_fields) for pattern in patterns)
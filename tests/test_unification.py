@@ -0,0 +1,108 @@
+import argparse
+import queue
+
+import pandas as pd
+import pytest
+
+import LEPAMTIC as lepamtic
+import extractor
+import unification
+from chat_via_api import ChatDialog
+from lexicon import Lexicon
+from llm_cache import ResponseCache
+from unification import IncompleteUnification, map_unified, unify_batch, unify_items
+
+
+def items(*values):
+    return [{'actor': value, 'sentences': f'A sentence about {value}.'} for value in values]
+
+
+def answering(answer):
+    '''A unification function which gives answer whatever it is asked.'''
+    return lambda llm, items, unified_list, **kwargs: answer
+
+
+class NoCache:
+    '''The cache interface of a dialog for unification functions which do not call the LLM.'''
+    last_cache_key = None
+
+    def forget_responses(self, keys):
+        pass
+
+
+def cached_incomplete_answer(base_url, cache_dir, values):
+    '''A dialog with a cache whose answer to the unification of values misses the last value.'''
+    llm = ChatDialog(api_key='mock', base_url=base_url, model='mock', call_wait_time=0, cache=ResponseCache(str(cache_dir)))
+    unify_items(llm, 'actor', items(*values), ['Earthworms', 'Nematodes'], {})
+    response = llm.cache.get(llm.last_cache_key)
+    message = response['choices'][0]['message']
+    message['content'] = '\n'.join(line for line in message['content'].splitlines() if values[-1] not in line)
+    llm.cache.put(llm.last_cache_key, response)
+    llm.reset()
+    return llm
+
+
+def test_answers_are_matched_by_value():
+    answer = [{'actor': ' Earthworms.', 'actor_unified': 'Earthworms'},
+              {'actor': 'soil bacteria', 'actor_unified': 'Soil microbiome'}]
+    assert map_unified(items('soil bacteria', 'earthworms'), answer, 'actor') == {'soil bacteria': 'Soil microbiome',
+                                                                                 'earthworms': 'Earthworms'}
+
+
+def test_missing_and_unknown_values_fail():
+    answer = [{'actor': 'earthworms', 'actor_unified': 'Earthworms'},
+              {'actor': 'nematodes', 'actor_unified': 'Nematodes'}]
+    assert map_unified(items('earthworms', 'soil bacteria'), answer, 'actor') is None
+
+
+def test_unify_items_keeps_the_order_of_the_items(monkeypatch):
+    answer = [{'actor': 'soil bacteria', 'actor_unified': 'Soil microbiome'},
+              {'actor': 'earthworms', 'actor_unified': 'Earthworms'}]
+    monkeypatch.setitem(unification.UNIFY_FUNCTIONS, 'actor', (answering(answer), None))
+    result = unify_items(NoCache(), 'actor', items('earthworms', 'soil bacteria', 'earthworms'), [], {})
+    assert [row['actor_unified'] for row in result] == ['Earthworms', 'Soil microbiome', 'Earthworms']
+
+
+def test_incomplete_answers_are_not_added_to_the_lexicon(monkeypatch, tmp_path):
+    lexicon = Lexicon(str(tmp_path / 'lexicon.db'), min_count=1)
+    answer = [{'actor': 'nematodes', 'actor_unified': 'Nematodes'}]
+    monkeypatch.setitem(unification.UNIFY_FUNCTIONS, 'actor', (answering(answer), None))
+    with pytest.raises(IncompleteUnification):
+        unify_items(NoCache(), 'actor', items('earthworms', 'nematodes'), [], {}, lexicon)
+    assert lexicon.lookup('actor', [], ['earthworms', 'nematodes']) == {}
+
+
+def test_unify_patterns_reuses_the_dialogs_of_a_run(monkeypatch, base_url):
+    created = []
+    def get_LLM(model_name, args):
+        created.append(ChatDialog(api_key='mock', base_url=base_url, model=model_name, call_wait_time=0))
+        return created[-1]
+    monkeypatch.setattr(extractor, 'get_LLM', get_LLM)
+
+    args = argparse.Namespace(model_name='mock', unify_batch_size=2, workers=3, n_repeats=1)
+    llms = queue.SimpleQueue()
+    for flush in range(3):
+        patterns_dfs = {f'{flush}-{i}': pd.DataFrame([dict(dict.fromkeys(['id'] + lepamtic.pattern_fields, ''), sentences='A sentence.',
+                                                           actor=f'actor {flush} {i} {j}', property=f'property {flush} {i} {j}')
+                                                      for j in range(4)])
+                        for i in range(3)}
+        result = extractor.unify_patterns(patterns_dfs, ['Earthworms', 'Nematodes'], {}, args, llms=llms)
+        assert all(df is not None for df in result.values())
+    assert len(created) <= args.workers
+
+
+def test_incomplete_cached_answers_are_asked_again(base_url, tmp_path):
+    values = ('earthworms', 'nematodes')
+    llm = cached_incomplete_answer(base_url, tmp_path / 'cache', values)
+    def unify():
+        llm.reset()
+        return unify_items(llm, 'actor', items(*values), ['Earthworms', 'Nematodes'], {})
+    ok, result = extractor.repeat_on_error(unify, 2)
+    assert ok and [row['actor'] for row in result] == list(values)
+
+
+def test_incomplete_cached_batch_answers_are_asked_again(base_url, tmp_path):
+    values = ('earthworms', 'nematodes')
+    llm = cached_incomplete_answer(base_url, tmp_path / 'cache', values)
+    mapping = unify_batch(llm, 'actor', items(*values), ['Earthworms', 'Nematodes'], {}, 2)
+    assert mapping is not None and set(mapping) == set(values)
@@ -0,0 +1,21 @@
+import glob
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+from conftest import REPO_DIR
+
+
+def test_workers_keep_the_order_of_the_input(tmp_path, base_url):
+    input_fn = tmp_path / 'abstracts.csv'
+    keys = [f'k{i}' for i in range(8)]
+    pd.DataFrame({'id': keys, 'abstract': [f'No tillage increased the abundance of earthworms in field {pk}.' for pk in keys]}).to_csv(input_fn, index=False)
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'extractor.py'), 'extract', '--model_name', 'mock', '--scoring_model_name', 'mock',
+                    '--actor_file', os.path.join(REPO_DIR, 'data', 'LLM_actors_list.csv'), '--input_file', str(input_fn),
+                    '--output_dir', str(tmp_path), '--primary_key', 'id', '--abstract_column', 'abstract', '--base_url', base_url,
+                    '--workers', '3'], check=True, capture_output=True)
+    patterns_fn, = glob.glob(str(tmp_path / 'abstracts__patterns__*.xlsx'))
+    found = pd.read_excel(patterns_fn)['id'].drop_duplicates().tolist()
+    assert found == [pk for pk in keys if pk in found] and len(found) > 1
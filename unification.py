@@ -0,0 +1,140 @@
+import logging
+from json import JSONDecodeError
+
+from openai import APIError
+
+import LEPAMTIC as lepamtic
+from lexicon import normalize_term
+
+
+logger = logging.getLogger(f"lepamtic.{__name__}")
+
+# pattern field -> (unification function, turns of the unification conversation)
+UNIFY_FUNCTIONS = {'actor': (lepamtic.unify_actors, lepamtic.unify_actors_turns),
+                   'property': (lepamtic.unify_property, lepamtic.unify_property_turns)}
+
+
+class IncompleteUnification(ValueError):
+    '''The answer of a unification call does not give a unified value for some of the values which were sent.'''
+    def __init__(self, field, missing):
+        super().__init__(f'No unified {field} in the answer for {len(missing)} value(s): {missing[:5]}')
+        self.field = field
+        self.missing = missing
+
+
+def match_unified(values, answer, field):
+    '''Match the rows of a unification answer to values by the echoed value of field (see lexicon.normalize_term()).
+
+    Returns a tuple (mapping, missing) with a dict value -> unified value and the list of values which are not in the answer.
+    '''
+    answered = {}
+    for row in answer:
+        if isinstance(row, dict) and row.get(f'{field}_unified') is not None:
+            answered.setdefault(normalize_term(row.get(field)), row[f'{field}_unified'])
+    mapping = {}
+    missing = []
+    for value in dict.fromkeys(values):
+        key = normalize_term(value)
+        if key in answered:
+            mapping[value] = answered[key]
+        else:
+            missing.append(value)
+    return mapping, missing
+
+
+def split_known(lexicon, field, items, unified_list):
+    '''Return a tuple (known, unknown) with a dict value -> unified value of the items answered by the lexicon
+    (see lexicon.Lexicon) and a list of the items which have to be sent to the LLM.
+    '''
+    items = list(items)
+    if lexicon is None:
+        return {}, items
+    known = lexicon.lookup(field, unified_list, [item[field] for item in items])
+    return known, [item for item in items if item[field] not in known]
+
+
+def unify_items(llm, field, items, unified_list, llm_parameters, lexicon=None):
+    '''Unify the items of one abstract (dicts with `field` and "sentences") in one call.
+
+    Returns a list of dicts with field and f"{field}_unified" in the order of the items. The answers are matched
+    to the items by their values (see match_unified()) and IncompleteUnification is raised if some are missing.
+    With a lexicon only unknown values are sent to the LLM and the answers are added to the lexicon.
+    '''
+    function = UNIFY_FUNCTIONS[field][0]
+    known, unknown = split_known(lexicon, field, items, unified_list)
+    answer = function(llm, unknown, unified_list, **llm_parameters) if unknown else []
+    mapping, missing = match_unified([item[field] for item in unknown], answer, field)
+    if missing:
+        # the next attempt must not get the same answer from the cache
+        llm.forget_responses([llm.last_cache_key])
+        raise IncompleteUnification(field, missing)
+    if lexicon is not None:
+        lexicon.add(field, unified_list, mapping)
+    mapping.update(known)
+    return [{field: item[field], f'{field}_unified': mapping[item[field]]} for item in items]
+
+
+def unification_batches(items, field, batch_size):
+    '''Split items (dicts with `field` and "sentences") into batches of at most batch_size items with distinct values of field.
+
+    Every value is sent only once, with the first sentence it was seen in as its context.
+    '''
+    unique = {}
+    for item in items:
+        unique.setdefault(item[field], {field: item[field], 'sentences': item['sentences']})
+    unique = list(unique.values())
+    return [unique[i:i+batch_size] for i in range(0, len(unique), batch_size)]
+
+
+def map_unified(batch, answer, field):
+    '''Return a dict value -> unified value for the items of the batch or None if the answer does not cover all of them.'''
+    mapping, missing = match_unified([item[field] for item in batch], answer, field)
+    if missing:
+        logger.warning(f'Unification of {len(batch)} {field} value(s) gave no answer for {len(missing)} of them: {missing[:5]}')
+        return None
+    return mapping
+
+
+def unify_batch(llm, field, batch, unified_list, llm_parameters, n_repeats):
+    '''Unify a batch of values of field (see unification_batches()) in one call, repeated up to n_repeats times on errors.
+
+    Returns a dict value -> unified value or None if all attempts failed.
+    '''
+    function = UNIFY_FUNCTIONS[field][0]
+    for cnt in range(n_repeats):
+        try:
+            llm.reset()
+            mapping = map_unified(batch, function(llm, batch, unified_list, **llm_parameters), field)
+        except JSONDecodeError as e:
+            print(e)
+            mapping = None
+        except APIError as e:
+            print(f'API error: {e}')
+            return None
+        if mapping is not None:
+            return mapping
+        llm.forget_responses([llm.last_cache_key])
+        print(f'Error, attempt {cnt+1} of {n_repeats}')
+    return None
+
+
+def apply_unification(patterns_dfs, mappings, failed):
+    '''Add the actor_unified and property_unified columns to the patterns of many abstracts.
+
+    patterns_dfs is a dict primary key -> patterns dataframe, mappings is a dict field -> (dict value -> unified value)
+    and failed is a dict field -> set of values which could not be unified.
+    Returns a dict primary key -> dataframe or None if any of its values could not be unified.
+    '''
+    result_dfs = {}
+    for pk, patterns_df in patterns_dfs.items():
+        if patterns_df['actor'].isin(failed['actor']).any():
+            print(f'Error while unifying actors for {pk}')
+            result_dfs[pk] = None
+        elif patterns_df['property'].isin(failed['property']).any():
+            print(f'Error while unifying property for {pk}')
+            result_dfs[pk] = None
+        else:
+            patterns_df.insert(7, 'actor_unified', patterns_df['actor'].map(mappings['actor']))
+            patterns_df.insert(6, 'property_unified', patterns_df['property'].map(mappings['property']))
+            result_dfs[pk] = patterns_df
+    return result_dfs